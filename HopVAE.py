@@ -1,12 +1,18 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
-import numpy as np
+from contextlib import nullcontext
 
 from hflayers import HopfieldLayer
 
-from utils import get_prior, straight_through_round
+from utils import get_prior, get_prior_sampler, prior_prediction_error, straight_through_round
+from utils import entropy_codec, tiling
+from utils.codes import codes_from_bytes, codes_to_bytes
+from utils.decode_cache import DecodeCache, EmbeddingCache
+from utils.fused_hopfield import fuse_lookup
+from utils.profiling import StageProfiler
 
 class Residual(nn.Module):
     def __init__(self, in_channels, num_hiddens, num_residual_hiddens):
@@ -25,22 +31,34 @@ class Residual(nn.Module):
     def forward(self, x):
         return x + self._block(x)
 
+    def forward_out_of_place(self, x):
+        # Same result as forward, whose first in place ReLU also rewrites x before the sum. Recomputation
+        # under activation checkpointing must not modify its saved input, so the ReLU is applied out of place
+        x = F.relu(x)
+        return x + self._block[1:](x)
+
 
 class ResidualStack(nn.Module):
-    def __init__(self, in_channels, num_hiddens, num_residual_layers, num_residual_hiddens):
+    def __init__(self, in_channels, num_hiddens, num_residual_layers, num_residual_hiddens, checkpoint_activations=False):
         super(ResidualStack, self).__init__()
         self._num_residual_layers = num_residual_layers
+        self.checkpoint_activations = checkpoint_activations
         self._layers = nn.ModuleList([Residual(in_channels, num_hiddens, num_residual_hiddens)
                              for _ in range(self._num_residual_layers)])
 
     def forward(self, x):
+        # Checkpointed layers keep only their input and recompute the rest during backward
+        recompute = self.checkpoint_activations and self.training and torch.is_grad_enabled()
         for i in range(self._num_residual_layers):
-            x = self._layers[i](x)
+            if recompute:
+                x = checkpoint(self._layers[i].forward_out_of_place, x, use_reentrant=False)
+            else:
+                x = self._layers[i](x)
         return F.relu(x)
 
 
 class Encoder(nn.Module):
-    def __init__(self, in_channels, num_hiddens, num_residual_layers, num_residual_hiddens):
+    def __init__(self, in_channels, num_hiddens, num_residual_layers, num_residual_hiddens, checkpoint_activations=False):
         super(Encoder, self).__init__()
 
         self.conv_1 = nn.Conv2d(in_channels=in_channels,
@@ -66,7 +84,8 @@ class Encoder(nn.Module):
         self.residual_stack = ResidualStack(in_channels=num_hiddens,
                                              num_hiddens=num_hiddens,
                                              num_residual_layers=num_residual_layers,
-                                             num_residual_hiddens=num_residual_hiddens)
+                                             num_residual_hiddens=num_residual_hiddens,
+                                             checkpoint_activations=checkpoint_activations)
 
     def forward(self, inputs):
         x = self.conv_1(inputs)
@@ -84,7 +103,7 @@ class Encoder(nn.Module):
 
 
 class Decoder(nn.Module):
-    def __init__(self, in_channels, out_channels, num_hiddens, num_residual_layers, num_residual_hiddens):
+    def __init__(self, in_channels, out_channels, num_hiddens, num_residual_layers, num_residual_hiddens, checkpoint_activations=False):
         super(Decoder, self).__init__()
         
         self.conv_1 = nn.Conv2d(in_channels=in_channels,
@@ -95,7 +114,8 @@ class Decoder(nn.Module):
         self.residual_stack = ResidualStack(in_channels=num_hiddens,
                                              num_hiddens=num_hiddens,
                                              num_residual_layers=num_residual_layers,
-                                             num_residual_hiddens=num_residual_hiddens)
+                                             num_residual_hiddens=num_residual_hiddens,
+                                             checkpoint_activations=checkpoint_activations)
         
         self.conv_trans_1 = nn.ConvTranspose2d(in_channels=num_hiddens, 
                                                 out_channels=num_hiddens//2,
@@ -136,10 +156,15 @@ class HopVAE(nn.Module):
         self.index_dim = config.index_dim
         self.representation_dim = config.representation_dim
         self.num_levels = config.num_levels
+        self.mixed_precision = config.mixed_precision
+        self.image_size = config.image_size
+        self.num_channels = config.num_channels
+        self.tile_overlap = config.tile_overlap
 
         self.encoder = Encoder(config.num_channels, config.num_hiddens,
                                 config.num_residual_layers, 
-                                config.num_residual_hiddens)
+                                config.num_residual_hiddens,
+                                config.checkpoint_residual)
 
         self.pre_vq_conv = nn.Conv2d(in_channels=config.num_hiddens, 
                                       out_channels=config.embedding_dim,
@@ -177,118 +202,298 @@ class HopVAE(nn.Module):
         
         self.fit_prior = False
         self.prior = get_prior(config, device)
+        self.prior_sampler = get_prior_sampler(config, self.prior)
+
+        # Set while a StageProfiler is active, see profile()
+        self.profiler = None
+        # Filled by compile_lookups(), kept out of the module tree so they never reach the state dict
+        self.fused_lookups = {}
+        # Set by enable_decode_cache(), eval mode decodes go through them
+        self.decode_cache = None
+        self.embedding_cache = None
+        # Recompute the Hopfield attention in backward instead of keeping the (B, H * W, num_embeddings) maps
+        self.checkpoint_hopfield = config.checkpoint_hopfield
 
         self.decoder = Decoder(config.embedding_dim,
                         config.num_channels,
                         config.num_hiddens, 
                         config.num_residual_layers, 
-                        config.num_residual_hiddens)
+                        config.num_residual_hiddens,
+                        config.checkpoint_residual)
+
+        self.channels_last = config.channels_last
+        if self.channels_last:
+            self.to(memory_format=torch.channels_last)
+
+    def profile(self, count_flops=False, trace_dir=None, trace_wait=1, trace_warmup=1, trace_active=3):
+        # Use as a context manager, wrapping each training step in profiler.step() to aggregate per step
+        return StageProfiler(self, count_flops, trace_dir, trace_wait, trace_warmup, trace_active)
+
+    def stage(self, name):
+        return self.profiler.stage(name) if self.profiler is not None else nullcontext()
+
+    def profile_step(self, stage=None):
+        return self.profiler.step(stage) if self.profiler is not None else nullcontext()
+
+    def unprofiled(self):
+        # For evaluation inside a profiled run, whose forwards are not training steps
+        return self.profiler.pause() if self.profiler is not None else nullcontext()
+
+    def to_sequence(self, z, channels):
+        # (B, C, H, W) -> (B, H * W, C) for the Hopfield layers, a pure view when z is channels_last
+        return z.permute(0, 2, 3, 1).reshape(-1, self.representation_dim * self.representation_dim, channels)
+
+    def to_grid(self, z, channels):
+        # (B, H * W, C) -> (B, C, H, W), the permuted view already has channels_last strides so only NCHW needs a copy
+        z = z.view(-1, self.representation_dim, self.representation_dim, channels).permute(0, 3, 1, 2)
+        return z if self.channels_last else z.contiguous()
+
+    def fuse_lookups(self, top_k=None, num_queries=256):
+        # Fused versions of the three Hopfield lookups, layers the fusion does not reproduce are left out
+        probes = {
+            "hopfield": torch.randn(1, num_queries, self.embedding_dim, device=self.device),
+            "embedding_to_index": torch.randn(1, num_queries, self.embedding_dim, device=self.device),
+            "index_to_embedding": torch.rand(1, num_queries, self.index_dim, device=self.device)
+        }
+        # Top-k would change the indices the codes are quantised from, so it is only used for retrieval and decoding
+        fused_lookups = {}
+        for name, probe in probes.items():
+            fused = fuse_lookup(getattr(self, name), probe, top_k=None if name == "embedding_to_index" else top_k)
+            if fused is not None:
+                fused_lookups[name] = fused
+        return fused_lookups
+
+    def compile_lookups(self, top_k=None, num_queries=256):
+        # Precomputes the three Hopfield lookups for inference, needs calling again whenever the weights change
+        self.fused_lookups = self.fuse_lookups(top_k, num_queries)
+        self.clear_decode_cache()
+
+    def release_lookups(self):
+        self.fused_lookups = {}
+        self.clear_decode_cache()
+
+    def enable_decode_cache(self, max_bytes, max_embeddings=0):
+        # Memoised decodes for inference, whole images by packed code grid and index_to_embedding outputs by
+        # index vector, see utils.decode_cache. Either is skipped when its limit is 0
+        self.decode_cache = DecodeCache(max_bytes, self.num_levels) if max_bytes else None
+        self.embedding_cache = EmbeddingCache(max_embeddings, self.num_levels, self.index_dim, self.embedding_dim, self.device) if max_embeddings else None
+
+    def clear_decode_cache(self):
+        # Cached outputs belong to the current weights and lookups
+        for cache in (self.decode_cache, self.embedding_cache):
+            if cache is not None:
+                cache.clear()
+
+    def release_decode_cache(self):
+        self.decode_cache = None
+        self.embedding_cache = None
+
+    def lookup(self, name, z):
+        fused = self.fused_lookups.get(name)
+        if fused is not None and not self.training:
+            return fused(z)
+        if self.checkpoint_hopfield and self.training and torch.is_grad_enabled():
+            return checkpoint(getattr(self, name), z, use_reentrant=False)
+        return getattr(self, name)(z)
+
+    def autocast(self, enabled=None):
+        # bf16 needs no loss scaling and is supported by autocast on both CPU and CUDA
+        enabled = self.mixed_precision if enabled is None else enabled
+        return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=enabled)
+
+    def lookup_embeddings(self, z_indices):
+        # bf16 cannot hold every one of the num_levels steps, so the index lookup always runs in fp32
+        with self.autocast(False):
+            return self.lookup("index_to_embedding", z_indices.float())
+
+    def decode_embeddings(self, z_embeddings):
+        z_embeddings = self.to_grid(z_embeddings, self.embedding_dim)
+
+        with self.autocast():
+            x_recon = self.decoder(z_embeddings)
 
-    def sample(self):
-        z_indices = self.prior.sample().type(torch.int64) / (self.num_levels - 1)
+        return x_recon.float()
+
+    def decode(self, z_indices_quantised):
+        if self.decode_cache is not None and not self.training:
+            return self.decode_cache(z_indices_quantised, self.decode_uncached)
+        return self.decode_uncached(z_indices_quantised)
+
+    def decode_uncached(self, z_indices_quantised):
+        z_indices_quantised = self.to_sequence(z_indices_quantised, self.index_dim)
+
+        if self.embedding_cache is not None and not self.training:
+            z_embeddings = self.embedding_cache(z_indices_quantised, self.lookup_embeddings)
+        else:
+            z_embeddings = self.lookup_embeddings(z_indices_quantised / (self.num_levels - 1))
+
+        return self.decode_embeddings(z_embeddings)
+
+    def sample_prior(self, num_samples=1, temperature=1.0, top_k=None):
+        if self.prior_sampler is not None:
+            return self.prior_sampler.sample(num_samples, temperature, top_k)
+        # Priors that sample themselves (Normal) have no logits to reshape
+        if temperature != 1.0 or top_k is not None:
+            raise ValueError(f'temperature and top_k only apply to autoregressive priors, not {type(self.prior).__name__}')
+        return self.prior.sample(num_samples)
+
+    def prior_logits(self, z_indices_quantised, pixel, windowed=True):
+        # (B, num_levels, index_dim) logits for one pixel given the grid filled in up to it, windowed=False always
+        # evaluates the prior on the full grid
+        if self.prior_sampler is not None:
+            return self.prior_sampler.logits_at(z_indices_quantised, pixel, windowed)
+        h, w = pixel
+        return self.prior(z_indices_quantised)[:, :, :, h, w]
+
+    @torch.no_grad()
+    def sample_iter(self, num_samples=1, batch_size=None, temperature=1.0, top_k=None):
+        # Latents for every sample are drawn in one batched prior call, decoding is chunked to bound memory
+        batch_size = batch_size or num_samples
+        z_indices_quantised = self.sample_prior(num_samples, temperature, top_k).type(torch.int64)
+
+        for start in range(0, num_samples, batch_size):
+            yield self.decode(z_indices_quantised[start:start + batch_size])
+
+    def sample(self, num_samples=1, batch_size=None, stream=False, temperature=1.0, top_k=None):
+        samples = self.sample_iter(num_samples, batch_size, temperature, top_k)
+        if stream:
+            return samples
+        return torch.cat(list(samples), dim=0)
+
+    @torch.no_grad()
+    def interpolate_iter(self, x, y, steps=1, batch_size=None):
+        if x.size() != y.size():
+            raise ValueError(f'Can only interpolate between batches of the same size, got {tuple(x.size())} and {tuple(y.size())}')
+
+        # Both end points go through the encoder in a single pass
+        xy = torch.cat([x, y], dim=0)
+        if self.channels_last:
+            xy = xy.contiguous(memory_format=torch.channels_last)
+
+        with self.autocast():
+            z = self.encoder(xy)
+            z = self.pre_vq_conv(z)
+        zx, zy = z.float().chunk(2, dim=0)
+
+        # Interior points of the line only, so steps=1 is the midpoint
+        weights = torch.linspace(0, 1, steps + 2, device=z.device)[1:-1]
+
+        # Rows are ordered step major, (steps * batch) in total, and are only materialised a chunk at a time
+        num_pairs = x.size(0)
+        num_rows = steps * num_pairs
+        batch_size = batch_size or num_rows
+
+        for start in range(0, num_rows, batch_size):
+            rows = torch.arange(start, min(start + batch_size, num_rows), device=z.device)
+            pairs = rows % num_pairs
+            z = torch.lerp(zx[pairs], zy[pairs], weights[rows // num_pairs].view(-1, 1, 1, 1))
+
+            z_indices_quantised = self.quantise(self.retrieve(z))
+
+            z_indices_quantised = self.to_grid(z_indices_quantised, self.index_dim).contiguous()
+
+            yield self.decode(self.prior.reconstruct(z_indices_quantised))
+
+    def interpolate(self, x, y, steps=1, batch_size=None, stream=False):
+        interpolations = self.interpolate_iter(x, y, steps, batch_size)
+        if stream:
+            return interpolations
+        return torch.cat(list(interpolations), dim=0)
 
-        z_indices = z_indices.permute(0, 2, 3, 1).contiguous()
-        z_indices = z_indices.view(-1, self.representation_dim * self.representation_dim, self.index_dim)
+    def reconstruct(self, x):
+        return self.forward(x)
 
-        z_embeddings = self.index_to_embedding(z_indices)
+    def retrieve(self, z):
+        with self.autocast():
+            z = self.to_sequence(z, self.embedding_dim)
 
-        z_embeddings = z_embeddings.view(-1, self.representation_dim, self.representation_dim, self.embedding_dim)
-        z_embeddings = z_embeddings.permute(0, 3, 1, 2).contiguous()
+            z_embeddings = self.lookup("hopfield", z)
 
-        x_sample = self.decoder(z_embeddings)
+        return z_embeddings.float()
 
-        return x_sample
+    def embed(self, x):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
 
-    def interpolate(self, x, y):
-        if (x.size() == y.size()):
-            zx = self.encoder(x)
-            zx = self.pre_vq_conv(zx)
+        with self.autocast():
+            z = self.encoder(x)
+            z = self.pre_vq_conv(z)
 
-            zy = self.encoder(y)
-            zy = self.pre_vq_conv(zy)
+        return self.retrieve(z)
 
-            z = (zx + zy) / 2
+    def quantise(self, z_embeddings):
+        # Rounding is done in fp32 so mixed precision never moves a value to a different level
+        with self.autocast(False):
+            z_indices = self.lookup("embedding_to_index", z_embeddings.float())
 
-            z = z.permute(0, 2, 3, 1).contiguous()
-            z = z.view(-1, self.representation_dim * self.representation_dim, self.embedding_dim)
+        with self.stage("quantise"):
+            #z_indices = F.relu(z_indices)#self.post_vq_conv(z_indices))
+            #z_indices = 1 - F.relu(1 - z_indices)
+            z_indices = torch.sigmoid(z_indices)#self.post_vq_conv(z_indices))
 
-            z_embeddings = self.hopfield(z)
-            z_indices = self.embedding_to_index(z_embeddings)
+            return straight_through_round(z_indices * (self.num_levels - 1))
 
-            #z_indices = z_indices.view(-1, self.representation_dim, self.representation_dim, self.index_dim)
-            #z_indices = z_indices.permute(0, 3, 1, 2).contiguous()
+    @torch.no_grad()
+    def encode(self, x):
+        z_indices_quantised = self.quantise(self.embed(x))
 
-            z_indices = F.relu(z_indices)#self.post_vq_conv(z_indices))
-            z_indices = 1 - F.relu(1 - z_indices)
-            #z_indices = F.sigmoid(self.post_vq_conv(z_indices))
-            z_indices_quantised = straight_through_round(z_indices * (self.num_levels - 1))
+        return self.to_grid(z_indices_quantised, self.index_dim).contiguous()
 
-            z_indices_quantised = z_indices_quantised.view(-1, self.representation_dim, self.representation_dim, self.index_dim)
-            z_indices_quantised = z_indices_quantised.permute(0, 3, 1, 2).contiguous()
+    def encode_packed(self, x):
+        # Bit packed codes with a header, see utils.codes
+        return codes_to_bytes(self.encode(x).cpu().numpy(), self.num_levels)
 
-            z_indices = self.prior.reconstruct(z_indices_quantised) / (self.num_levels - 1)
+    def unpack(self, data):
+        codes, header = codes_from_bytes(data)
+        if (header["index_dim"], header["representation_dim"], header["num_levels"]) != (self.index_dim, self.representation_dim, self.num_levels):
+            raise ValueError(f'Codes were produced with index_dim={header["index_dim"]}, representation_dim={header["representation_dim"]} '
+                             f'and num_levels={header["num_levels"]}, which this model does not match')
 
-            z_indices = z_indices.permute(0, 2, 3, 1).contiguous()
-            z_indices = z_indices.view(-1, self.representation_dim * self.representation_dim, self.index_dim)
+        return torch.from_numpy(codes).to(self.device)
 
-            z_embeddings = self.index_to_embedding(z_indices)
+    @torch.no_grad()
+    def decode_packed(self, data):
+        return self.decode(self.unpack(data))
 
-            z_embeddings = z_embeddings.view(-1, self.representation_dim, self.representation_dim, self.embedding_dim)
-            z_embeddings = z_embeddings.permute(0, 3, 1, 2).contiguous()
+    def encode_tiled(self, x, overlap=None, batch_size=64):
+        # Images of any size as overlapping tiles at the training resolution, see utils.tiling
+        return tiling.encode_tiled(self, x, self.tile_overlap if overlap is None else overlap, batch_size)
 
-            xy_inter = self.decoder(z_embeddings)
+    def decode_tiled(self, z_indices_quantised, height, width, overlap=None, batch_size=64):
+        return tiling.decode_tiled(self, z_indices_quantised, height, width, self.tile_overlap if overlap is None else overlap, batch_size)
 
-            return xy_inter.detach()
+    def reconstruct_tiled(self, x, overlap=None, batch_size=64):
+        return tiling.reconstruct_tiled(self, x, self.tile_overlap if overlap is None else overlap, batch_size)
 
-        return x
+    def compress(self, x):
+        # Entropy coded with the prior's predicted distributions, see utils.entropy_codec
+        return entropy_codec.compress(self, x)
 
-    def reconstruct(self, x):
-        return self.forward(x)
+    def decompress(self, data):
+        return entropy_codec.decompress(self, data)
 
     def forward(self, x):
-        z = self.encoder(x)
-        z = self.pre_vq_conv(z)
-
-        z = z.permute(0, 2, 3, 1).contiguous()
-        z = z.view(-1, self.representation_dim * self.representation_dim, self.embedding_dim)
+        z_embeddings = self.embed(x)
 
-        z_embeddings = self.hopfield(z)
-
-        z_indices = self.embedding_to_index(z_embeddings)
-
-        #z_indices = z_indices.view(-1, self.representation_dim, self.representation_dim, self.index_dim)
-        #z_indices = z_indices.permute(0, 3, 1, 2).contiguous()
-
-        #z_indices = F.relu(z_indices)#self.post_vq_conv(z_indices))
-        #z_indices = 1 - F.relu(1 - z_indices)
-        z_indices = torch.sigmoid(z_indices)#self.post_vq_conv(z_indices))
-
-        z_indices_quantised = straight_through_round(z_indices * (self.num_levels - 1))
+        z_indices_quantised = self.quantise(z_embeddings)
         z_indices = z_indices_quantised / (self.num_levels - 1)
 
         #z_indices = z_indices.permute(0, 2, 3, 1).contiguous()
         #z_indices = z_indices.view(-1, self.representation_dim * self.representation_dim, self.index_dim)
-        z_embeddings_recon = self.index_to_embedding(z_indices)
+        z_embeddings_recon = self.lookup_embeddings(z_indices)
         embedding_recon_loss = F.mse_loss(z_embeddings_recon, z_embeddings)
 
-        z_embeddings = z_embeddings.view(-1, self.representation_dim, self.representation_dim, self.embedding_dim)
-        z_embeddings = z_embeddings.permute(0, 3, 1, 2).contiguous()
-
         if self.fit_prior:
             #start by assuming that num_categories and num_levels are the same 
-            z_indices_quantised = z_indices_quantised.view(-1, self.representation_dim, self.representation_dim, self.index_dim)
-            z_indices_quantised = z_indices_quantised.permute(0, 3, 1, 2).contiguous()
+            z_indices_quantised = self.to_grid(z_indices_quantised, self.index_dim).contiguous()
 
             z_pred = self.prior(z_indices_quantised.detach())
+            z_prediction_error = prior_prediction_error(z_pred.float(), z_indices_quantised.detach())
 
-            z_cross_entropy = F.cross_entropy(z_pred, z_indices_quantised.long().detach(), reduction='none')
-            z_prediction_error = z_cross_entropy.mean(dim=[1,2,3]) * np.log2(np.exp(1))
-            z_prediction_error = z_prediction_error.mean()            
-
-            x_recon = self.decoder(z_embeddings)
+            x_recon = self.decode_embeddings(z_embeddings)
             return x_recon, z_prediction_error + embedding_recon_loss
 
 
-        x_recon = self.decoder(z_embeddings)
+        x_recon = self.decode_embeddings(z_embeddings)
 
         return x_recon, embedding_recon_loss#torch.zeros(1, requires_grad=True).to(self.device)
\ No newline at end of file
@@ -0,0 +1,90 @@
+"""Compares NCHW and channels_last execution of HopVAE.forward.
+
+    python -m benchmarks.channels_last --config ffhq_64 --batch-size 32
+
+Checks that both layouts give the same reconstructions from the same weights, exiting non-zero if
+they differ by more than --atol/--rtol, and reports the forward time together with the activation
+bytes the NCHW <-> sequence layout bridges (to_sequence and to_grid) copy, measured over one forward.
+"""
+import argparse
+import sys
+
+import numpy as np
+import torch
+
+from HopVAE import HopVAE
+from benchmarks.common import time_op
+from utils import get_config
+
+
+def build(name, channels_last, state_dict=None):
+    config = get_config(name)
+    config.channels_last = channels_last
+    torch.manual_seed(config.seed)
+    model = HopVAE(config, torch.device("cpu"))
+    if state_dict is not None:
+        model.load_state_dict(state_dict)
+    return model.eval(), config
+
+
+def count_bridge_copies(model, x):
+    # Wraps the instance's bridges for one forward, an output not sharing its input's storage was a copy
+    copies = {"count": 0, "bytes": 0}
+
+    def counted(bridge):
+        def wrapper(z, channels):
+            out = bridge(z, channels)
+            if out.untyped_storage().data_ptr() != z.untyped_storage().data_ptr():
+                copies["count"] += 1
+                copies["bytes"] += out.nbytes
+            return out
+        return wrapper
+
+    model.to_sequence, model.to_grid = counted(model.to_sequence), counted(model.to_grid)
+    try:
+        with torch.no_grad():
+            model(x)
+    finally:
+        del model.to_sequence, model.to_grid
+    return copies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="ffhq_64")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--atol", type=float, default=1e-5)
+    parser.add_argument("--rtol", type=float, default=1e-4)
+    args = parser.parse_args()
+
+    nchw_model, config = build(args.config, False)
+    channels_last_model, _ = build(args.config, True, nchw_model.state_dict())
+
+    x = torch.randn(args.batch_size, config.num_channels, config.image_size, config.image_size)
+
+    with torch.no_grad():
+        nchw_recon, _ = nchw_model(x)
+        channels_last_recon, _ = channels_last_model(x)
+    max_difference = (nchw_recon - channels_last_recon).abs().max().item()
+    identical_codes = torch.equal(nchw_model.encode(x), channels_last_model.encode(x))
+
+    for name, model in (("nchw", nchw_model), ("channels_last", channels_last_model)):
+        copies = count_bridge_copies(model, x)
+        with torch.no_grad():
+            latencies = time_op(lambda: model(x), args.repeats, args.warmup)
+        print(f'{name:14} forward p50={np.percentile(latencies, 50) * 1000:8.2f} ms  '
+              f'{args.batch_size / latencies.mean():8.1f} images/s  '
+              f'bridge copies={copies["count"]} ({copies["bytes"] / 2**20:6.2f} MiB)')
+
+    print(f'max |nchw - channels_last| = {max_difference:.3e}, identical codes: {identical_codes}')
+    try:
+        torch.testing.assert_close(channels_last_recon, nchw_recon, atol=args.atol, rtol=args.rtol)
+    except AssertionError as error:
+        print(f'channels_last does not match NCHW at atol={args.atol}, rtol={args.rtol}:\n{error}')
+        sys.exit(1)
+    print(f'channels_last matches NCHW at atol={args.atol}, rtol={args.rtol}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Real compressed size and throughput of HopVAE.compress / decompress against the prior's estimate.
+
+    python -m benchmarks.codec --config mnist_28 --ckpt checkpoints/MNIST-28.ckpt --data <mnist root> --batches 10
+
+Without --data the images are synthetic, which still measures throughput but not meaningful rates.
+"""
+import argparse
+import time
+
+import torch
+
+from HopVAE import HopVAE
+from utils import get_config, get_data_loaders, load_from_checkpoint
+from utils.entropy_codec import decompress_codes, estimated_bits_per_code
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="mnist_28")
+    parser.add_argument("--ckpt", type=str)
+    parser.add_argument("--data", type=str)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--batches", type=int, default=5)
+    args = parser.parse_args()
+
+    config = get_config(args.config)
+    config.batch_size = args.batch_size
+    device = torch.device("cpu")
+
+    model = HopVAE(config, device).to(device)
+    if args.ckpt:
+        model = load_from_checkpoint(model, args.ckpt)
+    model.eval()
+
+    if args.data:
+        _, _, test_loader, _ = get_data_loaders(config, args.data)
+        batches = (X for X, _ in test_loader)
+    else:
+        shape = (args.batch_size, config.num_channels, config.image_size, config.image_size)
+        batches = (torch.randn(shape) for _ in range(args.batches))
+
+    num_images = num_bytes = estimated_bits = 0
+    compress_time = decompress_time = 0.0
+    for i, X in enumerate(batches):
+        if i == args.batches:
+            break
+        X = X.to(device)
+
+        start = time.perf_counter()
+        data = model.compress(X)
+        compress_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        z_indices_quantised = decompress_codes(model, data)
+        decompress_time += time.perf_counter() - start
+
+        if not torch.equal(z_indices_quantised, model.encode(X)):
+            raise RuntimeError('Decompressed codes do not match the encoded codes')
+
+        num_images += X.size(0)
+        num_bytes += len(data)
+        estimated_bits += estimated_bits_per_code(model, z_indices_quantised) * X.size(0)
+
+    codes_per_image = config.index_dim * config.representation_dim ** 2
+    dims_per_image = config.num_channels * config.image_size ** 2
+    bits_per_image = num_bytes * 8 / num_images
+
+    print(f'images                  {num_images}')
+    print(f'bits per code           {bits_per_image / codes_per_image:8.4f} (prior estimate {estimated_bits / num_images:8.4f})')
+    print(f'bits per dimension      {bits_per_image / dims_per_image:8.4f}')
+    print(f'bytes per image         {bits_per_image / 8:8.1f}')
+    print(f'compress                {num_images / compress_time:8.1f} images/s')
+    print(f'decompress              {num_images / decompress_time:8.1f} images/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,16 @@
+import time
+
+import numpy as np
+
+
+def time_op(op, repeats=1, warmup=0):
+    # Wall clock seconds of each of repeats calls to op, after warmup untimed calls
+    for _ in range(warmup):
+        op()
+
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        op()
+        latencies.append(time.perf_counter() - start)
+    return np.array(latencies)
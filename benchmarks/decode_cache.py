@@ -0,0 +1,72 @@
+"""Decode throughput with and without the decode and embedding caches on repeated code grids.
+
+    python -m benchmarks.decode_cache --config ffhq_64 --pool 256 --requests 4096 --zipf 1.1
+
+Requests draw code grids from a pool of distinct grids with Zipf distributed popularity, so a few grids
+are decoded over and over as in serving traffic, and are decoded in batches of --batch-size. The interpolate
+row decodes the same pair of images at many steps, where neighbouring steps often share their codes.
+Each setting starts from empty caches, the hit rates include the cold start.
+"""
+import argparse
+
+import numpy as np
+import torch
+
+from HopVAE import HopVAE
+from benchmarks.common import time_op
+from utils import get_config, load_from_checkpoint
+
+SETTINGS = {
+    "none": (0, 0),
+    "embedding": (0, 1),
+    "decode": (1, 0),
+    "both": (1, 1)
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="ffhq_64")
+    parser.add_argument("--ckpt", type=str)
+    parser.add_argument("--pool", type=int, default=256, help="distinct code grids requests are drawn from")
+    parser.add_argument("--requests", type=int, default=4096)
+    parser.add_argument("--zipf", type=float, default=1.1)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--decode-cache-mb", type=float, default=64)
+    parser.add_argument("--embedding-cache-entries", type=int, default=65536)
+    parser.add_argument("--steps", type=int, default=64, help="interpolation steps")
+    args = parser.parse_args()
+
+    config = get_config(args.config)
+    torch.manual_seed(config.seed)
+    model = HopVAE(config, torch.device("cpu"))
+    if args.ckpt:
+        model = load_from_checkpoint(model, args.ckpt)
+    model.eval()
+
+    with torch.no_grad():
+        pool = model.encode(torch.rand(args.pool, config.num_channels, config.image_size, config.image_size))
+    rng = np.random.default_rng(config.seed)
+    requests = pool[torch.from_numpy((rng.zipf(args.zipf, args.requests) - 1) % args.pool)]
+    x, y = torch.rand(2, 1, config.num_channels, config.image_size, config.image_size)
+
+    print(f'{"cache":10} {"decode img/s":>13} {"hit rate":>9} {"interp img/s":>13} {"hit rate":>9} {"emb hit rate":>13}')
+    with torch.no_grad():
+        for name, (decode, embedding) in SETTINGS.items():
+            model.enable_decode_cache(int(decode * args.decode_cache_mb * 2**20), embedding * args.embedding_cache_entries)
+            decode_time, = time_op(lambda: [model.decode(requests[i:i + args.batch_size]) for i in range(0, args.requests, args.batch_size)])
+            decode_hits = model.decode_cache.stats()["hit_rate"] if model.decode_cache else 0.0
+
+            model.enable_decode_cache(int(decode * args.decode_cache_mb * 2**20), embedding * args.embedding_cache_entries)
+            interpolate_time, = time_op(lambda: [model.interpolate(x, y, args.steps, batch_size=args.batch_size) for _ in range(4)])
+            interpolate_hits = model.decode_cache.stats()["hit_rate"] if model.decode_cache else 0.0
+            embedding_hits = model.embedding_cache.stats()["hit_rate"] if model.embedding_cache else 0.0
+
+            print(f'{name:10} {args.requests / decode_time:13.1f} {decode_hits:9.3f} '
+                  f'{4 * args.steps / interpolate_time:13.1f} {interpolate_hits:9.3f} {embedding_hits:13.3f}')
+
+    model.release_decode_cache()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Encode/decode throughput of the eager model against its TorchScript and ONNX Runtime exports.
+
+    python -m benchmarks.export --config ffhq_64 --batch-size 32
+
+The model is built from the config with random weights unless --ckpt is given, and exported to a
+temporary directory with utils.export.export_model, which also checks parity.
+"""
+import argparse
+import tempfile
+
+import numpy as np
+import torch
+
+from HopVAE import HopVAE
+from benchmarks.common import time_op
+from utils import get_config, load_from_checkpoint
+from utils.export import export_model, onnx_runner
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="ffhq_64")
+    parser.add_argument("--ckpt", type=str)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--top-k", type=int)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=3)
+    args = parser.parse_args()
+
+    config = get_config(args.config)
+    torch.manual_seed(config.seed)
+    model = HopVAE(config, torch.device("cpu"))
+    if args.ckpt:
+        model = load_from_checkpoint(model, args.ckpt)
+    model.eval()
+
+    x = torch.randn(args.batch_size, config.num_channels, config.image_size, config.image_size)
+    with torch.no_grad():
+        z_indices_quantised = model.encode(x).long()
+
+    with tempfile.TemporaryDirectory() as directory:
+        report = export_model(model, config, directory, top_k=args.top_k)
+
+        runners = {"eager": (model.encode, model.decode)}
+        if args.top_k is not None:
+            model.compile_lookups(args.top_k)
+            runners["eager fused"] = (model.encode, model.decode)
+        runners["torchscript"] = (torch.jit.load(report["torchscript"]["encoder"]), torch.jit.load(report["torchscript"]["decoder"]))
+        if onnx_runner(report["onnx"]["encoder"]) is not None:
+            runners["onnxruntime"] = (onnx_runner(report["onnx"]["encoder"]), onnx_runner(report["onnx"]["decoder"]))
+
+        print(f'{"runtime":12} {"encode img/s":>14} {"decode img/s":>14}')
+        for name, (encode, decode) in runners.items():
+            with torch.no_grad():
+                encode_latencies = time_op(lambda: encode(x), args.repeats, args.warmup)
+                decode_latencies = time_op(lambda: decode(z_indices_quantised), args.repeats, args.warmup)
+            print(f'{name:12} {args.batch_size / np.median(encode_latencies):14.1f} {args.batch_size / np.median(decode_latencies):14.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""Encode/decode latency with the eager HopfieldLayers against the fused inference lookups.
+
+    python -m benchmarks.hopfield_lookup --config ffhq_64 --batch-size 32 --top-k 32
+"""
+import argparse
+
+import numpy as np
+import torch
+
+from HopVAE import HopVAE
+from benchmarks.common import time_op
+from utils import get_config
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="ffhq_64")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--top-k", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=3)
+    args = parser.parse_args()
+
+    config = get_config(args.config)
+    torch.manual_seed(config.seed)
+    model = HopVAE(config, torch.device("cpu")).eval()
+
+    x = torch.randn(args.batch_size, config.num_channels, config.image_size, config.image_size)
+
+    with torch.no_grad():
+        reference_codes = model.encode(x)
+        reference_recon = model.decode(reference_codes)
+
+        for name, top_k in (("eager", None), ("fused", None), (f"fused top-{args.top_k}", args.top_k)):
+            if name == "eager":
+                model.release_lookups()
+            else:
+                model.compile_lookups(top_k=top_k)
+
+            codes = model.encode(x)
+            recon = model.decode(reference_codes)
+            code_agreement = (codes == reference_codes).float().mean().item()
+            max_difference = (recon - reference_recon).abs().max().item()
+
+            encode = time_op(lambda: model.encode(x), args.repeats, args.warmup)
+            decode = time_op(lambda: model.decode(reference_codes), args.repeats, args.warmup)
+            print(f'{name:14} encode p50={np.percentile(encode, 50) * 1000:8.2f} ms  '
+                  f'decode p50={np.percentile(decode, 50) * 1000:8.2f} ms  '
+                  f'code agreement={code_agreement:.4f}  max decode difference={max_difference:.2e}  '
+                  f'fused={sorted(model.fused_lookups)}')
+
+
+if __name__ == '__main__':
+    main()
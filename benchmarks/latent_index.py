@@ -0,0 +1,98 @@
+"""Queries per second and recall of exact and IVF search in the latent similarity index.
+
+    python -m benchmarks.latent_index --config ffhq_64 --ckpt outputs/FFHQ-64-epoch40.ckpt --data <ffhq root>
+    python -m benchmarks.latent_index --config ffhq_64 --synthetic 70000
+
+With --data the index is built by encoding the train set (reporting images/s) and queried with test images.
+Without it --synthetic keys are drawn around random cluster centres, which measures search at FFHQ scale
+without running the model. Recall@k of each nprobe is measured against the exact search.
+"""
+import argparse
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from HopVAE import HopVAE
+from benchmarks.common import time_op
+from utils import get_config, get_data_loaders, load_from_checkpoint
+from utils.latent_index import LatentIndex, build_index, embedding_keys, index_path, normalise, recall
+
+
+def synthetic_keys(directory, kind, num_keys, dim, num_queries, seed):
+    # Keys scattered around a few thousand centres, queries are noisy copies of keys so every query has near duplicates
+    rng = np.random.default_rng(seed)
+    centres = normalise(rng.standard_normal((max(1, num_keys // 20), dim)))
+    keys = np.lib.format.open_memmap(index_path(directory, kind), mode='w+', dtype=np.float32, shape=(num_keys, dim))
+    for start in range(0, num_keys, 65536):
+        count = min(65536, num_keys - start)
+        keys[start:start + count] = normalise(centres[rng.integers(len(centres), size=count)] + 0.3 * rng.standard_normal((count, dim)) / np.sqrt(dim))
+    keys.flush()
+
+    queries = np.asarray(keys[rng.choice(num_keys, num_queries, replace=False)])
+    return normalise(queries + 0.05 * rng.standard_normal(queries.shape) / np.sqrt(dim))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="ffhq_64")
+    parser.add_argument("--ckpt", type=str)
+    parser.add_argument("--data", type=str)
+    parser.add_argument("--kind", default="pooled", choices=["pooled", "grid"])
+    parser.add_argument("--synthetic", type=int, default=70000, help="number of synthetic keys without --data")
+    parser.add_argument("--queries", type=int, default=256)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--ivf-lists", type=int)
+    parser.add_argument("--nprobes", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    config = get_config(args.config)
+    torch.manual_seed(config.seed)
+    directory = tempfile.mkdtemp(prefix="latent-index-")
+
+    if args.data:
+        model = HopVAE(config, torch.device("cpu"))
+        if args.ckpt:
+            model = load_from_checkpoint(model, args.ckpt)
+        model.eval()
+
+        train_loader, _, test_loader, _ = get_data_loaders(config, args.data)
+        start = time.perf_counter()
+        build_index(model, (x for x, _ in train_loader), len(train_loader.dataset), directory, kinds=(args.kind,))
+        elapsed = time.perf_counter() - start
+        print(f'built index of {len(train_loader.dataset)} images in {elapsed:.1f} s ({len(train_loader.dataset) / elapsed:.1f} img/s)')
+
+        queries = []
+        for x, _ in test_loader:
+            queries.append(embedding_keys(model, x, kinds=(args.kind,))[args.kind])
+            if sum(len(q) for q in queries) >= args.queries:
+                break
+        queries = np.concatenate(queries)[:args.queries]
+    else:
+        num_positions = config.representation_dim * config.representation_dim
+        dim = config.embedding_dim * (num_positions if args.kind == "grid" else 1)
+        queries = synthetic_keys(directory, args.kind, args.synthetic, dim, args.queries, config.seed)
+
+    latent_index = LatentIndex(directory, args.kind)
+    print(f'{len(latent_index)} keys of dimension {latent_index.vectors.shape[1]}, {len(queries)} queries, k={args.k}')
+
+    start = time.perf_counter()
+    latent_index.train_ivf(args.ivf_lists)
+    print(f'trained {len(latent_index.centroids)} IVF lists in {time.perf_counter() - start:.1f} s')
+
+    print()
+    print(f'{"search":12} {"queries/s":>12} {"recall@k":>10}')
+    _, exact = latent_index.search(queries, args.k)
+    elapsed = time_op(lambda: latent_index.search(queries, args.k), args.repeats).mean()
+    print(f'{"exact":12} {len(queries) / elapsed:12.1f} {1.0:10.3f}')
+
+    for nprobe in args.nprobes:
+        _, approximate = latent_index.search(queries, args.k, nprobe=nprobe)
+        elapsed = time_op(lambda: latent_index.search(queries, args.k, nprobe=nprobe), args.repeats).mean()
+        print(f'{f"ivf {nprobe}":12} {len(queries) / elapsed:12.1f} {recall(exact, approximate):10.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Images/sec of the input pipeline alone, without the model.
+
+    python -m benchmarks.loaders --data <torchvision root> --ffhq <image folder> \
+        --configs mnist_28 ffhq_32 ffhq_64 --num-workers 0 4 8
+"""
+import argparse
+import json
+import time
+
+from utils import get_config, get_data_loaders
+
+
+def benchmark_loader(loader, num_batches, warmup=2):
+    iterator = iter(loader)
+    for _ in range(warmup):
+        next(iterator)
+
+    num_images = 0
+    start = time.perf_counter()
+    for _ in range(num_batches):
+        try:
+            X, _ = next(iterator)
+        except StopIteration:
+            break
+        num_images += X.size(0)
+
+    return num_images / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data", type=str, help="root for the torchvision data sets")
+    parser.add_argument("--ffhq", type=str, help="image folder for the FFHQ configs")
+    parser.add_argument("--configs", nargs="+", default=["mnist_28", "ffhq_32", "ffhq_64"])
+    parser.add_argument("--num-workers", nargs="+", type=int, default=[0, 4])
+    parser.add_argument("--batches", type=int, default=50)
+    parser.add_argument("--output", type=str, help="optional JSON file for the results")
+    args = parser.parse_args()
+
+    results = []
+    for name in args.configs:
+        for num_workers in args.num_workers:
+            for batch_transforms in (False, True):
+                for cache_images in (False, True):
+                    config = get_config(name)
+                    config.num_workers = num_workers
+                    config.batch_transforms = batch_transforms
+                    config.cache_images = cache_images
+
+                    PATH = args.ffhq if config.data_set == "FFHQ" else args.data
+                    train_loader, _, _, _ = get_data_loaders(config, PATH)
+
+                    images_per_sec = benchmark_loader(train_loader, args.batches)
+                    result = {
+                        "config": name,
+                        "num_workers": num_workers,
+                        "batch_transforms": batch_transforms,
+                        "cache_images": cache_images,
+                        "images_per_sec": images_per_sec
+                    }
+                    results.append(result)
+                    print(f'{name:10} workers={num_workers:<3} batch_transforms={batch_transforms!s:5} '
+                          f'cache_images={cache_images!s:5} {images_per_sec:10.1f} images/s')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""Training memory against step time with activation checkpointing and gradient accumulation.
+
+    python -m benchmarks.memory --config ffhq_64 --batch-sizes 16 32 --accumulation-steps 1 4
+
+Each setting runs in a fresh process. It reports the activations autograd keeps for backward, counted
+through saved tensor hooks, the process peak RSS (peak CUDA allocation on GPU) and the time per
+optimiser step. An accumulation run covers batch size * steps images per step with micro-batches of
+batch size, so compare it with the plain run at the full effective batch size. A setting whose process
+dies (e.g. killed for running out of memory) or outlives --timeout is reported as failed and the run moves on.
+"""
+import argparse
+import multiprocessing
+import resource
+import time
+from queue import Empty
+
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+
+from HopVAE import HopVAE
+from utils import get_config
+
+SETTINGS = {
+    "none": (False, False),
+    "residual": (True, False),
+    "hopfield": (False, True),
+    "both": (True, True)
+}
+
+
+def saved_activation_bytes(model, x):
+    # Bytes autograd holds on to between the forward and backward of one micro-batch, each storage counted once
+    storages = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        x_recon, z_prediction_error = model(x)
+    (F.mse_loss(x_recon, x) + z_prediction_error).backward()
+    model.zero_grad(set_to_none=True)
+
+    # Parameters are saved by reference and are not activations
+    parameters = {param.untyped_storage().data_ptr() for param in model.parameters()}
+    return sum(nbytes for ptr, nbytes in storages.items() if ptr not in parameters)
+
+
+def run(config_name, setting, batch_size, accumulation_steps, steps, device, queue):
+    config = get_config(config_name)
+    config.checkpoint_residual, config.checkpoint_hopfield = SETTINGS[setting]
+    device = torch.device(device)
+    torch.manual_seed(config.seed)
+
+    model = HopVAE(config, device).to(device).train()
+    optimiser = optim.Adam(model.parameters(), lr=config.learning_rate)
+    x = torch.randn(batch_size, config.num_channels, config.image_size, config.image_size, device=device)
+
+    saved = saved_activation_bytes(model, x)
+
+    def step():
+        optimiser.zero_grad()
+        for _ in range(accumulation_steps):
+            x_recon, z_prediction_error = model(x)
+            ((F.mse_loss(x_recon, x) + z_prediction_error) / accumulation_steps).backward()
+        optimiser.step()
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+
+    step()
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    step_time = (time.perf_counter() - start) / steps
+
+    if device.type == "cuda":
+        peak = torch.cuda.max_memory_allocated(device) / 2**20
+    else:
+        # ru_maxrss is in KiB on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+    queue.put((saved / 2**20, peak, step_time))
+
+
+def wait_for_result(process, queue, timeout):
+    # The child's result, or None once it has exited without one or timeout seconds have passed
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            if not process.is_alive():
+                # A result put right before exiting may still be in the pipe
+                try:
+                    return queue.get(timeout=1)
+                except Empty:
+                    return None
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="ffhq_64")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[16, 32])
+    parser.add_argument("--accumulation-steps", type=int, nargs="+", default=[1])
+    parser.add_argument("--settings", nargs="+", default=list(SETTINGS), choices=list(SETTINGS))
+    parser.add_argument("--steps", type=int, default=3)
+    parser.add_argument("--cuda", action="store_true")
+    parser.add_argument("--timeout", type=float, default=3600, help="seconds a single setting may run")
+    args = parser.parse_args()
+
+    device = "cuda" if args.cuda and torch.cuda.is_available() else "cpu"
+    context = multiprocessing.get_context("spawn")
+
+    print(f'{"checkpoint":10} {"batch":>6} {"accum":>6} {"effective":>10} {"saved MB":>10} {"peak MB":>10} {"step s":>8} {"img/s":>8}')
+    for batch_size in args.batch_sizes:
+        for accumulation_steps in args.accumulation_steps:
+            for setting in args.settings:
+                queue = context.Queue()
+                process = context.Process(target=run, args=(args.config, setting, batch_size, accumulation_steps, args.steps, device, queue))
+                process.start()
+                result = wait_for_result(process, queue, args.timeout)
+                timed_out = result is None and process.is_alive()
+                if timed_out:
+                    process.terminate()
+                process.join()
+
+                effective = batch_size * accumulation_steps
+                if result is None:
+                    reason = f'timed out after {args.timeout:g} s' if timed_out else f'exit code {process.exitcode}'
+                    print(f'{setting:10} {batch_size:6} {accumulation_steps:6} {effective:10} failed, {reason}')
+                    continue
+
+                saved, peak, step_time = result
+                print(f'{setting:10} {batch_size:6} {accumulation_steps:6} {effective:10} {saved:10.1f} {peak:10.1f} '
+                      f'{step_time:8.3f} {effective / step_time:8.1f}')
+
+
+if __name__ == '__main__':
+    main()
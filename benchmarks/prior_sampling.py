@@ -0,0 +1,43 @@
+"""Windowed PriorSampler against the naive full grid loop for sampling latent grids from the PixelCNN prior.
+
+    python -m benchmarks.prior_sampling --config pixelcnn_mnist_28 --num-samples 64
+"""
+import argparse
+import time
+
+import torch
+
+from HopVAE import HopVAE
+from utils import get_config
+from utils.prior_sampling import PriorSampler
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="pixelcnn_mnist_28")
+    parser.add_argument("--num-samples", type=int, default=64)
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--top-k", type=int)
+    args = parser.parse_args()
+
+    config = get_config(args.config)
+    if config.prior != "PixelCNN":
+        raise SystemExit(f'{args.config} does not use an autoregressive prior')
+
+    model = HopVAE(config, torch.device("cpu")).eval()
+
+    for name, windowed in (("naive", False), ("windowed", True)):
+        sampler = PriorSampler(model.prior, config, windowed=windowed)
+        if windowed:
+            sampler.probe()
+
+        start = time.perf_counter()
+        sampler.sample(args.num_samples, args.temperature, args.top_k)
+        elapsed = time.perf_counter() - start
+
+        details = f'field={sampler.field} channels coupled={sampler.channels_coupled}' if windowed else ''
+        print(f'{name:9} {elapsed:8.2f} s  {args.num_samples / elapsed:8.2f} grids/s  {details}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Throughput and fidelity of the int8 post training quantised HopVAE against fp32 on CPU.
+
+    python -m benchmarks.quantisation --config mnist_28 --ckpt checkpoints/MNIST-28.ckpt --data <mnist root>
+
+Calibration uses config.calibration_batches batches of the train loader and the comparison the test loader.
+Without --data both use synthetic images, which still measures throughput but not meaningful errors.
+"""
+import argparse
+import time
+import warnings
+
+import numpy as np
+import torch
+
+from HopVAE import HopVAE
+from benchmarks.common import time_op
+from utils import get_config, get_data_loaders, load_from_checkpoint
+from utils.quantisation import calibration_batches, compare, quantise_model
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="mnist_28")
+    parser.add_argument("--ckpt", type=str)
+    parser.add_argument("--data", type=str)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--batches", type=int, default=10)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2)
+    args = parser.parse_args()
+
+    config = get_config(args.config)
+    config.batch_size = args.batch_size
+    torch.manual_seed(config.seed)
+
+    model = HopVAE(config, torch.device("cpu"))
+    if args.ckpt:
+        model = load_from_checkpoint(model, args.ckpt)
+    model.eval()
+
+    if args.data:
+        train_loader, _, test_loader, _ = get_data_loaders(config, args.data)
+        calibration = calibration_batches(train_loader, config.calibration_batches)
+        evaluation = calibration_batches(test_loader, args.batches)
+    else:
+        shape = (args.batch_size, config.num_channels, config.image_size, config.image_size)
+        calibration = [torch.randn(shape) for _ in range(config.calibration_batches)]
+        evaluation = [torch.randn(shape) for _ in range(args.batches)]
+
+    # torch.ao.quantization warns about its own deprecation on every quantised tensor it creates, only silenced here
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=UserWarning, module="torch.ao")
+        start = time.perf_counter()
+        quantised = quantise_model(model, calibration)
+        print(f'quantised in {time.perf_counter() - start:.2f} s from {len(calibration)} calibration batches')
+
+        x = evaluation[0]
+        ops = {
+            "encode": lambda m: m.encode(x),
+            "reconstruct": lambda m: m.reconstruct(x),
+            "sample": lambda m: m.sample(x.size(0))
+        }
+        with torch.no_grad():
+            print(f'{"op":12} {"fp32 img/s":>12} {"int8 img/s":>12} {"speedup":>8}')
+            for name, op in ops.items():
+                fp32, int8 = [x.size(0) / np.median(time_op(lambda: op(m), args.repeats, args.warmup)) for m in (model, quantised)]
+                print(f'{name:12} {fp32:12.1f} {int8:12.1f} {int8 / fp32:7.2f}x')
+
+        print()
+        for key, value in compare(model, quantised, evaluation).items():
+            print(f'{key:20} {value:.6f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""Latency and throughput of the dynamic-batching server under concurrent single-image requests.
+
+    python -m benchmarks.serving --config mnist_28 --clients 32 --requests 20 --max-batch-sizes 1 8 32
+
+The server runs in process on a Unix socket in a temporary directory, so no network port is opened.
+The batched forward rate at the largest batch size is reported as the ceiling to compare against.
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+import torch
+
+from HopVAE import HopVAE
+from utils import get_config, load_from_checkpoint
+from utils.serving import InferenceService, ServiceClient, make_server
+
+
+def run_clients(socket_path, endpoint, x, num_clients, num_requests):
+    latencies = [[] for _ in range(num_clients)]
+
+    def client(i):
+        service_client = ServiceClient(unix_socket=socket_path)
+        for _ in range(num_requests):
+            start = time.perf_counter()
+            getattr(service_client, endpoint)(x)
+            latencies[i].append(time.perf_counter() - start)
+        service_client.close()
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(num_clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return np.concatenate([np.array(latency) for latency in latencies]), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="mnist_28")
+    parser.add_argument("--ckpt", type=str)
+    parser.add_argument("--endpoint", type=str, default="reconstruct", choices=["encode", "reconstruct"])
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--max-batch-sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--max-wait-ms", type=float, default=5)
+    args = parser.parse_args()
+
+    config = get_config(args.config)
+    torch.manual_seed(config.seed)
+    model = HopVAE(config, torch.device("cpu"))
+    if args.ckpt:
+        model = load_from_checkpoint(model, args.ckpt)
+    model.eval()
+
+    x = torch.randn(1, config.num_channels, config.image_size, config.image_size)
+
+    batch = x.expand(max(args.max_batch_sizes), -1, -1, -1).contiguous()
+    with torch.no_grad():
+        getattr(model, args.endpoint)(batch)
+        start = time.perf_counter()
+        for _ in range(5):
+            getattr(model, args.endpoint)(batch)
+        ceiling = 5 * batch.size(0) / (time.perf_counter() - start)
+    print(f'batched forward at {batch.size(0):3}     {ceiling:8.1f} images/s')
+
+    with tempfile.TemporaryDirectory() as directory:
+        for max_batch_size in args.max_batch_sizes:
+            socket_path = os.path.join(directory, f'serve-{max_batch_size}.sock')
+            service = InferenceService(model, config, max_batch_size=max_batch_size, max_wait=args.max_wait_ms / 1000)
+            server = make_server(service, unix_socket=socket_path)
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+
+            latencies, elapsed = run_clients(socket_path, args.endpoint, x, args.clients, args.requests)
+
+            server.shutdown()
+            server.server_close()
+            service.close()
+
+            stats = service.stats()[args.endpoint]
+            print(f'max batch {max_batch_size:3}  {len(latencies) / elapsed:8.1f} images/s  '
+                  f'p50 {np.percentile(latencies, 50) * 1e3:7.1f} ms  p99 {np.percentile(latencies, 99) * 1e3:7.1f} ms  '
+                  f'mean batch {stats["mean_batch_rows"]:5.1f}')
+
+
+if __name__ == '__main__':
+    main()
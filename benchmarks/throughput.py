@@ -0,0 +1,159 @@
+"""Throughput and latency of the HopVAE entry points on synthetic inputs.
+
+    python -m benchmarks.throughput --batch-sizes 1 8 32 --threads 1 4 --output results.json
+
+Every config under configs/ is benchmarked by default. Results are written as JSON so runs from
+different commits can be compared, configs that fail to build (e.g. a missing prior) are recorded
+with their error rather than aborting the run. Without --output the JSON is the only thing on stdout,
+progress lines go to stderr.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+
+from HopVAE import HopVAE
+from benchmarks.common import time_op
+from utils import get_config, get_config_names
+
+
+def get_ops(model, optimiser, x, y):
+    def forward():
+        with torch.no_grad():
+            model(x)
+
+    def reconstruct():
+        with torch.no_grad():
+            model.reconstruct(x)
+
+    def sample():
+        model.sample(x.size(0))
+
+    def interpolate():
+        model.interpolate(x, y)
+
+    def train_step():
+        model.train()
+        optimiser.zero_grad()
+        x_recon, z_prediction_error = model(x)
+        loss = F.mse_loss(x_recon, x) + z_prediction_error
+        loss.backward()
+        optimiser.step()
+        model.eval()
+
+    return {
+        "forward": forward,
+        "reconstruct": reconstruct,
+        "sample": sample,
+        "interpolate": interpolate,
+        "train_step": train_step
+    }
+
+
+def benchmark_config(name, batch_sizes, threads, repeats, warmup, ops):
+    config = get_config(name)
+    device = torch.device("cpu")
+
+    torch.manual_seed(config.seed)
+    model = HopVAE(config, device).to(device)
+    model.eval()
+    optimiser = optim.Adam(model.parameters(), lr=config.learning_rate)
+
+    results = []
+    # Every setting changes the process wide thread count, the caller's is put back afterwards
+    default_threads = torch.get_num_threads()
+    try:
+        for num_threads in threads:
+            torch.set_num_threads(num_threads)
+            results.extend(benchmark_threads(name, model, optimiser, config, num_threads, batch_sizes, repeats, warmup, ops))
+    finally:
+        torch.set_num_threads(default_threads)
+    return results
+
+
+def benchmark_threads(name, model, optimiser, config, num_threads, batch_sizes, repeats, warmup, ops):
+    results = []
+    for batch_size in batch_sizes:
+        shape = (batch_size, config.num_channels, config.image_size, config.image_size)
+        x, y = torch.randn(shape), torch.randn(shape)
+
+        for op_name, op in get_ops(model, optimiser, x, y).items():
+            if op_name not in ops:
+                continue
+            latencies = time_op(op, repeats, warmup)
+            result = {
+                "config": name,
+                "op": op_name,
+                "batch_size": batch_size,
+                "threads": num_threads,
+                "images_per_sec": batch_size / latencies.mean(),
+                "latency_ms": {
+                    "mean": latencies.mean() * 1000,
+                    "p50": np.percentile(latencies, 50) * 1000,
+                    "p90": np.percentile(latencies, 90) * 1000,
+                    "p99": np.percentile(latencies, 99) * 1000
+                }
+            }
+            results.append(result)
+            print(f'{name:18} {op_name:12} batch={batch_size:<4} threads={num_threads:<3} '
+                  f'{result["images_per_sec"]:10.1f} images/s  p50={result["latency_ms"]["p50"]:8.2f} ms  '
+                  f'p99={result["latency_ms"]["p99"]:8.2f} ms', file=sys.stderr)
+    return results
+
+
+def get_metadata():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "commit": commit,
+        "torch": torch.__version__,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "num_cpus": os.cpu_count(),
+        "default_threads": torch.get_num_threads()
+    }
+
+
+def main():
+    all_ops = ["forward", "reconstruct", "sample", "interpolate", "train_step"]
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--configs", nargs="+", default=get_config_names())
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--threads", nargs="+", type=int, default=[1, torch.get_num_threads()])
+    parser.add_argument("--ops", nargs="+", default=all_ops, choices=all_ops)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--output", type=str, help="JSON file for the results, printed to stdout otherwise")
+    args = parser.parse_args()
+
+    metadata = get_metadata()
+    results, errors = [], []
+    for name in args.configs:
+        try:
+            results.extend(benchmark_config(name, args.batch_sizes, args.threads, args.repeats, args.warmup, args.ops))
+        except Exception as error:
+            errors.append({"config": name, "error": f'{type(error).__name__}: {error}'})
+            print(f'{name:18} skipped, {type(error).__name__}: {error}', file=sys.stderr)
+
+    report = {"metadata": metadata, "results": results, "errors": errors}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
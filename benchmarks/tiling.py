@@ -0,0 +1,94 @@
+"""Throughput, memory and seam quality of tiled reconstruction of images larger than the training resolution.
+
+    python -m benchmarks.tiling --config ffhq_64 --ckpt outputs/FFHQ-64-epoch40.ckpt --size 512 --overlaps 0 16 --batch-sizes 16 64
+
+Each setting runs in a fresh process and reports megapixels/s, the process peak RSS (peak CUDA allocation on
+GPU) and the reconstruction MSE both on pixels next to a tile boundary and away from them, so a seam shows up
+as a boundary error above the interior one. The test image is a smooth random field, upsampled noise.
+"""
+import argparse
+import multiprocessing
+import resource
+import time
+
+import torch
+import torch.nn.functional as F
+
+from HopVAE import HopVAE
+from utils import get_config, load_from_checkpoint
+from utils.tiling import tile_starts
+
+
+def boundary_mask(size, tile_size, overlap, width=2):
+    # Pixels within width of an edge of some tile, inside the image
+    mask = torch.zeros(size, dtype=torch.bool)
+    for start in tile_starts(size, tile_size, overlap):
+        for edge in (start, start + tile_size):
+            if 0 < edge < size:
+                mask[max(0, edge - width):edge + width] = True
+    return mask
+
+
+def run(config_name, ckpt, size, overlap, batch_size, device, queue):
+    config = get_config(config_name)
+    device = torch.device(device)
+    torch.manual_seed(config.seed)
+
+    model = HopVAE(config, device).to(device)
+    if ckpt:
+        model = load_from_checkpoint(model, ckpt)
+    model.eval()
+
+    noise = torch.randn(1, config.num_channels, size // 8, size // 8, device=device)
+    x = F.interpolate(noise, size=(size, size), mode="bicubic", align_corners=False)
+
+    model.reconstruct_tiled(x[..., :config.image_size * 2, :config.image_size * 2], overlap, batch_size)
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+
+    start = time.perf_counter()
+    x_recon = model.reconstruct_tiled(x, overlap, batch_size)
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    elapsed = time.perf_counter() - start
+
+    if device.type == "cuda":
+        peak = torch.cuda.max_memory_allocated(device) / 2**20
+    else:
+        # ru_maxrss is in KiB on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+    edges = boundary_mask(size, config.image_size, overlap).to(device)
+    mask = (edges[:, None] | edges[None, :]).expand_as(x[0, 0])
+    error = (x_recon - x).pow(2).mean(dim=(0, 1))
+    queue.put((size * size / 1e6 / elapsed, peak, error[mask].mean().item(), error[~mask].mean().item()))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="ffhq_64")
+    parser.add_argument("--ckpt", type=str)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--overlaps", type=int, nargs="+", default=[0, 16])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[16, 64])
+    parser.add_argument("--cuda", action="store_true")
+    args = parser.parse_args()
+
+    device = "cuda" if args.cuda and torch.cuda.is_available() else "cpu"
+    context = multiprocessing.get_context("spawn")
+
+    print(f'{"overlap":>8} {"batch":>6} {"MP/s":>8} {"peak MB":>10} {"seam mse":>10} {"interior mse":>13}')
+    for overlap in args.overlaps:
+        for batch_size in args.batch_sizes:
+            queue = context.Queue()
+            process = context.Process(target=run, args=(args.config, args.ckpt, args.size, overlap, batch_size, device, queue))
+            process.start()
+            throughput, peak, seam, interior = queue.get()
+            process.join()
+
+            print(f'{overlap:8} {batch_size:6} {throughput:8.3f} {peak:10.1f} {seam:10.5f} {interior:13.5f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+"""Command line inference with a trained HopVAE, without the training stack.
+
+    python cli.py encode --config ffhq_64 --ckpt outputs/FFHQ-64-epoch40.ckpt --input images/ --output codes.hvae
+    python cli.py decode --config ffhq_64 --ckpt outputs/FFHQ-64-epoch40.ckpt --input codes.hvae --output decoded/
+    python cli.py reconstruct --config mnist_28 --ckpt checkpoints/MNIST-28.ckpt --input images/ --output recon/
+    python cli.py sample --config mnist_28 --ckpt checkpoints/MNIST-28.ckpt --num-samples 64 --output samples/
+    python cli.py export --config ffhq_64 --ckpt outputs/FFHQ-64-epoch40.ckpt --output exported/ --formats torchscript onnx
+    python cli.py index --config ffhq_64 --ckpt outputs/FFHQ-64-epoch40.ckpt --input images/ --output index/ --ivf-lists 256
+    python cli.py search --config ffhq_64 --ckpt outputs/FFHQ-64-epoch40.ckpt --input queries/ --index index/ --output matches.tsv
+
+Only the standard library is imported up front. torch, the model and PIL are imported by the command
+that needs them, and neither wandb nor torchvision is imported at all. Image directories are read and
+written in streamed batches. Codes use the packed format from utils.codes, and encode writes the
+image names next to the code file so decode can restore them. --int8 runs the CPU quantised model.
+reconstruct --tiled processes images of any size as overlapping tiles at the config resolution.
+"""
+import argparse
+import os
+import sys
+import time
+
+
+def names_path(codes_path):
+    return os.path.splitext(codes_path)[0] + ".txt"
+
+
+def setup(args):
+    import torch
+
+    from utils import get_config, get_config_names
+    from utils.inference import load_model
+
+    if args.config not in get_config_names():
+        raise SystemExit(f'Unknown config {args.config}, choose from {", ".join(get_config_names())}')
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device("cuda" if args.cuda and torch.cuda.is_available() else "cpu")
+
+    config = get_config(args.config)
+    model = load_model(config, args.ckpt, device)
+
+    if args.int8:
+        model = quantise(args, config, model)
+    return config, model
+
+
+def quantise(args, config, model):
+    # int8 CPU model calibrated on the first batches of --calibration, or of --input when it is an image directory
+    from utils.inference import iter_image_batches, list_images
+    from utils.quantisation import quantise_model
+
+    directory = args.calibration or getattr(args, "input", None)
+    if directory is None or not os.path.isdir(directory):
+        raise SystemExit('--int8 needs --calibration pointing at a directory of images')
+
+    paths = list_images(directory)[:config.calibration_batches * args.batch_size]
+    calibration = [x for _, x in iter_image_batches(directory, paths, config, args.batch_size, args.io_threads)]
+    return quantise_model(model, calibration)
+
+
+def encode(args):
+    from utils.codes import CodeWriter
+    from utils.inference import iter_image_batches, list_images
+
+    config, model = setup(args)
+    paths = list_images(args.input)
+    if not paths:
+        raise SystemExit(f'No images found under {args.input}')
+
+    with CodeWriter(args.output, model.index_dim, model.representation_dim, model.num_levels) as writer:
+        for _, x in iter_image_batches(args.input, paths, config, args.batch_size, args.io_threads):
+            writer.write(model.encode(x.to(model.device)).cpu().numpy())
+
+    with open(names_path(args.output), "w") as f:
+        f.write("\n".join(paths) + "\n")
+    return len(paths)
+
+
+def decode(args):
+    import torch
+
+    from utils.codes import CodeFile
+    from utils.inference import ImageWriter
+
+    config, model = setup(args)
+    codes = CodeFile(args.input)
+    if (codes.index_dim, codes.representation_dim, codes.num_levels) != (model.index_dim, model.representation_dim, model.num_levels):
+        raise SystemExit(f'{args.input} was not produced with the {args.config} config')
+
+    names = [f'{i:06d}.png' for i in range(len(codes))]
+    if os.path.exists(names_path(args.input)):
+        with open(names_path(args.input)) as f:
+            names = f.read().splitlines()
+
+    with ImageWriter(args.output, config, args.io_threads) as writer, torch.no_grad():
+        for start in range(0, len(codes), args.batch_size):
+            z_indices_quantised = torch.from_numpy(codes[start:start + args.batch_size]).to(model.device)
+            writer.write(model.decode(z_indices_quantised), names[start:start + args.batch_size])
+    return len(codes)
+
+
+def reconstruct(args):
+    import torch
+
+    from utils.inference import ImageWriter, iter_image_batches, list_images, load_image, normalise
+
+    config, model = setup(args)
+    paths = list_images(args.input)
+    if not paths:
+        raise SystemExit(f'No images found under {args.input}')
+
+    if args.tiled:
+        # Native resolution one image at a time, --batch-size tiles per model call
+        with ImageWriter(args.output, config, args.io_threads) as writer:
+            for path in paths:
+                x = normalise(load_image(os.path.join(args.input, path), config, resize=False)[None], config)
+                writer.write(model.reconstruct_tiled(x, overlap=args.tile_overlap, batch_size=args.batch_size), [path])
+        return len(paths)
+
+    with ImageWriter(args.output, config, args.io_threads) as writer, torch.no_grad():
+        for batch_paths, x in iter_image_batches(args.input, paths, config, args.batch_size, args.io_threads):
+            x_recon, _ = model.reconstruct(x.to(model.device))
+            writer.write(x_recon, batch_paths)
+    return len(paths)
+
+
+def sample(args):
+    from utils.inference import ImageWriter
+
+    config, model = setup(args)
+
+    with ImageWriter(args.output, config, args.io_threads) as writer:
+        samples = model.sample(args.num_samples, batch_size=args.batch_size, stream=True, temperature=args.temperature, top_k=args.top_k)
+        start = 0
+        for x in samples:
+            writer.write(x, [f'sample_{i:06d}.png' for i in range(start, start + x.size(0))])
+            start += x.size(0)
+    return args.num_samples
+
+
+def export(args):
+    import json
+
+    from utils.export import export_model
+
+    config, model = setup(args)
+    report = export_model(model, config, args.output, formats=args.formats, fused=not args.eager_lookups, top_k=args.top_k)
+    print(json.dumps(report, indent=2))
+    return len(args.formats)
+
+
+def index(args):
+    from utils.inference import iter_image_batches, list_images
+    from utils.latent_index import LatentIndex, build_index
+
+    config, model = setup(args)
+    paths = list_images(args.input)
+    if not paths:
+        raise SystemExit(f'No images found under {args.input}')
+
+    batches = (x for _, x in iter_image_batches(args.input, paths, config, args.batch_size, args.io_threads))
+    build_index(model, batches, len(paths), args.output, kinds=args.kinds)
+    with open(os.path.join(args.output, "names.txt"), "w") as f:
+        f.write("\n".join(paths) + "\n")
+
+    if args.ivf_lists:
+        for kind in args.kinds:
+            LatentIndex(args.output, kind).train_ivf(args.ivf_lists)
+    return len(paths)
+
+
+def search(args):
+    from utils.inference import iter_image_batches, list_images
+    from utils.latent_index import LatentIndex, embedding_keys
+
+    config, model = setup(args)
+    paths = list_images(args.input)
+    if not paths:
+        raise SystemExit(f'No images found under {args.input}')
+
+    latent_index = LatentIndex(args.index, args.kind)
+    with open(os.path.join(args.index, "names.txt")) as f:
+        names = f.read().splitlines()
+
+    # One line per match: query, rank, indexed image, cosine similarity
+    with open(args.output, "w") as f:
+        for batch_paths, x in iter_image_batches(args.input, paths, config, args.batch_size, args.io_threads):
+            queries = embedding_keys(model, x.to(model.device), kinds=(args.kind,))[args.kind]
+            scores, indices = latent_index.search(queries, k=args.k, nprobe=args.nprobe)
+            for path, row_scores, row_indices in zip(batch_paths, scores, indices):
+                for rank, (score, i) in enumerate(zip(row_scores, row_indices)):
+                    if i >= 0:
+                        f.write(f'{path}\t{rank}\t{names[i]}\t{score:.6f}\n')
+    return len(paths)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="hopvae")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--config", type=str, required=True, help="name of a file under configs/, e.g. ffhq_64")
+    common.add_argument("--ckpt", type=str, required=True)
+    common.add_argument("--output", type=str, required=True)
+    common.add_argument("--batch-size", type=int, default=64)
+    common.add_argument("--threads", type=int, help="torch intra-op threads")
+    common.add_argument("--io-threads", type=int, default=4, help="threads decoding and writing images")
+    common.add_argument("--cuda", action="store_true")
+    common.add_argument("--int8", action="store_true", help="post training int8 quantisation for CPU, see utils.quantisation")
+    common.add_argument("--calibration", type=str, help="image directory to calibrate --int8 on, defaults to --input")
+
+    for name, fn, help in (("encode", encode, "images -> packed code file"),
+                           ("decode", decode, "packed code file -> images")):
+        subparser = subparsers.add_parser(name, parents=[common], help=help)
+        subparser.add_argument("--input", type=str, required=True)
+        subparser.set_defaults(fn=fn)
+
+    subparser = subparsers.add_parser("reconstruct", parents=[common], help="images -> reconstructed images")
+    subparser.add_argument("--input", type=str, required=True)
+    subparser.add_argument("--tiled", action="store_true", help="keep the native resolution, as overlapping tiles at the config's")
+    subparser.add_argument("--tile-overlap", type=int, help="pixels neighbouring tiles share, defaults to config.tile_overlap")
+    subparser.set_defaults(fn=reconstruct)
+
+    subparser = subparsers.add_parser("sample", parents=[common], help="samples from the prior -> images")
+    subparser.add_argument("--num-samples", type=int, default=64)
+    subparser.add_argument("--temperature", type=float, default=1.0, help="autoregressive (PixelCNN) priors only")
+    subparser.add_argument("--top-k", type=int, help="autoregressive (PixelCNN) priors only")
+    subparser.set_defaults(fn=sample)
+
+    subparser = subparsers.add_parser("export", parents=[common], help="TorchScript / ONNX encoder and decoder graphs")
+    subparser.add_argument("--formats", nargs="+", default=["torchscript", "onnx"], choices=["torchscript", "onnx"])
+    subparser.add_argument("--eager-lookups", action="store_true", help="trace the hflayers modules instead of the fused lookups")
+    subparser.add_argument("--top-k", type=int, help="sparse retrieval in the fused hopfield and index_to_embedding lookups")
+    subparser.set_defaults(fn=export)
+
+    subparser = subparsers.add_parser("index", parents=[common], help="images -> similarity search index over hopfield embeddings")
+    subparser.add_argument("--input", type=str, required=True)
+    subparser.add_argument("--kinds", nargs="+", default=["pooled"], choices=["pooled", "grid"])
+    subparser.add_argument("--ivf-lists", type=int, help="also cluster the index into this many lists for approximate search")
+    subparser.set_defaults(fn=index)
+
+    subparser = subparsers.add_parser("search", parents=[common], help="query images -> nearest indexed images")
+    subparser.add_argument("--input", type=str, required=True)
+    subparser.add_argument("--index", type=str, required=True)
+    subparser.add_argument("--kind", default="pooled", choices=["pooled", "grid"])
+    subparser.add_argument("-k", type=int, default=10)
+    subparser.add_argument("--nprobe", type=int, help="lists to scan for approximate search, exact when omitted")
+    subparser.set_defaults(fn=search)
+
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    count = args.fn(args)
+    elapsed = time.perf_counter() - start
+    print(f'{args.command}: {count} items in {elapsed:.2f} s ({count / elapsed:.1f} items/s)', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
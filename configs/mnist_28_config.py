@@ -4,7 +4,7 @@ config["epochs"] = 100             # number of epochs to train (default: 10)
 config["no_cuda"] = False         # disables CUDA training
 config["seed"] = 1265
 config["image_size"] = 28
-config["log_interval"] = 1     # how many batches to wait before logging training status
+config["log_interval"] = 0     # how many batches to wait before logging training status, 0 logs once per epoch only
 config["learning_rate"] = 1e-3
 config["momentum"] = 0.1
 config["gamma"] = 0.99
@@ -23,4 +23,51 @@ config["representation_dim"] = 8
 config["prior"] = "None"
 config["num_levels"] = 512
 config["prior_start"] = 100
-config["index_dim"] = 3
\ No newline at end of file
+config["index_dim"] = 3
+
+config["latent_cache"] = False     # train the prior on cached latent codes once prior_start is reached, otherwise through the full model
+config["cache_dir"] = "cache"
+config["latent_cache_dir"] = None  # defaults to cache_dir, sweep.py gives every trial its own
+config["cache_images"] = False     # resize once into a memory-mapped uint8 array under cache_dir
+
+config["num_workers"] = 4          # DataLoader worker processes, 0 loads on the training thread
+config["prefetch_factor"] = 2      # batches loaded ahead by each worker
+config["pin_memory"] = True
+config["persistent_workers"] = True
+config["batch_transforms"] = True  # apply Resize and Normalize once per batch instead of per image
+
+config["mixed_precision"] = False  # bf16 autocast for the conv stacks and Hopfield retrieval, quantisation stays fp32
+
+config["checkpoint_interval"] = 5  # epochs between checkpoints written to outputs/
+config["keep_checkpoints"] = 3     # most recent checkpoints kept on disk
+
+config["profile"] = False           # per stage time and peak memory breakdown of each training epoch
+config["profile_trace_dir"] = None  # also write a torch profiler trace of a few steps here
+config["profile_flops"] = False     # also count FLOPs per stage, FlopCounterMode slows every profiled step down
+
+config["channels_last"] = False     # NHWC convolutions, the bridge to the Hopfield sequence layout becomes a view
+
+config["fused_lookups"] = False     # precomputed Hopfield lookups for evaluation, see HopVAE.compile_lookups
+config["lookup_top_k"] = None       # sparse retrieval over the top k stored patterns when fused
+config["decode_cache_mb"] = 0           # LRU of decoded images keyed on packed codes for inference, 0 disables
+config["embedding_cache_entries"] = 0   # index_to_embedding outputs cached per distinct index vector, 0 disables
+config["tile_overlap"] = 7              # pixels neighbouring tiles share in the tiled encode / decode of larger images
+
+config["fast_sampling"] = True      # windowed evaluation of autoregressive priors when sampling and decompressing
+
+config["serve_max_batch_size"] = 64  # rows coalesced into one model call by serve.py
+config["serve_max_wait_ms"] = 5      # how long a request may wait for others to join its batch
+
+config["calibration_batches"] = 8    # batches observed to calibrate int8 activation ranges, see utils.quantisation
+
+config["distributed_backend"] = "gloo"     # process group backend when launched with torchrun
+config["threads_per_rank"] = None          # torch threads per CPU rank, None splits the cores evenly
+config["find_unused_parameters"] = True    # let DDP tolerate parameters a forward pass leaves unused
+
+config["checkpoint_residual"] = False       # recompute ResidualStack activations in backward instead of storing them
+config["checkpoint_hopfield"] = False       # same for the Hopfield layers and their attention maps
+config["gradient_accumulation_steps"] = 1   # batches whose gradients are summed per optimiser step
+
+config["logger"] = "wandb"          # "wandb", or "local" for an append only store under output_dir, see utils.loggers
+config["output_dir"] = "outputs"    # checkpoints, and local logs
+config["warm_start"] = True         # start from checkpoints/<data_set>-<image_size>.ckpt when there is nothing to resume
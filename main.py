@@ -3,125 +3,259 @@ import torch.nn.functional as F
 import torch.optim as optim
 
 import argparse
+from contextlib import nullcontext
 
 import numpy as np
 import os
 
-import wandb
-
 from HopVAE import HopVAE
 
-from utils import get_data_loaders, get_prior_optimiser, load_from_checkpoint, MakeConfig
+from utils import get_config, get_config_names, get_data_loaders, get_prior_optimiser, load_from_checkpoint, prior_prediction_error
+from utils.checkpoint import CheckpointManager, resume
+from utils.distributed import cleanup, init_distributed, is_main_process, no_sync, set_epoch, set_phase, wrap
+from utils.latent_cache import get_latent_loaders
+from utils.loggers import get_logger
+from utils.metrics import MetricsAccumulator
+
+
+def log_step(metrics, step, config, logger):
+    # Only materialise the on-device sums every log_interval steps, never within an epoch when log_interval <= 0
+    if config.log_interval > 0 and not step % config.log_interval:
+        metrics.all_reduce()
+        logger.log({f"Train Step {name}": value for name, value in metrics.means().items()})
+        metrics.reset()
+
+
+def log_profile(profiler, logger):
+    logger.log({
+        f"Profile {stage} {key}": value
+        for stage, stats in profiler.summary().items()
+        for key, value in stats.items()
+    })
+    profiler.reset()
+
 
-from configs.mnist_28_config import config
+def accumulation_group(step, num_batches, steps):
+    # Size of the gradient accumulation group batch `step` (1 based) belongs to and whether it completes the group,
+    # the last group of an epoch may be short so its losses are scaled by its real size
+    group_start = (step - 1) // steps * steps
+    group_size = min(steps, num_batches - group_start)
+    return group_size, step == group_start + group_size
 
-wandb.init(project="Hop-VAE", config=config)
-config = MakeConfig(config)
 
-def train(model, train_loader, optimiser, scheduler):
+def train(network, train_loader, optimiser, scheduler, config, logger):
+    # network is the model itself or its DistributedDataParallel wrapper, which the forward pass has to go through
+    model = getattr(network, "module", network)
 
     model.train()
-    train_res_recon_error = 0
+    epoch_metrics = MetricsAccumulator()
+    step_metrics = MetricsAccumulator()
+
+    optimiser.zero_grad()
+    for step, (X, _) in enumerate(train_loader, 1):
+        X = X.to(model.device, non_blocking=True)
+        group_size, update = accumulation_group(step, len(train_loader), config.gradient_accumulation_steps)
 
-    for X, _ in train_loader:
-        X = X.to(model.device)
-        optimiser.zero_grad()
+        with model.profile_step(), (nullcontext() if update else no_sync(network)):
+            X_recon, Z_prediction_error = network(X)
 
-        X_recon, Z_prediction_error = model(X)
+            recon_error = F.mse_loss(X_recon, X)
+            loss = recon_error + Z_prediction_error
 
-        recon_error = F.mse_loss(X_recon, X)
-        loss = recon_error + Z_prediction_error
+            (loss / group_size).backward()
 
-        loss.backward()
-        optimiser.step()
+        if update:
+            optimiser.step()
+            optimiser.zero_grad()
         
-        train_res_recon_error += recon_error.item() + Z_prediction_error.item()
+        # The epoch figure is per example seen, padded shards included, which is len(dataset) on a single process
+        epoch_metrics.add("Reconstruction Error", loss, count=X.size(0))
+        step_metrics.add("Reconstruction Error", loss)
+        log_step(step_metrics, step, config, logger)
+
+    scheduler.step()
+    epoch_metrics.all_reduce()
+    logger.log({
+        "Train Reconstruction Error": epoch_metrics.means()["Reconstruction Error"]
+    })
+
+    if model.profiler is not None:
+        log_profile(model.profiler, logger)
+
+
+def train_prior(model, prior, latent_loader, optimiser, scheduler, config, logger):
+    # Prior only phase, the frozen encoder has already been run over the data set once.
+    # prior is model.prior or its DistributedDataParallel wrapper
+    model.prior.train()
+    epoch_metrics = MetricsAccumulator()
+    step_metrics = MetricsAccumulator()
+
+    optimiser.zero_grad()
+    for step, (Z, _) in enumerate(latent_loader, 1):
+        Z = Z.to(model.device, non_blocking=True).float()
+        group_size, update = accumulation_group(step, len(latent_loader), config.gradient_accumulation_steps)
+
+        with model.profile_step("prior"), (nullcontext() if update else no_sync(prior)):
+            Z_pred = prior(Z)
+            Z_prediction_error = prior_prediction_error(Z_pred, Z)
+
+            (Z_prediction_error / group_size).backward()
+
+        if update:
+            optimiser.step()
+            optimiser.zero_grad()
+
+        epoch_metrics.add("Prior Prediction Error", Z_prediction_error, count=Z.size(0))
+        step_metrics.add("Prior Prediction Error", Z_prediction_error)
+        log_step(step_metrics, step, config, logger)
 
     scheduler.step()
-    wandb.log({
-        "Train Reconstruction Error": (train_res_recon_error) / len(train_loader.dataset)
+    epoch_metrics.all_reduce()
+    logger.log({
+        "Train Prior Prediction Error": epoch_metrics.means()["Prior Prediction Error"]
     })
 
+    if model.profiler is not None:
+        log_profile(model.profiler, logger)
+
 
-def test(model, test_loader):
+def test(model, test_loader, config, logger):
     # Recall Memory
     model.eval() 
 
-    test_res_recon_error = 0
+    if config.fused_lookups:
+        model.compile_lookups(top_k=config.lookup_top_k)
+
+    test_metrics = MetricsAccumulator()
 
     # Last batch is of different size so simplest to do like this
     iterator = iter(test_loader)
     Y, _ = next(iterator)
-    Y = Y.to(model.device)
+    Y = Y.to(model.device, non_blocking=True)
 
     Z, _ = next(iterator)
-    Z = Z.to(model.device)
+    Z = Z.to(model.device, non_blocking=True)
 
     with torch.no_grad():
         for X, _ in test_loader:
-            X = X.to(model.device)
+            X = X.to(model.device, non_blocking=True)
 
             X_recon, _ = model(X)
             recon_error = F.mse_loss(X_recon, X)
             
-            test_res_recon_error += recon_error.item()
+            test_metrics.add("Reconstruction Error", recon_error, count=X.size(0))
 
-        ZY_inter = model.interpolate(Z, Y)
+    test_metrics.all_reduce()
 
-        example_images = [wandb.Image(img) for img in X]
-        example_reconstructions = [wandb.Image(recon_img) for recon_img in X_recon]
-        example_samples = [wandb.Image(model.sample()) for _ in X_recon]
-        example_Z = [wandb.Image(recon_img) for recon_img in Z]
-        example_Y = [wandb.Image(recon_img) for recon_img in Y]
-        example_interpolations = [wandb.Image(inter_img) for inter_img in ZY_inter]
-
-    wandb.log({
-        "Test Inputs": example_images,
-        "Test Reconstruction": example_reconstructions,
-        "Test Interpolations": example_interpolations,
-        "Test Samples": example_samples,
-        "Test Z": example_Z,
-        "Test Y": example_Y,
-        "Test Reconstruction Error": test_res_recon_error / len(test_loader.dataset)
-        })
+    # Every rank evaluates its shard, example images are only generated and logged by the main process
+    if not is_main_process():
+        model.release_lookups()
+        return
 
+    with torch.no_grad():
+        ZY_inter = model.interpolate(Z, Y)
+        samples = model.sample(X_recon.size(0), batch_size=config.batch_size)
+
+    model.release_lookups()
+
+    # The logger turns the batches into images, the local one off the training thread
+    logger.log({
+        "Test Reconstruction Error": test_metrics.means()["Reconstruction Error"]
+        }, images={
+        "Test Inputs": X,
+        "Test Reconstruction": X_recon,
+        "Test Interpolations": ZY_inter,
+        "Test Samples": samples,
+        "Test Z": Z,
+        "Test Y": Y
+        })
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--data", type=str)
-
-    args = parser.parse_args()
-    PATH = args.data 
 
-    use_cuda = not config.no_cuda and torch.cuda.is_available()
-    device = torch.device("cuda" if use_cuda else "cpu")
+def run(config, PATH, logger):
+    # One training run of config on the data under PATH, checkpoints go to config.output_dir
+    # Launched with torchrun every rank trains on a shard of the data, see utils.distributed
+    device = init_distributed(config)
 
     train_loader, val_loader, test_loader, num_classes = get_data_loaders(config, PATH)
     checkpoint_location = f'checkpoints/{config.data_set}-{config.image_size}.ckpt'
-    output_location = f'outputs/{config.data_set}-{config.image_size}.ckpt'
+    checkpoints = CheckpointManager(config.output_dir, f'{config.data_set}-{config.image_size}', keep_last=config.keep_checkpoints)
 
     model = HopVAE(config, device).to(device)
-    model = load_from_checkpoint(model, checkpoint_location)
 
     optimiser = optim.Adam(model.parameters(), lr=config.learning_rate, amsgrad=False)
     scheduler = optim.lr_scheduler.ExponentialLR(optimiser, gamma=config.gamma)
 
-    wandb.watch(model, log="all")
+    # Resume from our own latest checkpoint if there is one, otherwise warm start from the shipped weights
+    start_epoch, optimiser, scheduler = resume(checkpoints, config, model, optimiser, scheduler)
+    if not start_epoch:
+        if config.warm_start:
+            model = load_from_checkpoint(model, checkpoint_location)
+
+    elif model.fit_prior and config.latent_cache:
+        latent_train_loader, = get_latent_loaders(config, model, (train_loader,), splits=('train',), rebuild=False)
+
+    set_phase(model, model.fit_prior)
+    network = wrap(model.prior if model.fit_prior and config.latent_cache else model, config)
+
+    logger.watch(model)
+
+    profiler = model.profile(count_flops=config.profile_flops, trace_dir=config.profile_trace_dir) if config.profile else nullcontext()
 
-    for epoch in range(config.epochs):
+    with profiler:
+        for epoch in range(start_epoch, config.epochs):
 
-        if epoch > config.prior_start and not model.fit_prior:
+            if epoch > config.prior_start and not model.fit_prior:
 
-            model.fit_prior = True
-            optimiser, scheduler = get_prior_optimiser(config, model.prior)
+                model.fit_prior = True
+                optimiser, scheduler = get_prior_optimiser(config, model.prior)
 
-        train(model, train_loader, optimiser, scheduler)
+                # Only the prior trains from here on, so DDP is rebuilt over the parameters that still require grad
+                set_phase(model, True)
+                network = wrap(model.prior if config.latent_cache else model, config)
 
-        if not epoch % 5:
-            test(model, test_loader)
+                if config.latent_cache:
+                    # The prior only trains on the train split, val and test codes would be encoded for nothing
+                    latent_train_loader, = get_latent_loaders(config, model, (train_loader,), splits=('train',))
+
+            if model.fit_prior and config.latent_cache:
+                set_epoch(latent_train_loader, epoch)
+                train_prior(model, network, latent_train_loader, optimiser, scheduler, config, logger)
+            else:
+                set_epoch(train_loader, epoch)
+                train(network, train_loader, optimiser, scheduler, config, logger)
+
+            if not epoch % 5:
+                with model.unprofiled():
+                    test(model, test_loader, config, logger)
+
+            if not epoch % config.checkpoint_interval and is_main_process():
+                checkpoints.save(epoch, model, optimiser, scheduler)
+
+    checkpoints.close()
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="mnist_28", choices=get_config_names())
+    parser.add_argument("--data", type=str)
+    parser.add_argument("--logger", type=str, choices=["wandb", "local"], help="overrides config.logger")
+    parser.add_argument("--output-dir", type=str, help="overrides config.output_dir")
+
+    args = parser.parse_args()
 
-        if not epoch % 5:
-            torch.save(model.state_dict(), output_location)
+    config = get_config(args.config)
+    config.logger = args.logger or config.logger
+    config.output_dir = args.output_dir or config.output_dir
+
+    # The process group has to be up before the logger, which only logs from the main process
+    init_distributed(config)
+    logger = get_logger(config)
+    try:
+        run(config, args.data, logger)
+    finally:
+        logger.close()
+        cleanup()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
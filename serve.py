@@ -0,0 +1,68 @@
+"""Local inference server for a trained HopVAE, concurrent requests are coalesced into batches.
+
+    python serve.py --config mnist_28 --ckpt checkpoints/MNIST-28.ckpt --port 8000
+    python serve.py --config ffhq_64 --ckpt outputs/FFHQ-64-epoch40.ckpt --unix-socket /tmp/hopvae.sock
+
+POST /encode, /decode, /reconstruct, /sample and /interpolate take and return JSON, see utils.serving.
+GET /stats reports how many batches each endpoint ran and their mean size, and the decode cache
+counters when --decode-cache-mb or --embedding-cache-entries turn it on.
+"""
+import argparse
+import os
+
+import torch
+
+from utils import get_config, get_config_names
+from utils.inference import load_model
+from utils.serving import InferenceService, make_server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="mnist_28", choices=get_config_names())
+    parser.add_argument("--ckpt", type=str, required=True)
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix-socket", type=str)
+    parser.add_argument("--max-batch-size", type=int)
+    parser.add_argument("--max-wait-ms", type=float)
+    parser.add_argument("--decode-cache-mb", type=float)
+    parser.add_argument("--embedding-cache-entries", type=int)
+    parser.add_argument("--threads", type=int)
+    parser.add_argument("--cuda", action="store_true")
+    args = parser.parse_args()
+
+    config = get_config(args.config)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device("cuda" if args.cuda and torch.cuda.is_available() else "cpu")
+
+    max_batch_size = args.max_batch_size or config.serve_max_batch_size
+    max_wait_ms = config.serve_max_wait_ms if args.max_wait_ms is None else args.max_wait_ms
+    if args.decode_cache_mb is not None:
+        config.decode_cache_mb = args.decode_cache_mb
+    if args.embedding_cache_entries is not None:
+        config.embedding_cache_entries = args.embedding_cache_entries
+
+    model = load_model(config, args.ckpt, device)
+    service = InferenceService(model, config, max_batch_size=max_batch_size, max_wait=max_wait_ms / 1000)
+
+    if args.unix_socket and os.path.exists(args.unix_socket):
+        os.remove(args.unix_socket)
+    server = make_server(service, args.host, args.port, args.unix_socket)
+
+    address = args.unix_socket or f'http://{args.host}:{args.port}'
+    print(f'Serving {args.config} from {args.ckpt} on {address} (max batch {max_batch_size}, max wait {max_wait_ms} ms)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if args.unix_socket and os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+
+
+if __name__ == '__main__':
+    main()
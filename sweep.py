@@ -0,0 +1,167 @@
+"""Grid sweep over config keys, trials run side by side in a process pool and log to a local store.
+
+    python sweep.py --config mnist_28 --data <mnist root> --grid num_embeddings=256,512 index_dim=2,3 num_levels=16,512 \
+        --set epochs=6 --workers 8 --threads 2
+
+Every combination of the --grid values is one trial, --set applies to all of them. Values are Python literals,
+anything else is taken as a string. Each trial runs main.run in its own process limited to --threads torch
+threads, so workers * threads should roughly match the core count. Trials log through utils.loggers.LocalLogger
+into <output>/trial-<hash of the overrides>/ (config.json, metrics.jsonl, images/, checkpoints) and never touch
+wandb. A finished trial appends its overrides and last metric values to <output>/sweep.jsonl. Trials are identified
+by their overrides, not their place in the grid, so a rerun skips the ones already in there and an interrupted or
+extended sweep picks up where it stopped.
+"""
+import argparse
+import ast
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from utils import get_config, get_config_names
+
+
+def parse_value(text):
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text
+
+
+def parse_assignments(assignments, multiple):
+    # ["key=a,b", ...] -> {key: [a, b]} with multiple, ["key=a", ...] -> {key: a} without
+    parsed = {}
+    for assignment in assignments:
+        key, sep, values = assignment.partition("=")
+        if not sep:
+            raise SystemExit(f'Expected key=value, got {assignment}')
+        parsed[key] = [parse_value(value) for value in values.split(",")] if multiple else parse_value(values)
+    return parsed
+
+
+def grid_trials(grid):
+    keys = list(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[key] for key in keys))]
+
+
+def trial_key(overrides):
+    # Normalised by one JSON round trip, so tuples parsed from the command line match the lists sweep.jsonl gives back
+    return json.dumps(json.loads(json.dumps(overrides, default=repr)), sort_keys=True)
+
+
+def trial_directory(output, overrides):
+    return os.path.join(output, f'trial-{hashlib.sha1(trial_key(overrides).encode()).hexdigest()[:12]}')
+
+
+def override_config(config_name, overrides):
+    config = get_config(config_name)
+    for key, value in overrides.items():
+        if key not in config.__dict__:
+            raise KeyError(f'{config_name} has no config key {key}')
+        setattr(config, key, value)
+    return config
+
+
+def trial_config(config_name, overrides, directory, num_workers, warm_start):
+    config = override_config(config_name, overrides)
+    config.logger = "local"
+    config.output_dir = directory
+    # Latent codes depend on the trial's model, the image cache does not and stays shared
+    config.latent_cache_dir = os.path.join(directory, "cache")
+    config.warm_start = warm_start
+    config.no_cuda = True
+    config.num_workers = num_workers
+    return config
+
+
+def run_trial(trial, config_name, overrides, directory, path, threads, num_workers, warm_start):
+    # Runs in a pool process, torch and the training stack are imported here so the parent stays light
+    import torch
+
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+
+    from main import run
+    from utils.loggers import LocalLogger
+
+    config = trial_config(config_name, overrides, directory, num_workers, warm_start)
+    # Trials differ only in their overrides, not in where the RNG happened to start. Plain main.py runs stay unseeded
+    torch.manual_seed(config.seed)
+    logger = LocalLogger(directory, config)
+    start = time.perf_counter()
+    try:
+        run(config, path, logger)
+    finally:
+        logger.close()
+    return {"trial": trial, "overrides": overrides, "seconds": time.perf_counter() - start, **logger.latest}
+
+
+def completed_trials(summary_path):
+    if not os.path.exists(summary_path):
+        return set()
+    with open(summary_path) as f:
+        return {trial_key(json.loads(line)["overrides"]) for line in f if line.strip()}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="mnist_28", choices=get_config_names())
+    parser.add_argument("--data", type=str)
+    parser.add_argument("--grid", nargs="+", default=[], help="key=v1,v2,... swept over")
+    parser.add_argument("--set", nargs="+", default=[], help="key=value applied to every trial")
+    parser.add_argument("--output", type=str, default="sweeps")
+    parser.add_argument("--workers", type=int, default=max(1, os.cpu_count() // 2))
+    parser.add_argument("--threads", type=int, default=2, help="torch threads per trial")
+    parser.add_argument("--num-workers", type=int, default=0, help="DataLoader workers per trial")
+    parser.add_argument("--warm-start", action="store_true", help="start every trial from the shipped checkpoint")
+    args = parser.parse_args()
+
+    fixed = parse_assignments(args.set, multiple=False)
+    trials = [{**fixed, **overrides} for overrides in grid_trials(parse_assignments(args.grid, multiple=True))]
+    for overrides in trials:
+        # Surface unknown keys before any process starts
+        trial_config(args.config, overrides, args.output, args.num_workers, args.warm_start)
+
+    os.makedirs(args.output, exist_ok=True)
+    summary_path = os.path.join(args.output, "sweep.jsonl")
+    done = completed_trials(summary_path)
+    pending = [(trial, overrides) for trial, overrides in enumerate(trials) if trial_key(overrides) not in done]
+    print(f'{len(trials)} trials, {len(trials) - len(pending)} already done, {args.workers} workers x {args.threads} threads')
+
+    if pending:
+        # Downloads the data set and builds the shared image cache once, before trials race to do it.
+        # --set values apply to every trial so they are honoured here, per trial grid values can not be
+        from utils import get_data_loaders
+        get_data_loaders(override_config(args.config, fixed), args.data)
+
+    # Spawned children inherit these before torch is imported, which also caps the OpenMP pools torch.set_num_threads misses
+    os.environ["OMP_NUM_THREADS"] = str(args.threads)
+    os.environ["MKL_NUM_THREADS"] = str(args.threads)
+
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(args.workers, mp_context=context, max_tasks_per_child=1) as pool, open(summary_path, "a") as summary:
+        futures = {
+            pool.submit(run_trial, trial, args.config, overrides, trial_directory(args.output, overrides),
+                        args.data, args.threads, args.num_workers, args.warm_start): (trial, overrides)
+            for trial, overrides in pending
+        }
+        for future in as_completed(futures):
+            trial, overrides = futures[future]
+            try:
+                result = future.result()
+            except Exception:
+                print(f'trial {trial} {overrides} failed:\n{traceback.format_exc()}')
+                continue
+
+            summary.write(json.dumps(result, default=repr) + "\n")
+            summary.flush()
+            error = result.get("Test Reconstruction Error", float("nan"))
+            print(f'trial {trial:4d} {json.dumps(overrides):60} {result["seconds"]:8.1f} s  test mse {error:.5f}')
+
+
+if __name__ == '__main__':
+    main()
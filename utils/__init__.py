@@ -1,16 +1,20 @@
 import sys
 import os
+import importlib
+import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
 from torch.utils.data import random_split
-
-import torchvision
-from torchvision import transforms
+from torch.utils.data.dataloader import default_collate
 
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
+from utils.checkpoint import load_checkpoint, load_partial_state_dict
+from utils.distributed import data_loader
+
 class MakeConfig:
     def __init__(self, config):
         self.__dict__ = config
@@ -21,8 +25,8 @@ class Normal(nn.Module):
         self.device = device
         self.config = config
 
-    def sample(self):
-        return torch.rand(1, self.config.index_dim, self.config.representation_dim, self.config.representation_dim).to(self.device) * self.config.num_levels
+    def sample(self, num_samples=1):
+        return torch.rand(num_samples, self.config.index_dim, self.config.representation_dim, self.config.representation_dim, device=self.device) * self.config.num_levels
     
     def interpolate(self, X, Y):
         return (X + Y) / 2
@@ -31,21 +35,14 @@ class Normal(nn.Module):
         return X
 
     def forward(self, X):
-        return torch.rand(X.shape[0], self.num_levels, self.config.index_dim, X.shape[2], X.shape[3]).to(self.device)
+        return torch.rand(X.shape[0], self.config.num_levels, self.config.index_dim, X.shape[2], X.shape[3]).to(self.device)
 
 def load_from_checkpoint(model, checkpoint_location):
     if os.path.exists(checkpoint_location):
-        pre_state_dict = torch.load(checkpoint_location, map_location=model.device)
-        to_delete = []
-        for key in pre_state_dict.keys():
-            if key not in model.state_dict().keys():
-                to_delete.append(key)
-        for key in to_delete:
-            del pre_state_dict[key]
-        for key in model.state_dict().keys():
-            if key not in pre_state_dict.keys():
-                pre_state_dict[key] = model.state_dict()[key]
-        model.load_state_dict(pre_state_dict)
+        pre_state_dict = load_checkpoint(checkpoint_location, model.device)
+        # Full training checkpoints nest the weights, plain state dicts are used as they are
+        pre_state_dict = pre_state_dict.get("model", pre_state_dict)
+        load_partial_state_dict(model, pre_state_dict)
     return model
 
 def straight_through_round(X):
@@ -54,6 +51,12 @@ def straight_through_round(X):
     out.data = forward_value.data
     return out
 
+def prior_prediction_error(z_pred, z_indices_quantised):
+    # Mean cross entropy of the prior over every latent position, in bits
+    z_cross_entropy = F.cross_entropy(z_pred, z_indices_quantised.long(), reduction='none')
+    z_prediction_error = z_cross_entropy.mean(dim=[1,2,3]) * np.log2(np.exp(1))
+    return z_prediction_error.mean()
+
 def get_prior_optimiser(config, prior):
 
     if config.prior == "PixelCNN":
@@ -82,13 +85,86 @@ def get_prior(config, device):
     return prior(prior_config, device)
 
 
+def get_prior_sampler(config, prior):
+    # Autoregressive priors are sampled through PriorSampler, None means the prior samples itself
+    if config.prior == "PixelCNN":
+        from utils.prior_sampling import PriorSampler
+        return PriorSampler(prior, config, windowed=config.fast_sampling, seed=config.seed)
+    return None
+
+NORMALISATION = {
+    "MNIST": ((0.1307,), (0.3081,)),
+    "CIFAR10": ((0.5, 0.5, 0.5), (1.0, 1.0, 1.0)),
+    "FFHQ": ((0.5, 0.5, 0.5), (1.0, 1.0, 1.0)),
+}
+
+class BatchTransform:
+    # Used as collate_fn so Resize and Normalize run once per stacked batch rather than once per image
+    def __init__(self, transform):
+        self.transform = transform
+
+    def __call__(self, batch):
+        X, y = default_collate(batch)
+        return self.transform(X), y
+
+def get_config_names():
+    configs_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'configs')
+    return sorted(name[:-len('_config.py')] for name in os.listdir(configs_dir) if name.endswith('_config.py'))
+
+def get_config(name):
+    config = importlib.import_module(f'configs.{name}_config').config
+    return MakeConfig(dict(config))
+
+def get_transforms(config, resize=True):
+    # Returns the per image transform and the transform applied to stacked batches (None when everything runs per image),
+    # cached data sets are already resized uint8 tensors so skip the PIL conversion and Resize
+    from torchvision import transforms
+
+    mean, std = NORMALISATION[config.data_set]
+
+    to_tensor = [transforms.PILToTensor()] if resize else []
+    tensor_transforms = [transforms.ConvertImageDtype(torch.float32)]
+    if resize:
+        tensor_transforms.append(transforms.Resize(config.image_size))
+    tensor_transforms.append(transforms.Normalize(mean, std))
+
+    if config.batch_transforms:
+        sample_transform = transforms.Compose(to_tensor) if to_tensor else None
+        return sample_transform, transforms.Compose(tensor_transforms)
+
+    return transforms.Compose(to_tensor + tensor_transforms), None
+
+def get_loader_kwargs(config, batch_transform=None):
+    kwargs = {
+        "batch_size": config.batch_size,
+        "num_workers": config.num_workers,
+        "pin_memory": config.pin_memory and torch.cuda.is_available()
+    }
+    if config.num_workers > 0:
+        kwargs["prefetch_factor"] = config.prefetch_factor
+        kwargs["persistent_workers"] = config.persistent_workers
+    if batch_transform is not None:
+        kwargs["collate_fn"] = BatchTransform(batch_transform)
+    return kwargs
+
 def get_data_loaders(config, PATH):
-    if config.data_set == "MNIST":
-        transform = transforms.Compose([
-                transforms.ToTensor(),
-                transforms.Resize(config.image_size),
-                transforms.Normalize((0.1307,), (0.3081,))
-            ])
+    # torchvision is only imported once data is actually loaded, so inference entry points start quickly
+    import torchvision
+
+    if config.cache_images:
+        from utils.image_cache import get_cached_data_sets
+
+        transform, batch_transform = get_transforms(config, resize=False)
+        train_set, val_set, test_set = get_cached_data_sets(config, PATH, transform)
+        num_classes = 0 if config.data_set == "FFHQ" else 10
+
+        if config.data_set == "CIFAR10":
+            config.data_variance = np.var(train_set.images[train_set.indices] / 255.0)
+        else:
+            config.data_variance = 1
+
+    elif config.data_set == "MNIST":
+        transform, batch_transform = get_transforms(config)
 
         train_set = torchvision.datasets.MNIST(root=PATH, train=True, download=True, transform=transform)
         val_set = torchvision.datasets.MNIST(root=PATH, train=False, download=True, transform=transform)
@@ -97,11 +173,8 @@ def get_data_loaders(config, PATH):
         config.data_variance = 1
 
     elif config.data_set == "CIFAR10":
-        transform=transforms.Compose([
-                transforms.ToTensor(),
-                transforms.Resize(config.image_size),
-                transforms.Normalize((0.5,0.5,0.5), (1.0,1.0,1.0))
-            ])
+        transform, batch_transform = get_transforms(config)
+
         train_set = torchvision.datasets.CIFAR10(root=PATH, train=True, download=True, transform=transform)
         val_set = torchvision.datasets.CIFAR10(root=PATH, train=False, download=True, transform=transform)
         test_set = torchvision.datasets.CIFAR10(root=PATH, train=False, download=True, transform=transform)
@@ -109,11 +182,7 @@ def get_data_loaders(config, PATH):
         config.data_variance = np.var(train_set.data / 255.0)
 
     elif config.data_set == "FFHQ":
-        transform = transforms.Compose([
-                transforms.ToTensor(),
-                transforms.Resize(config.image_size),
-                transforms.Normalize((0.5,0.5,0.5), (1.0,1.0,1.0))
-            ])
+        transform, batch_transform = get_transforms(config)
 
         dataset = torchvision.datasets.ImageFolder(PATH, transform=transform)
         lengths = [int(len(dataset)*0.7), int(len(dataset)*0.1), int(len(dataset)*0.2)]
@@ -122,13 +191,9 @@ def get_data_loaders(config, PATH):
         config.data_variance = 1#np.var(train_set.data / 255.0)
         num_classes = 0
 
-    train_loader = torch.utils.data.DataLoader(train_set, batch_size=config.batch_size, shuffle=True)
-    val_loader = torch.utils.data.DataLoader(val_set, batch_size=config.batch_size, shuffle=False)
-    test_loader = torch.utils.data.DataLoader(test_set, batch_size=config.batch_size, shuffle=False)
+    loader_kwargs = get_loader_kwargs(config, batch_transform)
+    train_loader = data_loader(train_set, shuffle=True, **loader_kwargs)
+    val_loader = data_loader(val_set, shuffle=False, **loader_kwargs)
+    test_loader = data_loader(test_set, shuffle=False, **loader_kwargs)
     
     return train_loader, val_loader, test_loader, num_classes
-
-        
-
-
-
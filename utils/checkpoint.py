@@ -0,0 +1,136 @@
+import os
+import re
+import queue
+import threading
+import torch
+
+
+def snapshot(obj):
+    # Detached CPU copies so training can keep mutating the live tensors while the copy is written out
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, snapshot(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+
+def load_checkpoint(checkpoint_location, device):
+    # Memory mapping means tensors are only paged in when load_state_dict copies them
+    try:
+        return torch.load(checkpoint_location, map_location=device, mmap=True)
+    except (TypeError, RuntimeError):
+        # Older torch versions and legacy (non zip) files can not be memory mapped
+        return torch.load(checkpoint_location, map_location=device)
+
+
+def load_partial_state_dict(model, pre_state_dict):
+    # Keys missing from the checkpoint keep the model's values and extra checkpoint keys are dropped
+    state_dict = model.state_dict()
+    matched = {key: pre_state_dict.get(key, value) for key, value in state_dict.items()}
+    model.load_state_dict(matched)
+    return model
+
+
+class CheckpointManager:
+    def __init__(self, directory, prefix, keep_last=3):
+        self.directory = directory
+        self.prefix = prefix
+        self.keep_last = keep_last
+
+        self._pattern = re.compile(re.escape(prefix) + r'-epoch(\d+)\.ckpt$')
+        # A single slot so a slow disk applies back pressure instead of queueing unbounded snapshots
+        self._queue = queue.Queue(maxsize=1)
+        self._error = None
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def checkpoints(self):
+        if not os.path.isdir(self.directory):
+            return []
+        epochs = []
+        for name in os.listdir(self.directory):
+            match = self._pattern.match(name)
+            if match:
+                epochs.append((int(match.group(1)), os.path.join(self.directory, name)))
+        return [path for _, path in sorted(epochs)]
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def save(self, epoch, model, optimiser, scheduler):
+        self._raise_error()
+        checkpoint = {
+            "epoch": epoch,
+            "fit_prior": model.fit_prior,
+            "model": snapshot(model.state_dict()),
+            "optimiser": snapshot(optimiser.state_dict()),
+            "scheduler": snapshot(scheduler.state_dict())
+        }
+        path = os.path.join(self.directory, f'{self.prefix}-epoch{epoch}.ckpt')
+        self._queue.put((path, checkpoint))
+
+    def wait(self):
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        self.wait()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+
+            path, checkpoint = item
+            try:
+                self._write(path, checkpoint)
+                self._rotate()
+            except Exception as error:
+                self._error = error
+            finally:
+                self._queue.task_done()
+
+    def _write(self, path, checkpoint):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = path + '.tmp'
+        torch.save(checkpoint, tmp_path)
+        # The rename is atomic, so a crash mid write never leaves a truncated checkpoint under the real name
+        os.replace(tmp_path, path)
+
+    def _rotate(self):
+        for path in self.checkpoints()[:-self.keep_last]:
+            os.remove(path)
+
+
+def resume(manager, config, model, optimiser, scheduler):
+    # Restores the latest checkpoint written by manager, returning the epoch to continue from
+    # along with the optimiser and scheduler, which are rebuilt for the prior phase if needed
+    from utils import get_prior_optimiser
+
+    checkpoint_location = manager.latest()
+    if checkpoint_location is None:
+        return 0, optimiser, scheduler
+
+    checkpoint = load_checkpoint(checkpoint_location, model.device)
+    load_partial_state_dict(model, checkpoint["model"])
+
+    if checkpoint["fit_prior"]:
+        model.fit_prior = True
+        optimiser, scheduler = get_prior_optimiser(config, model.prior)
+
+    optimiser.load_state_dict(checkpoint["optimiser"])
+    scheduler.load_state_dict(checkpoint["scheduler"])
+
+    return checkpoint["epoch"] + 1, optimiser, scheduler
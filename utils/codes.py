@@ -0,0 +1,120 @@
+import math
+import struct
+
+import numpy as np
+
+# magic, format version, bits per code, index_dim, representation_dim, num_levels, number of code grids
+HEADER = struct.Struct('<4sBBHHIQ')
+MAGIC = b'HVAE'
+VERSION = 1
+
+
+def bits_per_code(num_levels):
+    return max(1, math.ceil(math.log2(num_levels)))
+
+
+def record_size(index_dim, representation_dim, num_levels):
+    # Every grid is padded to a whole number of bytes so single grids can be read straight out of a memory map
+    return math.ceil(index_dim * representation_dim * representation_dim * bits_per_code(num_levels) / 8)
+
+
+def pack_codes(codes, num_levels):
+    # (N, index_dim, H, W) integer codes -> (N, record_size) uint8, least significant bit first
+    bits = bits_per_code(num_levels)
+    values = np.asarray(codes).reshape(len(codes), -1).astype(np.uint32)
+
+    bit_array = ((values[..., None] >> np.arange(bits, dtype=np.uint32)) & 1).astype(np.uint8)
+    return np.packbits(bit_array.reshape(len(codes), -1), axis=1, bitorder='little')
+
+
+def unpack_codes(packed, index_dim, representation_dim, num_levels):
+    bits = bits_per_code(num_levels)
+    num_codes = index_dim * representation_dim * representation_dim
+    packed = np.asarray(packed, dtype=np.uint8).reshape(-1, record_size(index_dim, representation_dim, num_levels))
+
+    bit_array = np.unpackbits(packed, axis=1, count=num_codes * bits, bitorder='little')
+    bit_array = bit_array.reshape(len(packed), num_codes, bits).astype(np.int64)
+    values = (bit_array << np.arange(bits, dtype=np.int64)).sum(axis=-1)
+
+    return values.reshape(len(packed), index_dim, representation_dim, representation_dim)
+
+
+def encode_header(index_dim, representation_dim, num_levels, count):
+    return HEADER.pack(MAGIC, VERSION, bits_per_code(num_levels), index_dim, representation_dim, num_levels, count)
+
+
+def decode_header(data):
+    magic, version, bits, index_dim, representation_dim, num_levels, count = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f'Not a version {VERSION} HopVAE code stream')
+    return {
+        "bits": bits,
+        "index_dim": index_dim,
+        "representation_dim": representation_dim,
+        "num_levels": num_levels,
+        "count": count
+    }
+
+
+def codes_to_bytes(codes, num_levels):
+    codes = np.asarray(codes)
+    _, index_dim, representation_dim, _ = codes.shape
+    header = encode_header(index_dim, representation_dim, num_levels, len(codes))
+    return header + pack_codes(codes, num_levels).tobytes()
+
+
+def codes_from_bytes(data):
+    header = decode_header(data)
+    packed = np.frombuffer(data, dtype=np.uint8, offset=HEADER.size)
+    codes = unpack_codes(packed, header["index_dim"], header["representation_dim"], header["num_levels"])
+    return codes, header
+
+
+class CodeWriter:
+    # Streams packed code grids to a file, the count in the header is filled in on close
+    def __init__(self, path, index_dim, representation_dim, num_levels):
+        self.index_dim = index_dim
+        self.representation_dim = representation_dim
+        self.num_levels = num_levels
+        self.count = 0
+
+        self.file = open(path, 'wb')
+        self.file.write(encode_header(index_dim, representation_dim, num_levels, 0))
+
+    def write(self, codes):
+        self.file.write(pack_codes(codes, self.num_levels).tobytes())
+        self.count += len(codes)
+
+    def close(self):
+        self.file.seek(0)
+        self.file.write(encode_header(self.index_dim, self.representation_dim, self.num_levels, self.count))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+class CodeFile:
+    # Random access to a packed code file through a memory map, grids are only unpacked when indexed
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            header = decode_header(f.read(HEADER.size))
+
+        self.index_dim = header["index_dim"]
+        self.representation_dim = header["representation_dim"]
+        self.num_levels = header["num_levels"]
+
+        shape = (header["count"], record_size(self.index_dim, self.representation_dim, self.num_levels))
+        self.packed = np.memmap(path, dtype=np.uint8, mode='r', offset=HEADER.size, shape=shape)
+
+    def __len__(self):
+        return len(self.packed)
+
+    def __getitem__(self, index):
+        packed = self.packed[index]
+        codes = unpack_codes(packed, self.index_dim, self.representation_dim, self.num_levels)
+        return codes[0] if np.ndim(index) == 0 and not isinstance(index, slice) else codes
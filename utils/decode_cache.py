@@ -0,0 +1,163 @@
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from utils.codes import pack_codes
+
+# Both caches are only valid for the weights they were filled with and are not thread safe on their own,
+# InferenceService already serialises model calls. HopVAE clears them whenever its lookups are recompiled
+
+
+class DecodeCache:
+    # Decoded images keyed on the bit packed code grid, least recently used first out once max_bytes is exceeded.
+    # Only the grids of a batch that miss are decoded, together in one call
+    def __init__(self, max_bytes, num_levels):
+        self.max_bytes = max_bytes
+        self.num_levels = num_levels
+        self._entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __call__(self, z_indices_quantised, decode):
+        # Packing flattens each grid, so its shape is part of the key, codes of a different shape never collide
+        shape = repr(tuple(z_indices_quantised.shape[1:])).encode()
+        keys = [shape + row.tobytes() for row in pack_codes(z_indices_quantised.cpu().numpy(), self.num_levels)]
+
+        images = [self._get(key) for key in keys]
+        missing = [i for i, image in enumerate(images) if image is None]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            # Repeats inside the batch are decoded once
+            first = {}
+            for i in missing:
+                first.setdefault(keys[i], i)
+            rows = torch.tensor(list(first.values()), device=z_indices_quantised.device)
+            decoded = dict(zip(first, decode(z_indices_quantised[rows])))
+            for key, image in decoded.items():
+                self._put(key, image)
+            for i in missing:
+                images[i] = decoded[keys[i]]
+
+        return torch.stack(images)
+
+    def clear(self):
+        self._entries.clear()
+        self.num_bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.num_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+    def _get(self, key):
+        image = self._entries.get(key)
+        if image is not None:
+            self._entries.move_to_end(key)
+        return image
+
+    def _put(self, key, image):
+        # A copy, so a cached image never keeps the rest of its batch alive
+        image = image.clone()
+        size = image.nbytes + len(key)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = image
+        self.num_bytes += size
+        while self.num_bytes > self.max_bytes:
+            evicted_key, evicted = self._entries.popitem(last=False)
+            self.num_bytes -= evicted.nbytes + len(evicted_key)
+            self.evictions += 1
+
+
+class EmbeddingCache:
+    # index_to_embedding outputs per distinct index vector. Every position is looked up independently of the
+    # others, so a grid's embeddings can be assembled from vectors seen in any earlier grid. Vectors are keyed
+    # by their mixed radix value and kept sorted, so a whole batch is resolved with one searchsorted
+    def __init__(self, max_entries, num_levels, index_dim, embedding_dim, device):
+        if num_levels ** index_dim > np.iinfo(np.int64).max:
+            raise ValueError(f'{index_dim} codes of {num_levels} levels do not fit an int64 key')
+        self.max_entries = max_entries
+        self.num_levels = num_levels
+        self.radix = num_levels ** torch.arange(index_dim, device=device)
+        self.keys = torch.empty(0, dtype=torch.int64, device=device)
+        self.values = torch.empty(0, embedding_dim, device=device)
+        self.last_used = torch.empty(0, dtype=torch.int64, device=device)
+        self.step = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __call__(self, z_indices_quantised, lookup):
+        # (B, H * W, index_dim) integer codes -> (B, H * W, embedding_dim), lookup maps (1, M, index_dim) codes
+        # scaled to [0, 1] to their embeddings and only runs on vectors not cached yet
+        self.step += 1
+        keys = (z_indices_quantised.long() * self.radix).sum(dim=-1)
+        unique, inverse = torch.unique(keys, return_inverse=True)
+
+        position = torch.searchsorted(self.keys, unique).clamp(max=max(len(self.keys) - 1, 0))
+        found = (self.keys[position] == unique) if len(self.keys) else torch.zeros_like(unique, dtype=torch.bool)
+        # Counted per position, a vector repeated across the batch is a hit or miss at every position it occupies
+        hits = int(found[inverse].sum())
+        self.hits += hits
+        self.misses += inverse.numel() - hits
+
+        values = torch.empty(len(unique), self.values.size(1), device=self.values.device)
+        values[found] = self.values[position[found]]
+        self.last_used[position[found]] = self.step
+
+        if not found.all():
+            new_keys = unique[~found]
+            codes = (new_keys.unsqueeze(-1) // self.radix) % self.num_levels
+            new_values = lookup(codes.unsqueeze(0) / (self.num_levels - 1)).squeeze(0).float()
+            values[~found] = new_values
+            self._insert(new_keys, new_values)
+
+        return values[inverse]
+
+    def clear(self):
+        self.keys = self.keys[:0]
+        self.values = self.values[:0]
+        self.last_used = self.last_used[:0]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.keys),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+    def _insert(self, new_keys, new_values):
+        keys = torch.cat([self.keys, new_keys])
+        values = torch.cat([self.values, new_values])
+        last_used = torch.cat([self.last_used, torch.full_like(new_keys, self.step)])
+
+        # Least recently used vectors go first, the ones just inserted are the most recent
+        if len(keys) > self.max_entries:
+            keep = torch.argsort(last_used, descending=True, stable=True)[:self.max_entries]
+            self.evictions += len(keys) - self.max_entries
+            keys, values, last_used = keys[keep], values[keep], last_used[keep]
+
+        order = torch.argsort(keys)
+        self.keys, self.values, self.last_used = keys[order], values[order], last_used[order]
@@ -0,0 +1,119 @@
+import os
+from contextlib import nullcontext
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, DistributedSampler, Sampler
+
+
+def init_distributed(config):
+    # Joins the process group when launched by torchrun, a plain `python main.py` stays single process.
+    # Returns the device this rank trains on
+    use_cuda = not config.no_cuda and torch.cuda.is_available()
+
+    if int(os.environ.get("WORLD_SIZE", 1)) > 1 and not dist.is_initialized():
+        dist.init_process_group(backend=config.distributed_backend)
+
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    if use_cuda:
+        torch.cuda.set_device(local_rank)
+        return torch.device("cuda", local_rank)
+
+    # torchrun pins every rank to a single thread unless told otherwise, which leaves most cores idle on CPU nodes
+    if is_distributed():
+        local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+        torch.set_num_threads(config.threads_per_rank or max(1, os.cpu_count() // local_world_size))
+    return torch.device("cpu")
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def all_reduce_sum(tensor):
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+
+class ShardSampler(Sampler):
+    # Every world_size-th index starting at the rank, in order. Unlike DistributedSampler no examples are repeated
+    # to even out the shards, so sums over every rank's shard count each example exactly once
+    def __init__(self, data_set):
+        self.data_set = data_set
+        self.rank = get_rank()
+        self.world_size = get_world_size()
+
+    def __iter__(self):
+        return iter(range(self.rank, len(self.data_set), self.world_size))
+
+    def __len__(self):
+        return len(range(self.rank, len(self.data_set), self.world_size))
+
+
+def data_loader(data_set, shuffle, **kwargs):
+    # Every rank gets its own shard of the data set once the process group is up. Evaluation (unshuffled) shards
+    # may differ in length by one, so they must only be iterated outside DDP, which needs every rank to step together
+    if is_distributed():
+        sampler = DistributedSampler(data_set, shuffle=True) if shuffle else ShardSampler(data_set)
+        return DataLoader(data_set, sampler=sampler, **kwargs)
+    return DataLoader(data_set, shuffle=shuffle, **kwargs)
+
+
+def set_epoch(loader, epoch):
+    # DistributedSampler only reshuffles when told the epoch, identically on every rank
+    if isinstance(loader.sampler, DistributedSampler):
+        loader.sampler.set_epoch(epoch)
+
+
+def unsharded(loader):
+    # The whole data set in order, for passes that have to see every example on one rank
+    if not isinstance(loader.sampler, (DistributedSampler, ShardSampler)):
+        return loader
+    return DataLoader(loader.dataset, batch_size=loader.batch_size, shuffle=False, num_workers=loader.num_workers,
+                      collate_fn=loader.collate_fn, pin_memory=loader.pin_memory)
+
+
+def set_phase(model, fit_prior):
+    # Only the parameters the current phase optimises require grad, so DDP neither reduces gradients the
+    # optimiser would ignore nor waits for ones that are never produced. post_vq_conv is never used
+    for name, module in model.named_children():
+        module.requires_grad_((name == "prior") == fit_prior and name != "post_vq_conv")
+
+
+def wrap(module, config):
+    # Needs calling again after set_phase, DDP fixes the set of parameters it reduces at construction
+    if not is_distributed() or not any(param.requires_grad for param in module.parameters()):
+        return module
+    device_ids = [module.device.index] if getattr(module, "device", torch.device("cpu")).type == "cuda" else None
+    return DistributedDataParallel(module, device_ids=device_ids, find_unused_parameters=config.find_unused_parameters)
+
+
+def no_sync(network):
+    # Skips the gradient all reduce for micro-batches that only accumulate, the last one of a group reduces the sum
+    if isinstance(network, DistributedDataParallel):
+        return network.no_sync()
+    return nullcontext()
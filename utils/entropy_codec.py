@@ -0,0 +1,203 @@
+import struct
+
+import numpy as np
+import torch
+
+from utils import Normal, prior_prediction_error
+
+# 32 bit rANS state in [RANS_L, RANS_L << 16) with 16 bit words and probabilities quantised to 16 bits,
+# so at most one word is written or read per symbol and every lane of a batch can be stepped together
+PROB_BITS = 16
+PROB_SCALE = 1 << PROB_BITS
+RANS_L = 1 << 16
+WORD_BITS = np.uint64(16)
+WORD_MASK = np.uint64(0xFFFF)
+
+# magic, format version, index_dim, representation_dim, num_levels, uniform prior flag, number of images
+HEADER = struct.Struct('<4sBHHI?I')
+MAGIC = b'HVRC'
+VERSION = 1
+
+
+def quantise_probabilities(probabilities):
+    # (..., K) probabilities -> integer frequencies summing to PROB_SCALE, every symbol keeps a frequency of at least one
+    num_symbols = probabilities.shape[-1]
+    frequencies = np.floor(probabilities * (PROB_SCALE - num_symbols)).astype(np.int64) + 1
+
+    largest = probabilities.argmax(axis=-1)[..., None]
+    deficit = PROB_SCALE - frequencies.sum(axis=-1, keepdims=True)
+    np.put_along_axis(frequencies, largest, np.take_along_axis(frequencies, largest, axis=-1) + deficit, axis=-1)
+    return frequencies
+
+
+def cumulative(frequencies):
+    cumulative = np.zeros(frequencies.shape[:-1] + (frequencies.shape[-1] + 1,), dtype=np.int64)
+    np.cumsum(frequencies, axis=-1, out=cumulative[..., 1:])
+    return cumulative
+
+
+class RANSEncoder:
+    # Symbols have to be pushed in reverse decoding order
+    def __init__(self, num_lanes, max_symbols):
+        self.state = np.full(num_lanes, RANS_L, dtype=np.uint64)
+        self.words = np.zeros((num_lanes, max_symbols + 2), dtype=np.uint16)
+        self.count = np.zeros(num_lanes, dtype=np.int64)
+
+    def _emit(self, lanes, values):
+        self.words[lanes, self.count[lanes]] = values.astype(np.uint16)
+        self.count[lanes] += 1
+
+    def push(self, starts, frequencies):
+        starts = starts.astype(np.uint64)
+        frequencies = frequencies.astype(np.uint64)
+
+        overflow = np.nonzero(self.state >= (frequencies << WORD_BITS))[0]
+        self._emit(overflow, self.state[overflow] & WORD_MASK)
+        self.state[overflow] >>= WORD_BITS
+
+        self.state = ((self.state // frequencies) << np.uint64(PROB_BITS)) + self.state % frequencies + starts
+
+    def finish(self):
+        lanes = np.arange(len(self.state))
+        self._emit(lanes, self.state & WORD_MASK)
+        self._emit(lanes, self.state >> WORD_BITS)
+        # Reversed so the decoder reads each stream front to back, starting with the final state
+        return [self.words[lane, :self.count[lane]][::-1].copy() for lane in lanes]
+
+
+class RANSDecoder:
+    def __init__(self, streams):
+        length = max(len(stream) for stream in streams)
+        self.words = np.zeros((len(streams), length + 1), dtype=np.uint64)
+        for lane, stream in enumerate(streams):
+            self.words[lane, :len(stream)] = stream
+
+        self.state = (self.words[:, 0] << WORD_BITS) | self.words[:, 1]
+        self.position = np.full(len(streams), 2, dtype=np.int64)
+
+    def pop(self, frequencies, cumulative):
+        # frequencies (lanes, K) and cumulative (lanes, K + 1) describe each lane's distribution for this symbol
+        lanes = np.arange(len(self.state))
+        slot = (self.state & np.uint64(PROB_SCALE - 1)).astype(np.int64)
+        symbols = (cumulative[:, 1:] <= slot[:, None]).sum(axis=1)
+
+        frequency = frequencies[lanes, symbols].astype(np.uint64)
+        start = cumulative[lanes, symbols].astype(np.uint64)
+        self.state = frequency * (self.state >> np.uint64(PROB_BITS)) + slot.astype(np.uint64) - start
+
+        underflow = np.nonzero(self.state < RANS_L)[0]
+        self.state[underflow] = (self.state[underflow] << WORD_BITS) | self.words[underflow, self.position[underflow]]
+        self.position[underflow] += 1
+
+        return symbols
+
+
+def positions(model):
+    # Raster order over pixels with the index channels innermost, the order an autoregressive prior conditions in
+    return [(c, h, w) for h in range(model.representation_dim)
+                      for w in range(model.representation_dim)
+                      for c in range(model.index_dim)]
+
+
+def uniform_prior(model):
+    return isinstance(model.prior, Normal)
+
+
+@torch.no_grad()
+def prior_probabilities(model, z_indices_quantised, position):
+    # Distribution for one position given the grid, in which only earlier positions are filled in. Encoder and decoder
+    # both go through here with identical partial grids, so they see bit identical probabilities. The prior is always
+    # evaluated on the full grid, windowed evaluation only matches it to a tolerance and depends on the sampler's probe
+    c, h, w = position
+    logits = model.prior_logits(z_indices_quantised.float(), (h, w), windowed=False)
+    return torch.softmax(logits[:, :, c].double(), dim=1).cpu().numpy()
+
+
+def compress(model, x):
+    z_indices_quantised = model.encode(x)
+    codes = z_indices_quantised.cpu().numpy().astype(np.int64)
+    num_images = len(codes)
+    order = positions(model)
+
+    if uniform_prior(model):
+        frequencies = quantise_probabilities(np.full((1, model.num_levels), 1.0 / model.num_levels))
+        frequencies = np.broadcast_to(frequencies, (num_images, len(order), model.num_levels))
+    else:
+        frequencies = np.zeros((num_images, len(order), model.num_levels), dtype=np.int64)
+        partial = torch.zeros_like(z_indices_quantised)
+        for i, position in enumerate(order):
+            frequencies[:, i] = quantise_probabilities(prior_probabilities(model, partial, position))
+            partial[(slice(None),) + position] = z_indices_quantised[(slice(None),) + position]
+
+    symbols = np.stack([codes[(slice(None),) + position] for position in order], axis=1)
+    starts = np.take_along_axis(cumulative(frequencies), symbols[..., None], axis=-1)[..., 0]
+    symbol_frequencies = np.take_along_axis(frequencies, symbols[..., None], axis=-1)[..., 0]
+
+    encoder = RANSEncoder(num_images, len(order))
+    for i in reversed(range(len(order))):
+        encoder.push(starts[:, i], symbol_frequencies[:, i])
+    streams = encoder.finish()
+
+    header = HEADER.pack(MAGIC, VERSION, model.index_dim, model.representation_dim, model.num_levels, uniform_prior(model), num_images)
+    lengths = np.array([len(stream) for stream in streams], dtype=np.uint32)
+    return header + lengths.tobytes() + b''.join(stream.astype('<u2').tobytes() for stream in streams)
+
+
+def read_streams(data):
+    magic, version, index_dim, representation_dim, num_levels, uniform, num_images = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f'Not a version {VERSION} HopVAE compressed stream')
+
+    offset = HEADER.size
+    lengths = np.frombuffer(data, dtype=np.uint32, count=num_images, offset=offset)
+    offset += lengths.nbytes
+
+    streams = []
+    for length in lengths:
+        streams.append(np.frombuffer(data, dtype='<u2', count=int(length), offset=offset).astype(np.uint16))
+        offset += int(length) * 2
+
+    header = {"index_dim": index_dim, "representation_dim": representation_dim, "num_levels": num_levels, "uniform": uniform}
+    return header, streams
+
+
+@torch.no_grad()
+def decompress_codes(model, data):
+    header, streams = read_streams(data)
+    if (header["index_dim"], header["representation_dim"], header["num_levels"]) != (model.index_dim, model.representation_dim, model.num_levels):
+        raise ValueError('Compressed stream was produced by a model with a different latent shape')
+    if header["uniform"] != uniform_prior(model):
+        raise ValueError('Compressed stream was produced with a different prior')
+
+    num_images = len(streams)
+    shape = (num_images, model.index_dim, model.representation_dim, model.representation_dim)
+    z_indices_quantised = torch.zeros(shape, device=model.device)
+
+    decoder = RANSDecoder(streams)
+    if uniform_prior(model):
+        frequencies = quantise_probabilities(np.full((num_images, model.num_levels), 1.0 / model.num_levels))
+        cumulative_frequencies = cumulative(frequencies)
+
+    for position in positions(model):
+        if not uniform_prior(model):
+            frequencies = quantise_probabilities(prior_probabilities(model, z_indices_quantised, position))
+            cumulative_frequencies = cumulative(frequencies)
+
+        symbols = decoder.pop(frequencies, cumulative_frequencies)
+        z_indices_quantised[(slice(None),) + position] = torch.from_numpy(symbols).to(z_indices_quantised)
+
+    return z_indices_quantised
+
+
+@torch.no_grad()
+def decompress(model, data):
+    return model.decode(decompress_codes(model, data))
+
+
+@torch.no_grad()
+def estimated_bits_per_code(model, z_indices_quantised):
+    # What forward() reports as z_prediction_error, the uniform prior always costs log2(num_levels)
+    if uniform_prior(model):
+        return float(np.log2(model.num_levels))
+    z_pred = model.prior(z_indices_quantised.float())
+    return prior_prediction_error(z_pred.float(), z_indices_quantised).item()
@@ -0,0 +1,184 @@
+import copy
+import inspect
+import os
+from contextlib import contextmanager
+
+import torch
+import torch.nn as nn
+
+
+def export_lookups(model, fused=True, top_k=None):
+    # Hopfield lookups for the exported graphs, the fused versions are a layer_norm, two matmuls and a softmax,
+    # which every graph runtime supports, while the eager hflayers modules only trace as far as TorchScript
+    lookups = model.fuse_lookups(top_k) if fused else {}
+    return {name: lookups.get(name) or copy.deepcopy(getattr(model, name))
+            for name in ("hopfield", "embedding_to_index", "index_to_embedding")}
+
+
+class HopVAEEncoder(nn.Module):
+    # Encoder -> pre_vq_conv -> hopfield -> embedding_to_index -> quantise, images to integer codes
+    def __init__(self, model, lookups):
+        super(HopVAEEncoder, self).__init__()
+
+        self.representation_dim = model.representation_dim
+        self.embedding_dim = model.embedding_dim
+        self.index_dim = model.index_dim
+        self.num_levels = model.num_levels
+
+        self.encoder = copy.deepcopy(model.encoder).to(memory_format=torch.contiguous_format)
+        self.pre_vq_conv = copy.deepcopy(model.pre_vq_conv).to(memory_format=torch.contiguous_format)
+        self.hopfield = lookups["hopfield"]
+        self.embedding_to_index = lookups["embedding_to_index"]
+
+    def forward(self, x):
+        z = self.pre_vq_conv(self.encoder(x))
+        z = z.permute(0, 2, 3, 1).reshape(-1, self.representation_dim * self.representation_dim, self.embedding_dim)
+
+        z_embeddings = self.hopfield(z)
+        z_indices = torch.sigmoid(self.embedding_to_index(z_embeddings))
+        z_indices_quantised = torch.round(z_indices * (self.num_levels - 1))
+
+        z_indices_quantised = z_indices_quantised.view(-1, self.representation_dim, self.representation_dim, self.index_dim)
+        return z_indices_quantised.permute(0, 3, 1, 2).to(torch.int64)
+
+
+class HopVAEDecoder(nn.Module):
+    # index_to_embedding -> Decoder, integer codes to images
+    def __init__(self, model, lookups):
+        super(HopVAEDecoder, self).__init__()
+
+        self.representation_dim = model.representation_dim
+        self.embedding_dim = model.embedding_dim
+        self.index_dim = model.index_dim
+        self.num_levels = model.num_levels
+
+        self.index_to_embedding = lookups["index_to_embedding"]
+        self.decoder = copy.deepcopy(model.decoder).to(memory_format=torch.contiguous_format)
+
+    def forward(self, z_indices_quantised):
+        z_indices = z_indices_quantised.float() / (self.num_levels - 1)
+        z_indices = z_indices.permute(0, 2, 3, 1).reshape(-1, self.representation_dim * self.representation_dim, self.index_dim)
+
+        z_embeddings = self.index_to_embedding(z_indices)
+
+        z_embeddings = z_embeddings.view(-1, self.representation_dim, self.representation_dim, self.embedding_dim)
+        return self.decoder(z_embeddings.permute(0, 3, 1, 2))
+
+
+def split_model(model, fused=True, top_k=None):
+    # Standalone fp32 encode and decode halves, the model itself is left untouched
+    lookups = export_lookups(model, fused, top_k)
+    encoder = HopVAEEncoder(model, lookups).float().eval()
+    decoder = HopVAEDecoder(model, lookups).float().eval()
+    return encoder.requires_grad_(False), decoder.requires_grad_(False)
+
+
+def export_torchscript(module, example, path):
+    with torch.no_grad():
+        traced = torch.jit.trace(module, example)
+    traced.save(path)
+    return torch.jit.load(path)
+
+
+def export_onnx(module, example, path, input_name, output_name, opset_version=17):
+    # The batch dimension is left dynamic, everything else is fixed by the config
+    # Newer torch defaults to the dynamo exporter, the TorchScript based one handles dynamic_axes on every version
+    kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        kwargs["dynamo"] = False
+
+    with torch.no_grad():
+        torch.onnx.export(module, (example,), path,
+                          input_names=[input_name], output_names=[output_name],
+                          dynamic_axes={input_name: {0: "batch"}, output_name: {0: "batch"}},
+                          opset_version=opset_version, **kwargs)
+
+
+def onnx_runner(path):
+    # None when onnxruntime is not installed, parity of the ONNX files is then not checked
+    try:
+        import onnxruntime
+    except ImportError:
+        return None
+
+    session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+    input_name = session.get_inputs()[0].name
+
+    def run(x):
+        return torch.from_numpy(session.run(None, {input_name: x.cpu().numpy()})[0])
+    return run
+
+
+@contextmanager
+def reference_model(model, top_k):
+    # The eager model as the exports run it, put back as it was afterwards. Sparse lookups are an approximation,
+    # so it runs the same ones. The graphs are fp32 (split_model), so autocast is off even for a mixed precision
+    # model. Its decode caches are detached, parity decodes neither read nor fill them and compile_lookups can not clear them
+    state = model.fused_lookups, model.mixed_precision, model.decode_cache, model.embedding_cache
+    model.mixed_precision = False
+    model.decode_cache, model.embedding_cache = None, None
+    try:
+        if top_k is not None:
+            model.compile_lookups(top_k)
+        yield model
+    finally:
+        model.release_lookups()
+        model.fused_lookups, model.mixed_precision, model.decode_cache, model.embedding_cache = state
+
+
+def parity(model, run_encoder, run_decoder, x):
+    # Codes are compared by agreement since a value on a rounding boundary may land either side, images by
+    # their largest difference after decoding the eager model's own codes so one flipped code does not count twice
+    with torch.no_grad():
+        z_indices_quantised = model.encode(x).long().cpu()
+        x_recon = model.decode(z_indices_quantised.to(model.device)).cpu()
+
+        exported_codes = run_encoder(x.cpu())
+        exported_recon = run_decoder(z_indices_quantised)
+
+    return {
+        "code_agreement": (exported_codes == z_indices_quantised).float().mean().item(),
+        "decode_max_abs_error": (exported_recon - x_recon).abs().max().item()
+    }
+
+
+def export_model(model, config, directory, formats=("torchscript", "onnx"), fused=True, top_k=None,
+                 trace_batch_size=2, check_batch_size=5, min_agreement=0.999, atol=1e-3):
+    # Writes encoder and decoder graphs to directory and checks them against the eager model on a batch size
+    # other than the traced one, so a batch dimension baked into the graph is caught. Raises when parity fails
+    os.makedirs(directory, exist_ok=True)
+    model.eval()
+    encoder, decoder = split_model(model, fused, top_k)
+
+    x_trace = torch.randn(trace_batch_size, config.num_channels, config.image_size, config.image_size)
+    x_check = torch.randn(check_batch_size, config.num_channels, config.image_size, config.image_size)
+    with torch.no_grad():
+        codes_trace = encoder(x_trace)
+
+    report = {}
+    for export_format in formats:
+        encoder_path = os.path.join(directory, f'encoder.{"pt" if export_format == "torchscript" else "onnx"}')
+        decoder_path = os.path.join(directory, f'decoder.{"pt" if export_format == "torchscript" else "onnx"}')
+
+        if export_format == "torchscript":
+            run_encoder = export_torchscript(encoder, x_trace, encoder_path)
+            run_decoder = export_torchscript(decoder, codes_trace, decoder_path)
+        elif export_format == "onnx":
+            export_onnx(encoder, x_trace, encoder_path, "images", "codes")
+            export_onnx(decoder, codes_trace, decoder_path, "codes", "images")
+            run_encoder, run_decoder = onnx_runner(encoder_path), onnx_runner(decoder_path)
+        else:
+            raise ValueError(f'Unknown export format {export_format}')
+
+        report[export_format] = {"encoder": encoder_path, "decoder": decoder_path}
+        if run_encoder is None:
+            continue
+
+        with reference_model(model, top_k):
+            result = parity(model, run_encoder, run_decoder, x_check)
+
+        report[export_format].update(result)
+        if result["code_agreement"] < min_agreement or result["decode_max_abs_error"] > atol:
+            raise RuntimeError(f'{export_format} export does not match the eager model: {result}')
+
+    return report
@@ -0,0 +1,90 @@
+import warnings
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class FusedHopfieldLookup(nn.Module):
+    # Inference only replacement for a HopfieldLayer with static stored and state patterns. The stored patterns
+    # are fixed lookup weights, so their normalisation and value projections are computed once here instead of
+    # per batch element on every call, leaving a single layer_norm -> matmul -> softmax -> matmul per lookup.
+    def __init__(self, layer, top_k=None):
+        super(FusedHopfieldLookup, self).__init__()
+
+        hopfield = layer.hopfield
+        core = hopfield.association_core
+        stored_pattern = layer.lookup_weights.detach()[0]
+        input_size = stored_pattern.size(-1)
+
+        scaling = getattr(hopfield, '_Hopfield__scaling', None)
+        if scaling is None:
+            # Static queries and keys use a single head of size input_size
+            scaling = input_size ** -0.5
+
+        with torch.no_grad():
+            keys = stored_pattern
+            if hopfield.norm_stored_pattern is not None:
+                keys = hopfield.norm_stored_pattern(keys)
+
+            values = stored_pattern
+            if hopfield.norm_pattern_projection is not None:
+                values = hopfield.norm_pattern_projection(values)
+            values = F.linear(values, core.in_proj_weight, core.in_proj_bias)
+            # Softmax weights sum to one, so the affine output projection can be folded into every value
+            if getattr(core, 'out_proj', None) is not None:
+                values = core.out_proj(values)
+
+            keys = keys * scaling
+            key_bias = None
+
+            # An affine query normalisation is folded into the key projection as well
+            norm_state_pattern = hopfield.norm_state_pattern
+            if norm_state_pattern is not None and norm_state_pattern.weight is not None:
+                key_bias = keys @ norm_state_pattern.bias if norm_state_pattern.bias is not None else None
+                keys = keys * norm_state_pattern.weight
+
+        self.input_size = input_size
+        self.normalise_query = norm_state_pattern is not None
+        self.eps = norm_state_pattern.eps if norm_state_pattern is not None else 0.0
+        self.top_k = top_k
+
+        self.keys = nn.Linear(input_size, keys.size(0), bias=key_bias is not None)
+        self.values = nn.Linear(values.size(0), values.size(1), bias=False)
+        self.requires_grad_(False)
+
+        with torch.no_grad():
+            self.keys.weight.copy_(keys)
+            if key_bias is not None:
+                self.keys.bias.copy_(key_bias)
+            self.values.weight.copy_(values.t())
+
+    def forward(self, query):
+        if self.normalise_query:
+            # A constant shape rather than query.shape keeps the lookup exportable to ONNX
+            query = F.layer_norm(query, (self.input_size,), eps=self.eps)
+
+        logits = self.keys(query)
+
+        if self.top_k is None or self.top_k >= logits.size(-1):
+            return self.values(torch.softmax(logits, dim=-1))
+
+        # Sparse retrieval, only the top_k best matching patterns get a non zero weight
+        top_logits, indices = logits.topk(self.top_k, dim=-1)
+        weights = torch.zeros_like(logits).scatter_(-1, indices, torch.softmax(top_logits, dim=-1))
+        return self.values(weights)
+
+
+def fuse_lookup(layer, query, top_k=None, atol=1e-4):
+    # Returns None when the fused lookup does not reproduce the layer, e.g. for hflayers options it does not model
+    fused = FusedHopfieldLookup(layer, top_k=None).to(query.device)
+
+    with torch.no_grad():
+        difference = (fused(query) - layer(query)).abs().max().item()
+
+    if difference > atol:
+        warnings.warn(f'Fused Hopfield lookup differs from the layer by {difference:.2e}, keeping the layer')
+        return None
+
+    fused.top_k = top_k
+    return fused
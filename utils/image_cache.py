@@ -0,0 +1,117 @@
+import os
+import numpy as np
+import torch
+from torch.utils.data import Dataset, random_split
+
+import torchvision
+from torchvision import transforms
+
+
+def image_cache_dir(config):
+    return os.path.join(config.cache_dir, f'{config.data_set}-{config.image_size}', 'images')
+
+
+def get_source_sets(config, PATH):
+    # Images are resized once here and stored as uint8, normalisation happens at read time
+    transform = transforms.Compose([
+            transforms.Resize(config.image_size),
+            transforms.PILToTensor()
+        ])
+
+    if config.data_set == "MNIST":
+        train_set = torchvision.datasets.MNIST(root=PATH, train=True, download=True, transform=transform)
+        test_set = torchvision.datasets.MNIST(root=PATH, train=False, download=True, transform=transform)
+
+    elif config.data_set == "CIFAR10":
+        train_set = torchvision.datasets.CIFAR10(root=PATH, train=True, download=True, transform=transform)
+        test_set = torchvision.datasets.CIFAR10(root=PATH, train=False, download=True, transform=transform)
+
+    elif config.data_set == "FFHQ":
+        dataset = torchvision.datasets.ImageFolder(PATH, transform=transform)
+        lengths = [int(len(dataset)*0.7), int(len(dataset)*0.1), int(len(dataset)*0.2)]
+        lengths[0] += len(dataset) - sum(lengths)
+        generator = torch.Generator().manual_seed(config.seed)
+        train_split, val_split, test_split = random_split(range(len(dataset)), lengths, generator=generator)
+
+        split = {"train": np.asarray(train_split.indices), "val": np.asarray(val_split.indices), "test": np.asarray(test_split.indices)}
+        return [dataset], split
+
+    # The torchvision sets have no separate validation split, so as before val and test share the test set
+    test_indices = np.arange(len(train_set), len(train_set) + len(test_set))
+    split = {"train": np.arange(len(train_set)), "val": test_indices, "test": test_indices}
+    return [train_set, test_set], split
+
+
+def build_image_cache(config, PATH):
+    directory = image_cache_dir(config)
+    os.makedirs(directory, exist_ok=True)
+
+    source_sets, split = get_source_sets(config, PATH)
+    num_images = sum(len(source_set) for source_set in source_sets)
+
+    images_path = os.path.join(directory, 'images.npy')
+    shape = (num_images, config.num_channels, config.image_size, config.image_size)
+    images = np.lib.format.open_memmap(images_path + '.tmp', mode='w+', dtype=np.uint8, shape=shape)
+    labels = np.empty(num_images, dtype=np.int64)
+
+    start = 0
+    for source_set in source_sets:
+        # Decoding and resizing is the slow part, so it is spread over worker processes
+        loader = torch.utils.data.DataLoader(source_set, batch_size=256, shuffle=False, num_workers=os.cpu_count() or 0)
+        for X, y in loader:
+            images[start:start + X.size(0)] = X.numpy()
+            labels[start:start + X.size(0)] = y.numpy()
+            start += X.size(0)
+
+    images.flush()
+    del images
+
+    np.save(os.path.join(directory, 'labels.npy'), labels)
+    np.savez(os.path.join(directory, 'split.npz'), **split)
+    # Written last so a partially built cache is never picked up
+    os.replace(images_path + '.tmp', images_path)
+
+    return directory
+
+
+class CachedImageDataset(Dataset):
+    def __init__(self, directory, split, transform=None):
+        self.directory = directory
+        self.transform = transform
+
+        self.indices = np.load(os.path.join(directory, 'split.npz'))[split]
+        self.labels = np.load(os.path.join(directory, 'labels.npy'))
+        self._images = None
+
+    @property
+    def images(self):
+        # Opened lazily so each DataLoader worker maps the file itself rather than receiving a pickled copy,
+        # copy on write mode gives writable arrays that torch can wrap without copying
+        if self._images is None:
+            self._images = np.load(os.path.join(self.directory, 'images.npy'), mmap_mode='c')
+        return self._images
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_images'] = None
+        return state
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        index = self.indices[index]
+        image = torch.from_numpy(self.images[index])
+
+        if self.transform is not None:
+            image = self.transform(image)
+
+        return image, int(self.labels[index])
+
+
+def get_cached_data_sets(config, PATH, transform=None):
+    directory = image_cache_dir(config)
+    if not os.path.exists(os.path.join(directory, 'images.npy')):
+        build_image_cache(config, PATH)
+
+    return [CachedImageDataset(directory, split, transform) for split in ('train', 'val', 'test')]
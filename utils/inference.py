@@ -0,0 +1,126 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from utils import NORMALISATION, load_from_checkpoint
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".webp")
+
+
+def load_model(config, checkpoint_location, device):
+    # Eval mode HopVAE with the fused lookups compiled when the config asks for them
+    from HopVAE import HopVAE
+
+    if not os.path.exists(checkpoint_location):
+        raise FileNotFoundError(f'No checkpoint at {checkpoint_location}')
+
+    model = HopVAE(config, device).to(device)
+    model = load_from_checkpoint(model, checkpoint_location)
+    model.eval()
+
+    if config.fused_lookups:
+        model.compile_lookups(top_k=config.lookup_top_k)
+    if config.decode_cache_mb or config.embedding_cache_entries:
+        model.enable_decode_cache(int(config.decode_cache_mb * 2**20), config.embedding_cache_entries)
+    return model
+
+
+def list_images(directory):
+    # Paths relative to directory, sorted so the order of a code file is reproducible
+    paths = []
+    for root, _, names in os.walk(directory):
+        for name in names:
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.relpath(os.path.join(root, name), directory))
+    return sorted(paths)
+
+
+def load_image(path, config, resize=True):
+    # Same pixels as get_transforms, but with PIL and plain tensor ops so torchvision is never imported.
+    # resize=False keeps the native resolution for the tiled model methods
+    from PIL import Image
+
+    with Image.open(path) as image:
+        image = image.convert("L" if config.num_channels == 1 else "RGB")
+        x = torch.from_numpy(np.asarray(image, dtype=np.uint8).copy())
+
+    x = x.view(x.size(0), x.size(1), -1).permute(2, 0, 1).float() / 255
+    if resize and tuple(x.shape[1:]) != (config.image_size, config.image_size):
+        x = F.interpolate(x[None], size=(config.image_size, config.image_size), mode="bilinear", antialias=True, align_corners=False)[0]
+    return x
+
+
+def normalise(x, config):
+    mean, std = NORMALISATION[config.data_set]
+    mean = torch.tensor(mean, device=x.device).view(1, -1, 1, 1)
+    std = torch.tensor(std, device=x.device).view(1, -1, 1, 1)
+    return (x - mean) / std
+
+
+def denormalise(x, config):
+    mean, std = NORMALISATION[config.data_set]
+    mean = torch.tensor(mean, device=x.device).view(1, -1, 1, 1)
+    std = torch.tensor(std, device=x.device).view(1, -1, 1, 1)
+    return x * std + mean
+
+
+def iter_image_batches(directory, paths, config, batch_size, num_threads=4):
+    # Yields (paths, normalised batch), decoding up to num_threads batches ahead of the one being processed
+    def load_batch(batch_paths):
+        x = torch.stack([load_image(os.path.join(directory, path), config) for path in batch_paths])
+        return batch_paths, normalise(x, config)
+
+    batches = (paths[start:start + batch_size] for start in range(0, len(paths), batch_size))
+    with ThreadPoolExecutor(num_threads) as pool:
+        pending = deque()
+        for batch_paths in batches:
+            pending.append(pool.submit(load_batch, batch_paths))
+            if len(pending) > num_threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def save_image(x, path):
+    from PIL import Image
+
+    image = x.mul(255).round().clamp(0, 255).to(torch.uint8).permute(1, 2, 0).cpu().numpy()
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    Image.fromarray(image[:, :, 0] if image.shape[2] == 1 else image).save(path)
+
+
+class ImageWriter:
+    # Writes denormalised batches as PNGs from a thread pool so encoding the next batch is not held up by disk
+    def __init__(self, directory, config, num_threads=4):
+        self.directory = directory
+        self.config = config
+        self._pool = ThreadPoolExecutor(num_threads)
+        self._futures = []
+
+    def write(self, x, names):
+        x = denormalise(x.float(), self.config).clamp(0, 1).cpu()
+        for image, name in zip(x, names):
+            path = os.path.join(self.directory, os.path.splitext(name)[0] + ".png")
+            self._futures.append(self._pool.submit(save_image, image, path))
+        # Surface write errors early and keep the list of futures short
+        done = [future for future in self._futures if future.done()]
+        for future in done:
+            future.result()
+            self._futures.remove(future)
+
+    def close(self):
+        for future in self._futures:
+            future.result()
+        self._futures = []
+        self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
@@ -0,0 +1,75 @@
+import os
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from utils.distributed import barrier, data_loader, is_main_process, unsharded
+
+
+def code_dtype(num_levels):
+    # Smallest unsigned integer type able to hold every quantised level
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if num_levels - 1 <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def latent_cache_path(config, split):
+    return os.path.join(config.latent_cache_dir or config.cache_dir, f'{config.data_set}-{config.image_size}', f'latents-{split}.npy')
+
+
+def extract_latents(model, loader, path):
+    loader = unsharded(loader)
+    was_training = model.training
+    model.eval()
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+
+    shape = (len(loader.dataset), model.index_dim, model.representation_dim, model.representation_dim)
+    codes = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=code_dtype(model.num_levels), shape=shape)
+
+    start = 0
+    with torch.no_grad():
+        for X, _ in loader:
+            z_indices_quantised = model.encode(X.to(model.device))
+            codes[start:start + z_indices_quantised.size(0)] = z_indices_quantised.cpu().numpy()
+            start += z_indices_quantised.size(0)
+
+    codes.flush()
+    del codes
+    # Only a fully written cache is ever visible under the final name
+    os.replace(tmp_path, path)
+
+    model.train(was_training)
+    return path
+
+
+class LatentDataset(Dataset):
+    def __init__(self, path):
+        self.codes = np.load(path, mmap_mode='r')
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def __getitem__(self, index):
+        # Second element mirrors the (X, label) pairs of the image loaders
+        return torch.from_numpy(self.codes[index].astype(np.int64)), 0
+
+
+def get_latent_loaders(config, model, loaders, splits=('train', 'val', 'test'), rebuild=True):
+    # One latent loader per image loader, loaders[i] being the splits[i] split. Only those splits are encoded and cached.
+    # Only the main process writes the caches, the other ranks wait and then read their shard of them
+    if len(loaders) != len(splits):
+        raise ValueError(f'Got {len(loaders)} loaders for the splits {", ".join(splits)}')
+
+    latent_loaders = []
+    for split, loader in zip(splits, loaders):
+        path = latent_cache_path(config, split)
+        if is_main_process() and (rebuild or not os.path.exists(path)):
+            extract_latents(model, loader, path)
+        barrier()
+
+        latent_loaders.append(data_loader(LatentDataset(path), shuffle=split == 'train', batch_size=config.batch_size))
+
+    return latent_loaders
@@ -0,0 +1,213 @@
+import os
+
+import numpy as np
+import torch
+
+# Pooled keys are the mean retrieved pattern of an image, grid keys every position's pattern concatenated,
+# which only matches images that also agree spatially. Both are L2 normalised so inner product is cosine similarity
+KINDS = ("pooled", "grid")
+DTYPES = {"pooled": np.float32, "grid": np.float16}
+
+
+def index_path(directory, kind):
+    return os.path.join(directory, f'{kind}.npy')
+
+
+def ivf_path(directory, kind):
+    return os.path.join(directory, f'ivf-{kind}.npz')
+
+
+def normalise(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+
+def embedding_keys(model, x, kinds=KINDS):
+    # (N, embedding_dim) pooled and (N, H * W * embedding_dim) grid keys from the hopfield retrievals
+    with torch.no_grad():
+        z_embeddings = model.embed(x)
+
+    keys = {}
+    if "pooled" in kinds:
+        keys["pooled"] = normalise(z_embeddings.mean(dim=1).cpu().numpy())
+    if "grid" in kinds:
+        keys["grid"] = normalise(z_embeddings.flatten(1).cpu().numpy())
+    return keys
+
+
+def build_index(model, batches, num_images, directory, kinds=KINDS):
+    # Streams (N, C, H, W) image batches through the model once, writing every kind of key straight into a
+    # memory mapped array so the data set never has to fit in memory. Same tmp then rename scheme as the latent cache
+    was_training = model.training
+    model.eval()
+    os.makedirs(directory, exist_ok=True)
+
+    num_positions = model.representation_dim * model.representation_dim
+    dims = {"pooled": model.embedding_dim, "grid": num_positions * model.embedding_dim}
+    arrays = {
+        kind: np.lib.format.open_memmap(index_path(directory, kind) + '.tmp', mode='w+', dtype=DTYPES[kind], shape=(num_images, dims[kind]))
+        for kind in kinds
+    }
+
+    start = 0
+    for x in batches:
+        for kind, keys in embedding_keys(model, x.to(model.device), kinds).items():
+            arrays[kind][start:start + len(keys)] = keys
+        start += x.size(0)
+
+    if start != num_images:
+        raise ValueError(f'Expected {num_images} images but the batches held {start}')
+
+    for kind, array in arrays.items():
+        array.flush()
+        del array
+        os.replace(index_path(directory, kind) + '.tmp', index_path(directory, kind))
+
+    model.train(was_training)
+    return directory
+
+
+def top_k(scores, k):
+    # Unordered column indices of the k highest scores per row
+    if scores.shape[1] <= k:
+        return np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    return np.argpartition(-scores, k - 1, axis=1)[:, :k]
+
+
+def merge_top_k(scores, indices, chunk_scores, chunk_indices, k):
+    # Keeps the k best scores per query across the running best and a chunk of rows chunk_indices. The chunk is
+    # reduced to its own k best first so only 2k candidates per query are ever merged
+    best = top_k(chunk_scores, k)
+    scores = np.concatenate([scores, np.take_along_axis(chunk_scores, best, axis=1)], axis=1)
+    indices = np.concatenate([indices, chunk_indices[best]], axis=1)
+    best = top_k(scores, k)
+    return np.take_along_axis(scores, best, axis=1), np.take_along_axis(indices, best, axis=1)
+
+
+def sort_results(scores, indices):
+    order = np.argsort(-scores, axis=1, kind='stable')
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+
+def kmeans(vectors, num_clusters, iterations=20, seed=0):
+    # Spherical k-means, centroids stay unit length so assignment is a single matrix product
+    if not 1 <= num_clusters <= len(vectors):
+        raise ValueError(f'Can not form {num_clusters} clusters from {len(vectors)} vectors')
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), num_clusters, replace=False)].astype(np.float32)
+
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        counts = np.bincount(assignment, minlength=num_clusters)
+
+        # Empty clusters are restarted on random vectors
+        empty = counts == 0
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+        centroids = normalise(sums)
+
+    return centroids
+
+
+class LatentIndex:
+    # k nearest neighbour search over one kind of key written by build_index. Exact search streams the memory map
+    # in chunks of matrix products, approximate search (train_ivf) only scores the nprobe closest k-means lists
+    def __init__(self, directory, kind="pooled", chunk_size=65536):
+        self.directory = directory
+        self.kind = kind
+        self.chunk_size = chunk_size
+        self.vectors = np.load(index_path(directory, kind), mmap_mode='r')
+
+        self.centroids = None
+        self.order = None
+        self.offsets = None
+        if os.path.exists(ivf_path(directory, kind)):
+            self._load_ivf()
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def search(self, queries, k=10, nprobe=None):
+        # (Q, D) normalised queries -> (Q, k) cosine similarities and row indices, best first.
+        # nprobe=None searches exhaustively, otherwise the inverted lists from train_ivf are used
+        queries = normalise(queries)
+        if nprobe is None or self.centroids is None:
+            return self.search_exact(queries, k)
+        return self.search_ivf(queries, k, nprobe)
+
+    def search_exact(self, queries, k=10):
+        scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        indices = np.zeros((len(queries), 0), dtype=np.int64)
+
+        for start in range(0, len(self.vectors), self.chunk_size):
+            chunk = np.asarray(self.vectors[start:start + self.chunk_size], dtype=np.float32)
+            scores, indices = merge_top_k(scores, indices, queries @ chunk.T, np.arange(start, start + len(chunk)), k)
+
+        return sort_results(scores, indices)
+
+    def train_ivf(self, num_lists=None, iterations=20, sample_size=100000, seed=0):
+        # Coarse quantiser for approximate search. Vectors are grouped by their nearest centroid and stored as one
+        # permutation with list offsets, so a list is a contiguous slice of the permutation
+        num_lists = num_lists or max(1, int(np.sqrt(len(self.vectors))))
+        # Centroids are seeded from distinct vectors of the sample, so there can be at most one list per sampled vector
+        sample_size = min(sample_size, len(self.vectors))
+        if num_lists > sample_size:
+            raise ValueError(f'{num_lists} IVF lists need at least as many vectors, the index samples {sample_size} of {len(self.vectors)}')
+        rng = np.random.default_rng(seed)
+        sample = rng.choice(len(self.vectors), sample_size, replace=False)
+        centroids = kmeans(np.asarray(self.vectors[np.sort(sample)], dtype=np.float32), num_lists, iterations, seed)
+
+        assignment = np.empty(len(self.vectors), dtype=np.int64)
+        for start in range(0, len(self.vectors), self.chunk_size):
+            chunk = np.asarray(self.vectors[start:start + self.chunk_size], dtype=np.float32)
+            assignment[start:start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+
+        order = np.argsort(assignment, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=num_lists))])
+        np.savez(ivf_path(self.directory, self.kind), centroids=centroids, order=order, offsets=offsets)
+        self._load_ivf()
+
+    def search_ivf(self, queries, k=10, nprobe=8):
+        # Lists are visited once each, in order, and scored against every query probing them in one matrix product
+        nprobe = min(nprobe, len(self.centroids))
+        probes = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+
+        scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        indices = np.zeros((len(queries), 0), dtype=np.int64)
+        probing = [[] for _ in range(len(self.centroids))]
+        for i, j in zip(np.repeat(np.arange(len(queries)), nprobe), probes.ravel()):
+            probing[j].append(i)
+
+        for j, rows in enumerate(probing):
+            if not rows or self.offsets[j] == self.offsets[j + 1]:
+                continue
+            # Sorted members keep the memory map reads sequential
+            members = np.sort(self.order[self.offsets[j]:self.offsets[j + 1]])
+            rows = np.array(rows)
+            list_scores = queries[rows] @ np.asarray(self.vectors[members], dtype=np.float32).T
+            merged = merge_top_k(scores[rows], indices[rows], list_scores, members, k)
+
+            # Queries gain candidates at different rates, the running best is widened to k with empty slots
+            if merged[0].shape[1] > scores.shape[1]:
+                width = merged[0].shape[1] - scores.shape[1]
+                scores = np.pad(scores, ((0, 0), (0, width)), constant_values=-np.inf)
+                indices = np.pad(indices, ((0, 0), (0, width)), constant_values=-1)
+            scores[rows, :merged[0].shape[1]], indices[rows, :merged[0].shape[1]] = merged
+
+        # Queries whose probed lists hold fewer than k vectors are padded with -inf scores and index -1
+        scores = np.pad(scores, ((0, 0), (0, k - scores.shape[1])), constant_values=-np.inf)
+        indices = np.pad(indices, ((0, 0), (0, k - indices.shape[1])), constant_values=-1)
+        return sort_results(scores, indices)
+
+    def _load_ivf(self):
+        ivf = np.load(ivf_path(self.directory, self.kind))
+        self.centroids = ivf["centroids"]
+        self.order = ivf["order"]
+        self.offsets = ivf["offsets"]
+
+
+def recall(exact_indices, approximate_indices):
+    # Fraction of the exact k nearest neighbours the approximate search also returned
+    hits = [len(np.intersect1d(exact, approximate)) for exact, approximate in zip(exact_indices, approximate_indices)]
+    return sum(hits) / exact_indices.size
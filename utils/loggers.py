@@ -0,0 +1,136 @@
+import json
+import numbers
+import os
+import queue
+import threading
+import time
+
+import torch
+
+from utils.distributed import is_main_process
+
+
+class Logger:
+    # Does nothing, ranks other than the main process log through this
+    def log(self, metrics, images=None):
+        pass
+
+    def watch(self, model):
+        pass
+
+    def close(self):
+        pass
+
+
+class WandbLogger(Logger):
+    # The original wandb backend, images are converted to wandb.Image on the calling thread
+    def __init__(self, config, project="Hop-VAE"):
+        import wandb
+
+        self._wandb = wandb
+        wandb.init(project=project, config=config.__dict__)
+
+    def log(self, metrics, images=None):
+        metrics = dict(metrics)
+        for name, x in (images or {}).items():
+            metrics[name] = [self._wandb.Image(image) for image in x]
+        self._wandb.log(metrics)
+
+    def watch(self, model):
+        self._wandb.watch(model, log="all")
+
+    def close(self):
+        self._wandb.finish()
+
+
+class LocalLogger(Logger):
+    # Append only store under directory: config.json, one JSON line per log call in metrics.jsonl and a PNG grid
+    # per image batch in images/. A background thread does the writing, so logging only costs copying images to the
+    # host, and a bounded queue applies back pressure if the disk cannot keep up
+    def __init__(self, directory, config=None, max_pending=16):
+        self.directory = directory
+        self.step = 0
+        # Most recent value of every metric, for summaries once a run ends
+        self.latest = {}
+
+        os.makedirs(os.path.join(directory, "images"), exist_ok=True)
+        if config is not None:
+            with open(os.path.join(directory, "config.json"), "w") as f:
+                json.dump(config.__dict__, f, indent=2, default=str)
+
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def log(self, metrics, images=None):
+        self._raise_error()
+        metrics = {name: to_number(value) for name, value in metrics.items()}
+        images = {name: x.detach().float().cpu() for name, x in (images or {}).items()}
+        self.latest.update(metrics)
+
+        self._queue.put((self.step, time.time(), metrics, images))
+        self.step += 1
+
+    def wait(self):
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        self.wait()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _worker(self):
+        with open(os.path.join(self.directory, "metrics.jsonl"), "a") as f:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    self._queue.task_done()
+                    return
+
+                step, timestamp, metrics, images = item
+                try:
+                    record = {"step": step, "time": timestamp, **metrics}
+                    if images:
+                        record["images"] = {name: self._write_images(step, name, x) for name, x in images.items()}
+                    f.write(json.dumps(record) + "\n")
+                    f.flush()
+                except Exception as error:
+                    self._error = error
+                finally:
+                    self._queue.task_done()
+
+    def _write_images(self, step, name, x):
+        from torchvision.utils import make_grid
+
+        from utils.inference import save_image
+
+        path = os.path.join("images", f'{step:06d}-{name.lower().replace(" ", "-")}.png')
+        # Each grid is min-max scaled on its own, like wandb does for float images
+        save_image(make_grid(x, nrow=8, normalize=True), os.path.join(self.directory, path))
+        return path
+
+
+def to_number(value):
+    if isinstance(value, torch.Tensor):
+        return value.item()
+    if isinstance(value, numbers.Number):
+        return value
+    return float(value)
+
+
+def get_logger(config, directory=None):
+    # config.logger picks the backend, only the main process of a distributed run logs anything
+    if not is_main_process():
+        return Logger()
+    if config.logger == "local":
+        return LocalLogger(directory or config.output_dir, config)
+    if config.logger == "wandb":
+        return WandbLogger(config)
+    raise ValueError(f'Unknown logger {config.logger}, expected "wandb" or "local"')
@@ -0,0 +1,46 @@
+import torch
+
+from utils.distributed import all_reduce_sum, is_distributed
+
+
+class MetricsAccumulator:
+    # Running sums stay on the device as tensors, reading them is the only point that synchronises with the host
+    def __init__(self):
+        self._sums = {}
+        self._counts = {}
+
+    def add(self, name, value, count=1):
+        value = value.detach().float()
+        if name in self._sums:
+            self._sums[name] += value
+        else:
+            self._sums[name] = value.clone()
+        self._counts[name] = self._counts.get(name, 0) + count
+
+    def sums(self):
+        if not self._sums:
+            return {}
+        names = list(self._sums)
+        values = torch.stack([self._sums[name] for name in names]).tolist()
+        return dict(zip(names, values))
+
+    def all_reduce(self):
+        # Sums and counts over every rank, every rank has to call this at the same point. A no-op without a process group
+        if not is_distributed() or not self._sums:
+            return
+        names = list(self._sums)
+        sums = all_reduce_sum(torch.stack([self._sums[name] for name in names]))
+        counts = all_reduce_sum(torch.tensor([self._counts[name] for name in names], dtype=torch.float64, device=sums.device))
+        for name, total, count in zip(names, sums, counts.tolist()):
+            self._sums[name] = total
+            self._counts[name] = int(count)
+
+    def means(self):
+        return {name: total / self._counts[name] for name, total in self.sums().items()}
+
+    def reset(self):
+        self._sums = {}
+        self._counts = {}
+
+    def __len__(self):
+        return len(self._sums)
@@ -0,0 +1,140 @@
+import warnings
+
+import torch
+
+
+class PriorSampler:
+    # Batched ancestral sampling for autoregressive (PixelCNN style) priors over the latent grid.
+    #
+    # The prior is treated as a black box: its dependency structure is probed once through gradients, giving
+    # how many rows above and columns either side a position can see and whether the index channels of a
+    # pixel condition on each other. Each step then only evaluates the prior on the window the newly
+    # sampled position can affect rather than the whole grid, and samples every channel of a pixel at
+    # once when they are independent. The probe grids come from a generator of their own seeded with seed, so
+    # probing is repeatable and leaves the global RNG untouched.
+    def __init__(self, prior, config, windowed=True, num_probes=3, seed=0):
+        self.prior = prior
+        self.index_dim = config.index_dim
+        self.representation_dim = config.representation_dim
+        self.num_levels = config.num_levels
+        self.windowed = windowed
+        self.num_probes = num_probes
+        self.seed = seed
+
+        self.field = None
+        self.channels_coupled = True
+
+    @property
+    def device(self):
+        return next(self.prior.parameters()).device
+
+    def random_grid(self, num_grids, generator):
+        size = self.representation_dim
+        z = torch.rand(num_grids, self.index_dim, size, size, generator=generator)
+        return (z * (self.num_levels - 1)).round().to(self.device)
+
+    def probe(self):
+        generator = torch.Generator().manual_seed(self.seed)
+        size = self.representation_dim
+        # The receptive field is measured from the bottom row, causality is checked from the centre
+        h, w = size - 1, size // 2
+        centre = size // 2
+
+        dependencies = torch.zeros(size, size, dtype=torch.bool, device=self.device)
+        future = False
+        coupled = False
+        with torch.enable_grad():
+            for _ in range(self.num_probes):
+                z = self.random_grid(1, generator).requires_grad_(True)
+                z_pred = self.prior(z)
+
+                grad, = torch.autograd.grad(z_pred[0, :, :, h, w].sum(), z, retain_graph=True)
+                dependencies |= (grad[0] != 0).any(dim=0)
+
+                grad, = torch.autograd.grad(z_pred[0, :, :, centre, centre].sum(), z, retain_graph=True)
+                seen = (grad[0] != 0).any(dim=0)
+                future |= bool(seen[centre, centre + 1:].any() or seen[centre + 1:].any())
+
+                # Does a later index channel of a pixel see the earlier ones
+                for c in range(1, self.index_dim):
+                    grad, = torch.autograd.grad(z_pred[0, :, c, h, w].sum(), z, retain_graph=True)
+                    coupled |= bool((grad[0, :c, h, w] != 0).any())
+
+        if future:
+            raise ValueError('Prior is not autoregressive in raster order, so it can not be sampled position by position')
+
+        # A field reaching the edge of the grid may extend further, so it is treated as unbounded in that direction
+        rows, cols = dependencies.nonzero(as_tuple=True)
+        self.field = (
+            size if rows.min().item() == 0 else h - rows.min().item(),
+            size if cols.min().item() == 0 else w - cols.min().item(),
+            size if cols.max().item() == size - 1 else cols.max().item() - w
+        ) if len(rows) else (0, 0, 0)
+        self.channels_coupled = coupled
+        self.check_window(generator)
+
+    def check_window(self, generator):
+        # Windowing is only exact if the probe found the full receptive field, otherwise fall back to full evaluation
+        size = self.representation_dim
+        z = self.random_grid(2, generator)
+        with torch.no_grad():
+            full = self.prior(z)
+            for h, w in ((size - 1, size - 1), (size // 2, size // 2), (size - 1, 0)):
+                windowed = self.logits_at(z, (h, w))
+                if not torch.allclose(windowed, full[:, :, :, h, w], atol=1e-4, rtol=1e-4):
+                    warnings.warn('Windowed prior evaluation does not match the full grid, sampling without windows')
+                    self.windowed = False
+                    return
+
+    def window(self, h, w):
+        rows_above, cols_left, cols_right = self.field
+        row_start = max(0, h - rows_above)
+        col_start = max(0, w - cols_left)
+        col_end = min(self.representation_dim, w + cols_right + 1)
+        return row_start, col_start, col_end
+
+    def logits_at(self, z, pixel, windowed=True):
+        # (B, num_levels, index_dim) logits for every channel of one pixel, given the grid filled in up to it.
+        # windowed=False always evaluates the full grid, for callers that need the result to be the same whatever
+        # the probe decided
+        h, w = pixel
+        if not (self.windowed and windowed):
+            return self.prior(z)[:, :, :, h, w]
+
+        if self.field is None:
+            self.probe()
+            if not self.windowed:
+                return self.prior(z)[:, :, :, h, w]
+
+        row_start, col_start, col_end = self.window(h, w)
+        z_pred = self.prior(z[:, :, row_start:h + 1, col_start:col_end])
+        return z_pred[:, :, :, h - row_start, w - col_start]
+
+    def draw(self, logits, temperature, top_k):
+        # logits (N, num_levels) -> (N,) sampled levels
+        logits = logits.float() / temperature
+        if top_k is not None and top_k < logits.size(-1):
+            threshold = logits.topk(top_k, dim=-1).values[:, -1:]
+            logits = logits.masked_fill(logits < threshold, float('-inf'))
+        return torch.multinomial(torch.softmax(logits, dim=-1), 1).squeeze(-1)
+
+    @torch.no_grad()
+    def sample(self, num_samples=1, temperature=1.0, top_k=None):
+        if self.windowed and self.field is None:
+            self.probe()
+
+        size = self.representation_dim
+        z = torch.zeros(num_samples, self.index_dim, size, size, device=self.device)
+
+        for h in range(size):
+            for w in range(size):
+                if self.channels_coupled:
+                    for c in range(self.index_dim):
+                        logits = self.logits_at(z, (h, w))[:, :, c]
+                        z[:, c, h, w] = self.draw(logits, temperature, top_k).float()
+                else:
+                    logits = self.logits_at(z, (h, w))
+                    logits = logits.permute(0, 2, 1).reshape(-1, self.num_levels)
+                    z[:, :, h, w] = self.draw(logits, temperature, top_k).view(num_samples, self.index_dim).float()
+
+        return z
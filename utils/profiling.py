@@ -0,0 +1,245 @@
+import sys
+import time
+import warnings
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def get_flop_counter_mode():
+    # Imported on first use, the flop counter pulls in torch.fx and costs a noticeable share of start up time
+    try:
+        from torch.utils.flop_counter import FlopCounterMode
+    except ImportError:
+        return None
+    return FlopCounterMode
+
+
+# Stage names match the HopVAE attributes they time, quantise is timed by HopVAE.stage
+STAGES = ("encoder", "pre_vq_conv", "hopfield", "embedding_to_index", "quantise", "index_to_embedding", "prior", "decoder")
+
+def stage_name(key):
+    path = key.split(".")[1:]
+    while path and path[0] == "module":
+        path = path[1:]
+    return ".".join(path) or None
+
+
+def peak_rss_mb():
+    # High water mark of the whole process, the CPU allocator keeps no peak that could be reset per stage
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+@contextmanager
+def quiet_backward_hooks():
+    # Stages whose input does not require grad (the encoder) trigger this, backward end times come from their parameters
+    # instead. Only silenced while the profiler is registering hooks or running a step, the process filters are restored after
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", message="Full backward hook is firing when gradients are computed with respect to module outputs")
+        yield
+
+
+class StageProfiler:
+    def __init__(self, model, count_flops=False, trace_dir=None, trace_wait=1, trace_warmup=1, trace_active=3):
+        self.model = model
+        self.cuda = model.device.type == "cuda"
+        self.flop_counter_mode = get_flop_counter_mode() if count_flops else None
+        self.count_flops = self.flop_counter_mode is not None
+
+        self.trace_dir = trace_dir
+        self.trace_schedule = (trace_wait, trace_warmup, trace_active)
+
+        self._handles = []
+        self._trace = None
+        self.paused = False
+        self._forward_start = {}
+        self._backward_start = {}
+        self._backward_end = {}
+        self.reset()
+
+    def reset(self):
+        self.stats = defaultdict(lambda: defaultdict(float))
+        self.steps = 0
+
+    def __enter__(self):
+        with quiet_backward_hooks():
+            for name in STAGES:
+                module = getattr(self.model, name, None)
+                if isinstance(module, torch.nn.Module):
+                    self._attach(name, module)
+
+        if self.trace_dir is not None:
+            wait, warmup, active = self.trace_schedule
+            self._trace = torch.profiler.profile(
+                schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(self.trace_dir),
+                profile_memory=True,
+                record_shapes=True
+            )
+            self._trace.__enter__()
+
+        self.model.profiler = self
+        return self
+
+    def __exit__(self, *exc):
+        self.model.profiler = None
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+        if self._trace is not None:
+            self._trace.__exit__(*exc)
+            self._trace = None
+
+        for name in list(self._backward_start):
+            self._flush_backward(name)
+        return False
+
+    @contextmanager
+    def pause(self):
+        # Forwards outside training steps (evaluation, interpolation, sampling) are left out of the stage figures
+        self.paused = True
+        self.model.profiler = None
+        try:
+            yield
+        finally:
+            self.model.profiler = self
+            self.paused = False
+
+    def _now(self):
+        if self.cuda:
+            torch.cuda.synchronize(self.model.device)
+        return time.perf_counter()
+
+    def _start_memory(self):
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.model.device)
+
+    def _record_memory(self, name, phase):
+        # On CUDA the allocator's peak over the stage, on CPU the process peak RSS once the stage has run
+        if self.cuda:
+            key, peak = f"{phase}_peak_memory_mb", torch.cuda.max_memory_allocated(self.model.device) / 2**20
+        else:
+            key, peak = f"{phase}_peak_rss_mb", peak_rss_mb()
+            if peak is None:
+                return
+        self.stats[name][key] = max(self.stats[name][key], peak)
+
+    def _attach(self, name, module):
+        def forward_pre_hook(module, inputs):
+            if self.paused:
+                return
+            self._flush_backward(name)
+            self._start_memory()
+            self._forward_start[name] = self._now()
+
+        def forward_hook(module, inputs, outputs):
+            if self.paused or name not in self._forward_start:
+                return
+            self.stats[name]["forward_ms"] += (self._now() - self._forward_start.pop(name)) * 1000
+            self.stats[name]["forward_calls"] += 1
+            self._record_memory(name, "forward")
+
+        def backward_pre_hook(module, grad_outputs):
+            if self.paused:
+                return
+            self._start_memory()
+            self._backward_start[name] = self._now()
+
+        def backward_hook(module, grad_inputs, grad_outputs):
+            self._mark_backward_end(name)
+
+        def accumulate_grad_hook(param):
+            self._mark_backward_end(name)
+
+        self._handles.append(module.register_forward_pre_hook(forward_pre_hook))
+        self._handles.append(module.register_forward_hook(forward_hook))
+        self._handles.append(module.register_full_backward_pre_hook(backward_pre_hook))
+        self._handles.append(module.register_full_backward_hook(backward_hook))
+
+        # A stage's backward is only finished once its own parameter gradients have been accumulated
+        if hasattr(torch.Tensor, "register_post_accumulate_grad_hook"):
+            for param in module.parameters():
+                if param.requires_grad:
+                    self._handles.append(param.register_post_accumulate_grad_hook(accumulate_grad_hook))
+
+    def _mark_backward_end(self, name):
+        if name in self._backward_start:
+            self._backward_end[name] = self._now()
+            self._record_memory(name, "backward")
+
+    def _flush_backward(self, name):
+        start = self._backward_start.pop(name, None)
+        end = self._backward_end.pop(name, None)
+        if start is not None and end is not None:
+            self.stats[name]["backward_ms"] += (end - start) * 1000
+            self.stats[name]["backward_calls"] += 1
+
+    def stage(self, name):
+        # For stages that are plain tensor code rather than modules
+        @contextmanager
+        def timed():
+            self._start_memory()
+            start = self._now()
+            yield
+            self.stats[name]["forward_ms"] += (self._now() - start) * 1000
+            self.stats[name]["forward_calls"] += 1
+            self._record_memory(name, "forward")
+        return timed()
+
+    @contextmanager
+    def step(self, stage=None):
+        # stage attributes every FLOP of the step to one stage, for steps that call a stage directly (train_prior)
+        flop_counter = self.flop_counter_mode(display=False) if self.count_flops else nullcontext()
+        with quiet_backward_hooks(), flop_counter:
+            yield
+
+        for name in list(self._backward_start):
+            self._flush_backward(name)
+
+        if self.count_flops and stage is not None:
+            self.stats[stage]["flops"] += sum(flop_counter.get_flop_counts().get("Global", {}).values())
+        elif self.count_flops:
+            for key, counts in flop_counter.get_flop_counts().items():
+                # Keys are module paths rooted at the class name of whatever was called, e.g. HopVAE.encoder, or
+                # DistributedDataParallel.module.encoder when the model runs wrapped
+                name = stage_name(key)
+                if name in STAGES:
+                    self.stats[name]["flops"] += sum(counts.values())
+
+        self.steps += 1
+        if self._trace is not None:
+            self._trace.step()
+
+    def summary(self):
+        # Per stage totals divided by the number of profiled steps. Peaks are not divided: peak_memory_mb is the CUDA
+        # allocator's peak within the stage, on CPU peak_rss_mb is the peak RSS of the whole process by the stage's end
+        steps = max(self.steps, 1)
+        summary = {}
+        for name in STAGES:
+            if name not in self.stats:
+                continue
+            summary[name] = {
+                key: (value if key.endswith(("peak_memory_mb", "peak_rss_mb")) else value / steps)
+                for key, value in self.stats[name].items()
+            }
+        return summary
+
+    def report(self):
+        lines = [f'{"stage":20} {"fwd ms":>10} {"bwd ms":>10} {"GFLOP":>10} {"peak MB" if self.cuda else "peak RSS MB":>11}']
+        memory = "peak_memory_mb" if self.cuda else "peak_rss_mb"
+        for name, stats in self.summary().items():
+            peak = max(stats.get(f"forward_{memory}", 0), stats.get(f"backward_{memory}", 0))
+            lines.append(f'{name:20} {stats.get("forward_ms", 0):10.3f} {stats.get("backward_ms", 0):10.3f} '
+                         f'{stats.get("flops", 0) / 1e9:10.3f} {peak:11.1f}')
+        return "\n".join(lines)
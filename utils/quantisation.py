@@ -0,0 +1,127 @@
+import copy
+import warnings
+from contextlib import contextmanager
+
+import torch
+import torch.nn as nn
+
+
+def calibration_batches(loader, num_batches):
+    # The first num_batches image batches of a loader, labels dropped
+    batches = []
+    for X, _ in loader:
+        batches.append(X)
+        if len(batches) == num_batches:
+            break
+    return batches
+
+
+@contextmanager
+def quantized_engine(backend):
+    # The quantised engine is process wide, it is only switched for the duration of the block
+    previous = torch.backends.quantized.engine
+    torch.backends.quantized.engine = backend
+    try:
+        yield
+    finally:
+        torch.backends.quantized.engine = previous
+
+
+class EngineScope(nn.Module):
+    # Runs a quantised module under the engine it was converted for, whatever engine the caller has selected
+    def __init__(self, module, backend):
+        super(EngineScope, self).__init__()
+        self.module = module
+        self.backend = backend
+
+    def forward(self, *inputs):
+        with quantized_engine(self.backend):
+            return self.module(*inputs)
+
+
+def quantise_static(module, calibration_inputs, backend="fbgemm"):
+    # FX graph mode post training quantisation, observers are calibrated on the given inputs and the
+    # converted module takes and returns fp32 tensors, so it drops into the model unchanged.
+    # fbgemm rather than x86 by default, the x86 engine's ConvTranspose2d kernels give wrong results in the Decoder
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    module = copy.deepcopy(module).float().eval().to(memory_format=torch.contiguous_format)
+    prepared = prepare_fx(module, get_default_qconfig_mapping(backend), (calibration_inputs[0],))
+
+    with torch.no_grad():
+        for inputs in calibration_inputs:
+            prepared(inputs)
+
+    return convert_fx(prepared)
+
+
+def quantise_dynamic(module):
+    # int8 weights with activations quantised on the fly, which suits the Linear layers of the fused lookups
+    from torch.ao.quantization import quantize_dynamic
+
+    return quantize_dynamic(copy.deepcopy(module).float().eval(), {nn.Linear}, dtype=torch.qint8)
+
+
+def quantise_model(model, calibration_images, backend="fbgemm"):
+    # Returns an int8 copy of an eval HopVAE for encode/reconstruct/sample on CPU, the model itself is untouched.
+    # Encoder with pre_vq_conv and the Decoder are statically quantised, calibrated on calibration_images and on the
+    # retrieved embeddings those images produce. The hopfield and index_to_embedding lookups use dynamic quantisation.
+    # embedding_to_index stays fp32, int8 cannot resolve num_levels steps of its output (cf. compile_lookups and top_k)
+    model.eval()
+
+    with torch.no_grad():
+        encoder_inputs = [X.to(model.device) for X in calibration_images]
+        decoder_inputs = [model.to_grid(model.embed(X), model.embedding_dim).float().contiguous() for X in encoder_inputs]
+
+    quantised = copy.deepcopy(model).cpu()
+    quantised.device = torch.device("cpu")
+    # Autocast and NHWC have no quantised kernels to dispatch to, the int8 convs pick their own layout
+    quantised.mixed_precision = False
+    quantised.channels_last = False
+    # Decodes cached from the fp32 weights must never be served by the int8 model, it starts with empty caches of the same size
+    quantised.enable_decode_cache(getattr(model.decode_cache, "max_bytes", 0), getattr(model.embedding_cache, "max_entries", 0))
+
+    # Weights are packed for the engine selected at conversion, so conversion and every int8 call run under backend
+    with quantized_engine(backend):
+        encoder = nn.Sequential(quantised.encoder, quantised.pre_vq_conv)
+        quantised.encoder = EngineScope(quantise_static(encoder, [X.cpu() for X in encoder_inputs], backend), backend)
+        quantised.pre_vq_conv = nn.Identity()
+        quantised.decoder = EngineScope(quantise_static(quantised.decoder, [z.cpu() for z in decoder_inputs], backend), backend)
+
+        fused_lookups = quantised.fuse_lookups()
+        for name in ("hopfield", "index_to_embedding"):
+            if name in fused_lookups:
+                fused_lookups[name] = EngineScope(quantise_dynamic(fused_lookups[name]), backend)
+            else:
+                warnings.warn(f'{name} could not be fused, it stays fp32 in the quantised model')
+        quantised.fused_lookups = fused_lookups
+
+    return quantised.eval()
+
+
+def compare(model, quantised, batches):
+    # Reconstruction MSE of both models against the inputs, MSE between their reconstructions and the
+    # fraction of quantised codes the int8 model reproduces exactly, along with how many levels off they are on average
+    totals = {"fp32_mse": 0.0, "int8_mse": 0.0, "int8_vs_fp32_mse": 0.0, "code_agreement": 0.0, "code_mean_abs_diff": 0.0}
+    num_images = 0
+
+    with torch.no_grad():
+        for X in batches:
+            X = X.cpu()
+            x_recon, _ = model.reconstruct(X.to(model.device))
+            x_recon_int8, _ = quantised.reconstruct(X)
+            x_recon = x_recon.cpu()
+
+            codes = model.encode(X.to(model.device)).cpu()
+            codes_int8 = quantised.encode(X)
+
+            n = X.size(0)
+            totals["fp32_mse"] += torch.mean((x_recon - X) ** 2).item() * n
+            totals["int8_mse"] += torch.mean((x_recon_int8 - X) ** 2).item() * n
+            totals["int8_vs_fp32_mse"] += torch.mean((x_recon_int8 - x_recon) ** 2).item() * n
+            totals["code_agreement"] += (codes_int8 == codes).float().mean().item() * n
+            totals["code_mean_abs_diff"] += (codes_int8 - codes).abs().float().mean().item() * n
+            num_images += n
+
+    return {key: value / max(num_images, 1) for key, value in totals.items()}
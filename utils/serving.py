@@ -0,0 +1,357 @@
+import base64
+import http.client
+import json
+import queue
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+from utils.codes import codes_to_bytes
+
+
+class DynamicBatcher:
+    # Coalesces concurrent submissions into one call of run_batch(items) -> one result per item. A batch is run
+    # once it holds max_batch_size rows or max_wait seconds after its first item arrived, whichever comes first
+    def __init__(self, run_batch, max_batch_size=64, max_wait=0.005):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.num_batches = 0
+        self.num_items = 0
+        self.num_rows = 0
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def submit(self, item, size=1):
+        future = Future()
+        self._queue.put((item, size, future))
+        return future
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def stats(self):
+        return {
+            "batches": self.num_batches,
+            "items": self.num_items,
+            "rows": self.num_rows,
+            "mean_batch_rows": self.num_rows / max(self.num_batches, 1)
+        }
+
+    def _collect(self, first):
+        # Items that would overflow the batch are carried over to start the next one, an oversized item runs alone
+        batch, rows = [first], first[1]
+        deadline = time.perf_counter() + self.max_wait
+        while rows < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                entry = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                return batch, None
+            if entry is None:
+                # Put the stop marker back so the worker sees it after running this batch
+                self._queue.put(None)
+                return batch, None
+            if rows + entry[1] > self.max_batch_size:
+                return batch, entry
+            batch.append(entry)
+            rows += entry[1]
+        return batch, None
+
+    def _worker(self):
+        carried = None
+        while True:
+            entry = carried if carried is not None else self._queue.get()
+            if entry is None:
+                return
+
+            batch, carried = self._collect(entry)
+            items = [item for item, _, _ in batch]
+            futures = [future for _, _, future in batch]
+            try:
+                results = self.run_batch(items)
+            except Exception as error:
+                for future in futures:
+                    future.set_exception(error)
+            else:
+                for future, result in zip(futures, results):
+                    future.set_result(result)
+
+            self.num_batches += 1
+            self.num_items += len(batch)
+            self.num_rows += sum(size for _, size, _ in batch)
+
+
+class InferenceService:
+    # Thread safe front end to a loaded HopVAE, every entry point has its own batcher and a shared lock
+    # serialises the model calls so batches for different entry points never compete for the same cores
+    ENDPOINTS = ("encode", "decode", "reconstruct", "sample", "interpolate")
+
+    def __init__(self, model, config, max_batch_size=64, max_wait=0.005):
+        self.model = model.eval()
+        self.config = config
+        self._lock = threading.Lock()
+        self.batchers = {name: DynamicBatcher(getattr(self, f'_run_{name}'), max_batch_size, max_wait) for name in self.ENDPOINTS}
+
+    def close(self):
+        for batcher in self.batchers.values():
+            batcher.close()
+
+    def stats(self):
+        stats = {name: batcher.stats() for name, batcher in self.batchers.items()}
+        for name in ("decode_cache", "embedding_cache"):
+            cache = getattr(self.model, name, None)
+            if cache is not None:
+                stats[name] = cache.stats()
+        return stats
+
+    def encode(self, x):
+        x = self._check_images(x)
+        return self._submit("encode", x, x.size(0))
+
+    def decode(self, z_indices_quantised):
+        z_indices_quantised = self._check_codes(z_indices_quantised)
+        return self._submit("decode", z_indices_quantised, z_indices_quantised.size(0))
+
+    def decode_packed(self, data):
+        return self.decode(self.model.unpack(data))
+
+    def reconstruct(self, x):
+        x = self._check_images(x)
+        return self._submit("reconstruct", x, x.size(0))
+
+    def sample(self, num_samples=1, temperature=1.0, top_k=None):
+        if num_samples < 1:
+            raise ValueError(f'num_samples must be at least 1, got {num_samples}')
+        return self._submit("sample", (num_samples, float(temperature), top_k), num_samples)
+
+    def interpolate(self, x, y, steps=1):
+        x, y = self._check_images(x), self._check_images(y)
+        if x.size() != y.size():
+            raise ValueError(f'Can only interpolate between batches of the same size, got {tuple(x.size())} and {tuple(y.size())}')
+        if steps < 1:
+            raise ValueError(f'steps must be at least 1, got {steps}')
+        return self._submit("interpolate", (x, y, steps), steps * x.size(0))
+
+    def _submit(self, name, item, size):
+        return self.batchers[name].submit(item, size).result()
+
+    def _check_images(self, x):
+        x = torch.as_tensor(x, dtype=torch.float32)
+        expected = (self.config.num_channels, self.config.image_size, self.config.image_size)
+        if x.dim() != 4 or tuple(x.shape[1:]) != expected:
+            raise ValueError(f'Expected images of shape (N, {", ".join(map(str, expected))}), got {tuple(x.shape)}')
+        return x
+
+    def _check_codes(self, z_indices_quantised):
+        z_indices_quantised = torch.as_tensor(z_indices_quantised, dtype=torch.int64)
+        expected = (self.model.index_dim, self.model.representation_dim, self.model.representation_dim)
+        if z_indices_quantised.dim() != 4 or tuple(z_indices_quantised.shape[1:]) != expected:
+            raise ValueError(f'Expected codes of shape (N, {", ".join(map(str, expected))}), got {tuple(z_indices_quantised.shape)}')
+        if z_indices_quantised.min() < 0 or z_indices_quantised.max() >= self.model.num_levels:
+            raise ValueError(f'Codes must lie in [0, {self.model.num_levels})')
+        return z_indices_quantised
+
+    def _call(self, fn, *args, **kwargs):
+        with self._lock, torch.no_grad():
+            return fn(*args, **kwargs)
+
+    def _split(self, out, items):
+        return [chunk.cpu() for chunk in torch.split(out, [item.size(0) for item in items])]
+
+    def _run_encode(self, items):
+        x = torch.cat(items).to(self.model.device)
+        return self._split(self._call(self.model.encode, x), items)
+
+    def _run_decode(self, items):
+        z_indices_quantised = torch.cat(items).to(self.model.device)
+        return self._split(self._call(self.model.decode, z_indices_quantised), items)
+
+    def _run_reconstruct(self, items):
+        x = torch.cat(items).to(self.model.device)
+        x_recon, _ = self._call(self.model.reconstruct, x)
+        return self._split(x_recon, items)
+
+    def _run_sample(self, items):
+        # Requests only share a prior pass when they asked for the same temperature and top_k
+        results = [None] * len(items)
+        groups = {}
+        for i, (num_samples, temperature, top_k) in enumerate(items):
+            groups.setdefault((temperature, top_k), []).append(i)
+
+        for (temperature, top_k), indices in groups.items():
+            sizes = [items[i][0] for i in indices]
+            samples = self._call(self.model.sample, sum(sizes), temperature=temperature, top_k=top_k)
+            for i, chunk in zip(indices, torch.split(samples, sizes)):
+                results[i] = chunk.cpu()
+        return results
+
+    def _run_interpolate(self, items):
+        results = [None] * len(items)
+        groups = {}
+        for i, (_, _, steps) in enumerate(items):
+            groups.setdefault(steps, []).append(i)
+
+        for steps, indices in groups.items():
+            x = torch.cat([items[i][0] for i in indices]).to(self.model.device)
+            y = torch.cat([items[i][1] for i in indices]).to(self.model.device)
+            # Rows come back step major over all pairs, so each request picks its own pairs out of every step
+            out = self._call(self.model.interpolate, x, y, steps).view(steps, x.size(0), *x.shape[1:])
+
+            start = 0
+            for i in indices:
+                num_pairs = items[i][0].size(0)
+                results[i] = out[:, start:start + num_pairs].reshape(-1, *x.shape[1:]).cpu()
+                start += num_pairs
+        return results
+
+
+def tensor_to_json(x):
+    x = np.ascontiguousarray(x.detach().cpu().numpy(), dtype='<f4')
+    return {"shape": list(x.shape), "data": base64.b64encode(x.tobytes()).decode('ascii')}
+
+
+def tensor_from_json(obj):
+    data = np.frombuffer(base64.b64decode(obj["data"]), dtype='<f4')
+    return torch.from_numpy(data.reshape(obj["shape"]).copy())
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    # JSON over HTTP, images travel as base64 little endian float32 with their shape and codes in the
+    # bit packed format from utils.codes, so a request body costs about the same as the raw tensors
+    service = None
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._reply(200, self.service.stats())
+        elif self.path == '/health':
+            self._reply(200, {"status": "ok"})
+        else:
+            self._reply(404, {"error": f'Unknown endpoint {self.path}'})
+
+    def do_POST(self):
+        name = self.path.strip('/')
+        if name not in InferenceService.ENDPOINTS:
+            self._reply(404, {"error": f'Unknown endpoint {self.path}'})
+            return
+
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            self._reply(200, getattr(self, f'_{name}')(body))
+        except (ValueError, KeyError, TypeError) as error:
+            self._reply(400, {"error": f'{type(error).__name__}: {error}'})
+        except Exception as error:
+            self._reply(500, {"error": f'{type(error).__name__}: {error}'})
+
+    def _encode(self, body):
+        z_indices_quantised = self.service.encode(tensor_from_json(body["images"]))
+        return {"codes": base64.b64encode(codes_to_bytes(z_indices_quantised.numpy(), self.service.model.num_levels)).decode('ascii')}
+
+    def _decode(self, body):
+        return {"images": tensor_to_json(self.service.decode_packed(base64.b64decode(body["codes"])))}
+
+    def _reconstruct(self, body):
+        return {"images": tensor_to_json(self.service.reconstruct(tensor_from_json(body["images"])))}
+
+    def _sample(self, body):
+        samples = self.service.sample(int(body.get("num_samples", 1)), body.get("temperature", 1.0), body.get("top_k"))
+        return {"images": tensor_to_json(samples)}
+
+    def _interpolate(self, body):
+        interpolations = self.service.interpolate(tensor_from_json(body["x"]), tensor_from_json(body["y"]), int(body.get("steps", 1)))
+        return {"images": tensor_to_json(interpolations)}
+
+    def _reply(self, status, obj):
+        data = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket peers have no host to report
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    # Unix sockets refuse rather than queue connections past the backlog, and clients arrive in bursts
+    request_queue_size = 128
+
+
+def make_server(service, host='127.0.0.1', port=8000, unix_socket=None):
+    # A Unix socket keeps the server reachable from local processes and tests without opening a network port
+    handler = type('BoundServiceHandler', (ServiceHandler,), {"service": service})
+    if unix_socket is not None:
+        return UnixHTTPServer(unix_socket, handler)
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=60):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class ServiceClient:
+    # Keeps one connection open, so use one client per thread
+    def __init__(self, host='127.0.0.1', port=8000, unix_socket=None, timeout=60):
+        if unix_socket is not None:
+            self.connection = UnixHTTPConnection(unix_socket, timeout)
+        else:
+            self.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def close(self):
+        self.connection.close()
+
+    def request(self, endpoint, body=None):
+        data = None if body is None else json.dumps(body).encode('utf-8')
+        self.connection.request('GET' if body is None else 'POST', f'/{endpoint}', body=data,
+                                headers={'Content-Type': 'application/json'})
+        response = self.connection.getresponse()
+        obj = json.loads(response.read())
+        if response.status != 200:
+            raise RuntimeError(f'{endpoint} failed with status {response.status}: {obj.get("error")}')
+        return obj
+
+    def encode(self, x):
+        return base64.b64decode(self.request("encode", {"images": tensor_to_json(x)})["codes"])
+
+    def decode(self, data):
+        return tensor_from_json(self.request("decode", {"codes": base64.b64encode(data).decode('ascii')})["images"])
+
+    def reconstruct(self, x):
+        return tensor_from_json(self.request("reconstruct", {"images": tensor_to_json(x)})["images"])
+
+    def sample(self, num_samples=1, temperature=1.0, top_k=None):
+        body = {"num_samples": num_samples, "temperature": temperature, "top_k": top_k}
+        return tensor_from_json(self.request("sample", body)["images"])
+
+    def interpolate(self, x, y, steps=1):
+        body = {"x": tensor_to_json(x), "y": tensor_to_json(y), "steps": steps}
+        return tensor_from_json(self.request("interpolate", body)["images"])
+
+    def stats(self):
+        return self.request("stats")
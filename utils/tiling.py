@@ -0,0 +1,101 @@
+import torch
+import torch.nn.functional as F
+
+# Images of any size are covered by overlapping tiles at the training resolution, laid out row major.
+# Tiles are processed batch_size at a time, so memory grows with the image and not with the number of tiles,
+# and outputs are blended with weights that ramp down over the overlap so no seam is a hard edge
+
+
+def tile_starts(size, tile_size, overlap):
+    # The last tile sits flush with the edge, so it can overlap its neighbour by more than overlap
+    if not 0 <= overlap < tile_size:
+        raise ValueError(f'overlap must lie in [0, {tile_size}), got {overlap}')
+    if size <= tile_size:
+        return [0]
+    starts = list(range(0, size - tile_size, tile_size - overlap))
+    return starts + [size - tile_size]
+
+
+def tile_grid(height, width, tile_size, overlap):
+    return [(top, left) for top in tile_starts(height, tile_size, overlap) for left in tile_starts(width, tile_size, overlap)]
+
+
+def blend_window(tile_size, overlap, device=None):
+    # Rises linearly over the first overlap pixels and falls over the last, never reaching 0 so pixels only one tile covers keep their value
+    ramp = torch.arange(tile_size, device=device, dtype=torch.float32)
+    weights = torch.minimum(ramp + 1, tile_size - ramp).div(overlap + 1).clamp(max=1)
+    return weights[:, None] * weights[None, :]
+
+
+def pad_to_tile(x, tile_size):
+    # Images smaller than a tile are padded with their edge pixels and cropped again afterwards
+    pad_height, pad_width = max(0, tile_size - x.size(-2)), max(0, tile_size - x.size(-1))
+    if pad_height or pad_width:
+        x = F.pad(x, (0, pad_width, 0, pad_height), mode="replicate")
+    return x
+
+
+def iter_tiles(x, tile_size, overlap, batch_size):
+    # Yields ((image, position) pairs, (B, C, tile_size, tile_size) tiles) over every tile of every image in order
+    tiles = [(n, position) for n in range(x.size(0)) for position in tile_grid(x.size(-2), x.size(-1), tile_size, overlap)]
+    for start in range(0, len(tiles), batch_size):
+        batch = tiles[start:start + batch_size]
+        yield batch, torch.stack([x[n, :, top:top + tile_size, left:left + tile_size] for n, (top, left) in batch])
+
+
+def blend_tiles(batches, num_images, num_channels, height, width, tile_size, overlap, device):
+    # Weighted average of (positions, tiles) batches over (N, C, height, width), only the canvas and one batch are ever held
+    canvas = torch.zeros(num_images, num_channels, height, width, device=device)
+    total = torch.zeros(num_images, 1, height, width, device=device)
+    window = blend_window(tile_size, overlap, device)
+
+    for batch, tiles in batches:
+        for (n, (top, left)), tile in zip(batch, tiles):
+            canvas[n, :, top:top + tile_size, left:left + tile_size] += tile.float() * window
+            total[n, :, top:top + tile_size, left:left + tile_size] += window
+
+    return canvas / total
+
+
+@torch.no_grad()
+def encode_tiled(model, x, overlap, batch_size):
+    # (N, C, H, W) -> (N, num_tiles, index_dim, representation_dim, representation_dim) codes, tiles row major
+    padded = pad_to_tile(x, model.image_size)
+    num_tiles = len(tile_grid(padded.size(-2), padded.size(-1), model.image_size, overlap))
+
+    codes = [model.encode(tiles.to(model.device)) for _, tiles in iter_tiles(padded, model.image_size, overlap, batch_size)]
+    return torch.cat(codes).view(x.size(0), num_tiles, *codes[0].shape[1:])
+
+
+@torch.no_grad()
+def decode_tiled(model, z_indices_quantised, height, width, overlap, batch_size):
+    # Inverse of encode_tiled for images of height x width, which fix the tile layout
+    padded_height, padded_width = max(height, model.image_size), max(width, model.image_size)
+    grid = tile_grid(padded_height, padded_width, model.image_size, overlap)
+    if z_indices_quantised.size(1) != len(grid):
+        raise ValueError(f'A {height}x{width} image with overlap {overlap} has {len(grid)} tiles, got codes for {z_indices_quantised.size(1)}')
+
+    tiles = [(n, position) for n in range(z_indices_quantised.size(0)) for position in grid]
+    z_indices_quantised = z_indices_quantised.flatten(0, 1)
+
+    def batches():
+        for start in range(0, len(tiles), batch_size):
+            yield tiles[start:start + batch_size], model.decode(z_indices_quantised[start:start + batch_size].to(model.device))
+
+    x = blend_tiles(batches(), len(z_indices_quantised) // len(grid), model.num_channels, padded_height, padded_width,
+                    model.image_size, overlap, model.device)
+    return x[..., :height, :width]
+
+
+@torch.no_grad()
+def reconstruct_tiled(model, x, overlap, batch_size):
+    # Tiles go through encode and decode together, without materialising the codes of the whole image
+    padded = pad_to_tile(x, model.image_size)
+
+    def batches():
+        for batch, tiles in iter_tiles(padded, model.image_size, overlap, batch_size):
+            x_recon, _ = model.reconstruct(tiles.to(model.device))
+            yield batch, x_recon
+
+    x_recon = blend_tiles(batches(), x.size(0), x.size(1), padded.size(-2), padded.size(-1), model.image_size, overlap, model.device)
+    return x_recon[..., :x.size(-2), :x.size(-1)]